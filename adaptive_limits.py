@@ -0,0 +1,174 @@
+"""
+Library for working out how many requests to have in flight to each host at once. The limit for
+each host is raised slowly while its responses stay fast, and cut sharply when it starts throttling
+us, timing out or slowing down - additive increase, multiplicative decrease (AIMD), as TCP does
+for its congestion window.
+
+@author: SquidneyPoitier <squidney.poitier@gmail.com>
+@version: 0.1
+"""
+
+from collections import deque;
+import threading;
+import time;
+
+dflt_initial = 4;           # Requests in flight to a host before anything is known about it.
+dflt_minimum = 1;
+dflt_maximum = 64;
+dflt_increase = 1.0;        # Added to the limit for each limit's worth of good responses.
+dflt_decrease = 0.5;        # The limit is multiplied by this on a bad response.
+dflt_latency_factor = 2.0;  # Latency this many times the host's baseline counts as a bad response.
+dflt_cooldown = 1.0;        # Seconds after a decrease during which further decreases are ignored.
+dflt_history = 1000;        # Limit changes remembered per host.
+
+throttle_codes = (429, 503);
+
+class AIMDController:
+    '''
+    Thread-safe per-host concurrency limits. Feed it every response with record(), and ask it for
+    a host's current limit with limit().
+
+    A response is bad if its status is in throttle_codes, if the request failed (timeouts
+    included), or if the host's smoothed latency has risen above latency_factor times its
+    baseline. The baseline follows the lowest latencies seen, creeping up slowly so it can adapt
+    to a host that is permanently slower.
+    '''
+
+    def __init__(self, initial=dflt_initial, minimum=dflt_minimum, maximum=dflt_maximum,
+                 increase=dflt_increase, decrease=dflt_decrease,
+                 latency_factor=dflt_latency_factor, cooldown=dflt_cooldown,
+                 history=dflt_history):
+        '''
+        @param initial: int, the starting limit for each host.
+        @param minimum: int, the lowest the limit goes.
+        @param maximum: int, the highest the limit goes.
+        @param increase: Amount added to the limit once per limit's worth of good responses.
+        @param decrease: Factor (0 to 1) the limit is multiplied by on a bad response.
+        @param latency_factor: How far above baseline latency may rise before it counts as bad.
+        @param cooldown: Seconds after a decrease during which bad responses are not counted
+                    again, since requests already in flight will report the same problem.
+        @param history: int, number of limit changes kept for each host.
+        '''
+
+        self.initial = initial;
+        self.minimum = minimum;
+        self.maximum = maximum;
+        self.increase = increase;
+        self.decrease = decrease;
+        self.latency_factor = latency_factor;
+        self.cooldown = cooldown;
+        self.history = history;
+
+        self.lock = threading.Lock();
+        self.hosts = {};
+
+    def host(self, host):
+        '''
+        The HostLimit for a host, created if needed. Call with the lock held.
+        '''
+
+        if host not in self.hosts:
+            self.hosts[host] = HostLimit(self.initial, self.history);
+
+        return self.hosts[host];
+
+    def limit(self, host):
+        '''
+        @param host: String, the netloc.
+        @return: Returns the number of requests currently allowed in flight to the host.
+        '''
+
+        with self.lock:
+            return int(self.host(host).limit);
+
+    def record(self, host, latency, status=None, error=None):
+        '''
+        Adjust a host's limit for a response.
+
+        @param host: String, the netloc.
+        @param latency: Seconds from sending the request to receiving the response headers (or to
+                    the failure).
+        @param status: int, the HTTP status, None if the request failed.
+        @param error: The exception the request failed with, if it did.
+        '''
+
+        now = time.time();
+        with self.lock:
+            h = self.host(host);
+
+            if error != None or status in throttle_codes:
+                if error != None:
+                    reason = 'error: ' + type(error).__name__;
+                else:
+                    reason = 'status ' + str(status);
+                self.backOff(h, now, reason);
+                return;
+
+            # Smoothed latency, and a baseline that drops straight to new lows but only drifts up.
+            if h.latency == None:
+                h.latency = h.base = latency;
+            else:
+                h.latency += 0.2*(latency - h.latency);
+                if latency < h.base:
+                    h.base = latency;
+                else:
+                    h.base += 0.01*(latency - h.base);
+
+            if h.latency > self.latency_factor*h.base and h.base > 0:
+                self.backOff(h, now, 'latency %.3fs, baseline %.3fs' % (h.latency, h.base));
+                return;
+
+            # Additive increase - spread over a limit's worth of responses, so the limit rises by
+            # about 'increase' per round trip.
+            old = int(h.limit);
+            h.limit = min(self.maximum, h.limit + self.increase/h.limit);
+            if int(h.limit) != old:
+                h.change(now, 'increase');
+
+    def backOff(self, h, now, reason):
+        '''
+        Multiplicative decrease. Call with the lock held.
+        '''
+
+        if now - h.last_decrease < self.cooldown:
+            return;
+
+        h.last_decrease = now;
+        h.limit = max(self.minimum, h.limit*self.decrease);
+        h.change(now, reason);
+
+    def stats(self):
+        '''
+        @return: Returns a dictionary keyed by host, each value a dictionary with the current
+                'limit', the smoothed 'latency' and 'base_latency' in seconds, and the 'history'
+                of (time, limit, reason) changes, oldest first.
+        '''
+
+        with self.lock:
+            out = {};
+            for name, h in self.hosts.items():
+                out[name] = {
+                             'limit' : int(h.limit),
+                             'latency' : h.latency,
+                             'base_latency' : h.base,
+                             'history' : list(h.changes)
+                             };
+
+            return out;
+
+
+class HostLimit:
+    '''
+    The state of a single host in an AIMDController.
+    '''
+
+    def __init__(self, initial, history):
+        self.limit = float(initial);
+        self.latency = None;
+        self.base = None;
+        self.last_decrease = 0;
+        self.changes = deque(maxlen=history);
+        self.changes.append((time.time(), int(self.limit), 'initial'));
+
+    def change(self, now, reason):
+        self.changes.append((now, int(self.limit), reason));
@@ -0,0 +1,351 @@
+"""
+Library for keeping everything found about the articles crawled - titles, authors, citations and
+the files downloaded for them - in a SQLite index which lasts between runs and can be queried.
+
+The index also lets a crawl skip work it has already done: an article page whose URL is in the
+index under a DOI isn't fetched again, and its files aren't downloaded again while they are
+still where they were saved.
+
+Writes are queued and made in batches, each in a single transaction, so that indexing doesn't
+hold up the crawl.
+
+@author: SquidneyPoitier <squidney.poitier@gmail.com>
+@version: 0.1
+"""
+
+from os import path;
+import json;
+import re;
+import sqlite3;
+import threading;
+import time;
+
+dflt_index_file = path.join(path.dirname(path.abspath(__file__)), 'articles.sqlite');
+dflt_batch_size = 500;      # Records queued before they are written.
+index_format = 1;           # Stored as the database's user_version.
+
+re_doi_prefix = re.compile(r'^\s*(?:doi:\s*|https?://(?:dx\.)?doi\.org/)', re.IGNORECASE);
+
+# Fields with their own columns. The rest are only kept in the JSON of all the fields.
+columns = ('doi', 'url', 'title', 'journal', 'volume', 'issue', 'pages', 'year');
+
+schema = '''
+CREATE TABLE IF NOT EXISTS articles (
+    id INTEGER PRIMARY KEY,
+    doi TEXT UNIQUE,
+    url TEXT NOT NULL,
+    title TEXT,
+    title_key TEXT,
+    journal TEXT,
+    volume TEXT,
+    issue TEXT,
+    pages TEXT,
+    year TEXT,
+    fields TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS articles_url ON articles (url);
+CREATE INDEX IF NOT EXISTS articles_issue ON articles (journal, volume, issue);
+CREATE INDEX IF NOT EXISTS articles_title ON articles (title_key);
+CREATE TABLE IF NOT EXISTS authors (
+    article INTEGER NOT NULL,
+    pos INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    name_key TEXT NOT NULL,
+    PRIMARY KEY (article, pos)
+);
+CREATE INDEX IF NOT EXISTS authors_name ON authors (name_key);
+CREATE TABLE IF NOT EXISTS files (
+    doi TEXT NOT NULL,
+    url TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    PRIMARY KEY (doi, url)
+);
+''';
+
+class ArticleIndex:
+    '''
+    Thread-safe index of articles, in a SQLite database. Articles are keyed by their DOI, or by
+    their URL if none was found.
+
+    Records are dictionaries of the fields found for an article (see fetchMode.stepFields) plus
+    its 'url', with the 'doi' normalised (see normalizeDOI).
+    '''
+
+    def __init__(self, fname=dflt_index_file, batch_size=dflt_batch_size):
+        '''
+        Opens the index, creating it if needed.
+
+        @param fname: String, the database file.
+        @param batch_size: int, the number of records and files queued before they are written.
+        '''
+
+        self.fname = fname;
+        self.batch_size = batch_size;
+        self.lock = threading.Lock();
+        self.queued = {};       # Key (DOI or URL) -> record, waiting to be written.
+        self.queued_urls = {};  # URL -> record, for the same records.
+        self.queued_files = {}; # (DOI, URL) -> file tuple, waiting to be written.
+
+        self.conn = sqlite3.connect(fname, check_same_thread=False);
+        self.conn.text_factory = str;
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL');
+            self.conn.execute('PRAGMA synchronous=NORMAL');
+            self.conn.executescript(schema);
+            self.conn.execute('PRAGMA user_version=' + str(index_format));
+            self.conn.commit();
+
+    def add(self, fields):
+        '''
+        Queue an article to be added, replacing what the index has under the same key.
+
+        @param fields: Dictionary of the article's fields, including its 'url'.
+        '''
+
+        record = dict(fields);
+        record['doi'] = normalizeDOI(record.get('doi'));
+        ident = record['doi'] or record['url'];
+
+        with self.lock:
+            self.queued[ident] = record;
+            self.queued_urls[record['url']] = record;
+            full = len(self.queued) + len(self.queued_files) >= self.batch_size;
+
+        if full:
+            self.flush();
+
+    def addBranch(self, branch, names):
+        '''
+        Queue an article from a download_pdfs.Branch, with the fields it inherits.
+
+        @param names: List of the names of the fields to keep.
+        '''
+
+        fields = dict([(name, branch.getField(name)) for name in names]);
+        fields['url'] = branch.url;
+        self.add(fields);
+
+    def addFile(self, doi, f):
+        '''
+        Queue a file downloaded for an article.
+
+        @param doi: String, the article's DOI.
+        @param f: The download_pdfs.DownloadedFile.
+        '''
+
+        doi = normalizeDOI(doi);
+        if doi == None:
+            return;
+
+        with self.lock:
+            self.queued_files[(doi, f.url)] = (doi, f.url, f.path, f.size, f.checksum);
+            full = len(self.queued) + len(self.queued_files) >= self.batch_size;
+
+        if full:
+            self.flush();
+
+    def flush(self):
+        '''
+        Write everything queued, in one transaction.
+        '''
+
+        with self.lock:
+            records = self.queued.values();
+            files = self.queued_files.values();
+            if len(records) == 0 and len(files) == 0:
+                return;
+
+            now = time.time();
+            with self.conn:
+                for record in records:
+                    self._write(record, now);
+                self.conn.executemany('INSERT OR REPLACE INTO files (doi, url, path, size, sha256) '
+                                      'VALUES (?, ?, ?, ?, ?)', files);
+
+            self.queued = {};
+            self.queued_urls = {};
+            self.queued_files = {};
+
+    def _write(self, record, now):
+        conn = self.conn;
+        if record['doi'] != None:
+            row = conn.execute('SELECT id FROM articles WHERE doi=?', (record['doi'],)).fetchone();
+        else:
+            row = conn.execute('SELECT id FROM articles WHERE doi IS NULL AND url=?',
+                               (record['url'],)).fetchone();
+
+        values = [record.get(name) for name in columns];
+        values += [key(record.get('title')), json.dumps(record), now];
+        if row == None:
+            cur = conn.execute('INSERT INTO articles (' + ', '.join(columns) + ', title_key, '
+                               'fields, updated) VALUES (' + ', '.join(['?']*(len(columns) + 3)) +
+                               ')', values);
+            article = cur.lastrowid;
+        else:
+            article = row[0];
+            conn.execute('UPDATE articles SET ' + ', '.join([name + '=?' for name in columns]) +
+                         ', title_key=?, fields=?, updated=? WHERE id=?', values + [article]);
+            conn.execute('DELETE FROM authors WHERE article=?', (article,));
+
+        authors = record.get('authors') or [];
+        conn.executemany('INSERT INTO authors (article, pos, name, name_key) VALUES (?, ?, ?, ?)',
+                         [(article, i, name, key(name)) for i, name in enumerate(authors)]);
+
+    def get(self, doi):
+        '''
+        @param doi: String, a DOI, in any of the forms normalizeDOI accepts.
+        @return: Returns the record for the DOI, or None if the index doesn't have it.
+        '''
+
+        doi = normalizeDOI(doi);
+        if doi == None:
+            return None;
+
+        with self.lock:
+            if doi in self.queued:
+                return dict(self.queued[doi]);
+            row = self.conn.execute('SELECT fields FROM articles WHERE doi=?', (doi,)).fetchone();
+
+        return json.loads(row[0]) if row != None else None;
+
+    def has(self, doi):
+        return self.get(doi) != None;
+
+    def getURL(self, url):
+        '''
+        @param url: String, the article's URL.
+        @return: Returns the most recent record for the URL, or None.
+        '''
+
+        with self.lock:
+            if url in self.queued_urls:
+                return dict(self.queued_urls[url]);
+            row = self.conn.execute('SELECT fields FROM articles WHERE url=? '
+                                    'ORDER BY updated DESC LIMIT 1', (url,)).fetchone();
+
+        return json.loads(row[0]) if row != None else None;
+
+    def getFile(self, doi, url):
+        '''
+        @return: Returns a tuple of the path, size and SHA-256 of the file recorded for an
+                article's DOI and the file's URL, or None.
+        '''
+
+        doi = normalizeDOI(doi);
+        with self.lock:
+            if (doi, url) in self.queued_files:
+                return self.queued_files[(doi, url)][2:];
+            return self.conn.execute('SELECT path, size, sha256 FROM files WHERE doi=? AND url=?',
+                                     (doi, url)).fetchone();
+
+    def search(self, title=None, author=None, journal=None, volume=None, issue=None, year=None,
+               limit=None):
+        '''
+        Find articles. Anything queued is written first. All the conditions given must match.
+
+        @param title: String, the start of the title (case-insensitive).
+        @param author: String, the start of an author's name (case-insensitive).
+        @param journal: String, the journal name, exactly.
+        @param volume: String, the volume, exactly.
+        @param issue: String, the issue, exactly.
+        @param year: String, the year, exactly.
+        @param limit: int, the most records to return, or None for all.
+        @return: Returns a list of records, in the order they were first indexed.
+        '''
+
+        self.flush();
+
+        where = [];
+        args = [];
+        for name, value in (('journal', journal), ('volume', volume), ('issue', issue),
+                            ('year', year)):
+            if value != None:
+                where.append(name + '=?');
+                args.append(value);
+
+        if title != None:
+            where.append('title_key >= ? AND title_key < ?');
+            args += prefixRange(key(title));
+
+        if author != None:
+            where.append('id IN (SELECT article FROM authors WHERE name_key >= ? AND name_key < ?)');
+            args += prefixRange(key(author));
+
+        query = 'SELECT fields FROM articles';
+        if len(where):
+            query += ' WHERE ' + ' AND '.join(where);
+        query += ' ORDER BY id';
+        if limit != None:
+            query += ' LIMIT ' + str(int(limit));
+
+        with self.lock:
+            rows = self.conn.execute(query, args).fetchall();
+
+        return [json.loads(row[0]) for row in rows];
+
+    def issue(self, journal, volume, issue=None):
+        '''
+        @return: Returns the records of an issue (or of a whole volume if issue is None).
+        '''
+        return self.search(journal=journal, volume=volume, issue=issue);
+
+    def count(self):
+        self.flush();
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM articles').fetchone()[0];
+
+    def close(self):
+        self.flush();
+        with self.lock:
+            self.conn.close();
+
+    def __enter__(self):
+        return self;
+
+    def __exit__(self, *args):
+        self.close();
+
+
+def normalizeDOI(doi):
+    '''
+    Reduce a DOI to the form it is indexed under - without any 'doi:' or resolver URL in front of
+    it, and in lower case, since DOIs are case-insensitive.
+
+    @param doi: String, or None.
+    @return: Returns the DOI, or None if the string isn't one.
+    '''
+
+    if not doi:
+        return None;
+
+    doi = re_doi_prefix.sub('', doi).strip().lower();
+    if not doi.startswith('10.'):
+        return None;
+
+    return doi;
+
+def key(value):
+    '''
+    @return: Returns the form of a title or name used for case-insensitive prefix searches.
+    '''
+
+    if value == None:
+        return None;
+
+    if isinstance(value, str):
+        value = value.decode('utf-8', 'replace');
+
+    return ' '.join(value.lower().split());
+
+def prefixRange(prefix):
+    '''
+    @return: Returns the bounds of the range of strings starting with a prefix, so a prefix
+            search can use an index.
+    '''
+
+    # Text is compared as UTF-8 bytes, and no UTF-8 string has a 0xff byte in it.
+    prefix = prefix.encode('utf-8');
+    return [prefix, prefix + '\xff'];
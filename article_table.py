@@ -0,0 +1,272 @@
+"""
+Library for holding the information found for a large number of articles compactly. Rather than
+an object (with its own dictionary) per article, an ArticleTable keeps one array of integers per
+field, each integer the index of a string in a single pool, so every distinct string is stored
+once however many articles share it - a journal name, a volume, an author.
+
+@author: SquidneyPoitier <squidney.poitier@gmail.com>
+@version: 0.1
+"""
+
+import settings_manager as SettingsManager;
+from array import array;
+
+dflt_columns = ('url', 'title', 'pdf', 'journal', 'volume', 'issue', 'pages', 'doi', 'year');
+dflt_list_columns = SettingsManager.fetchMode.listFields;
+
+class StringPool(object):
+    '''
+    Interns strings, giving each distinct string an integer id. None has the id -1.
+    '''
+
+    __slots__ = ('ids', 'strings');
+
+    def __init__(self):
+        self.ids = {};
+        self.strings = [];
+
+    def id(self, value):
+        '''
+        @param value: String, or None.
+        @return: Returns the id of the string, adding it to the pool if it's new.
+        '''
+
+        if value == None:
+            return -1;
+
+        i = self.ids.get(value);
+        if i == None:
+            i = len(self.strings);
+            self.ids[value] = i;
+            self.strings.append(value);
+
+        return i;
+
+    def find(self, value):
+        '''
+        @return: Returns the id of a string, or None if it isn't in the pool.
+        '''
+
+        if value == None:
+            return -1;
+
+        return self.ids.get(value);
+
+    def get(self, i):
+        if i < 0:
+            return None;
+
+        return self.strings[i];
+
+    def __len__(self):
+        return len(self.strings);
+
+
+class ArticleTable(object):
+    '''
+    Column-oriented table of articles. Each single-valued field is an array of string ids, one
+    per article. Each list field (e.g. the authors) is an array of the string ids of all the
+    articles' values end to end, plus an array of offsets into it - the values for article i run
+    from offsets[i] to offsets[i + 1].
+
+    Rows are read back through ArticleRow items, which are made as needed and have getField() as
+    download_pdfs.Branch does, so a table can be used in place of the branches (for example with
+    make_pdf.orderArticles).
+    '''
+
+    __slots__ = ('pool', 'columns', 'list_columns', 'values', 'offsets', 'items', 'length');
+
+    def __init__(self, columns=dflt_columns, list_columns=dflt_list_columns, pool=None):
+        '''
+        @param columns: List of names of the single-valued fields.
+        @param list_columns: List of names of the fields with a list of values.
+        @param pool: StringPool to share with other tables, or None for a new one.
+        '''
+
+        if pool == None:
+            pool = StringPool();
+
+        self.pool = pool;
+        self.columns = tuple(columns);
+        self.list_columns = tuple(list_columns);
+        self.values = dict([(name, array('l')) for name in self.columns]);
+        self.offsets = dict([(name, array('l', [0])) for name in self.list_columns]);
+        self.items = dict([(name, array('l')) for name in self.list_columns]);
+        self.length = 0;
+
+    def append(self, fields):
+        '''
+        Add an article.
+
+        @param fields: Dictionary of field values. Missing fields are stored as None (or an empty
+                    list), fields not in the table are ignored.
+        @return: Returns the index of the new row.
+        '''
+
+        intern = self.pool.id;
+        for name in self.columns:
+            self.values[name].append(intern(fields.get(name)));
+
+        for name in self.list_columns:
+            items = self.items[name];
+            items.extend([intern(v) for v in fields.get(name) or ()]);
+            self.offsets[name].append(len(items));
+
+        self.length += 1;
+        return self.length - 1;
+
+    def appendBranch(self, branch):
+        '''
+        Add an article from a download_pdfs.Branch, including the fields it inherits from the
+        branches above it. The 'url' column is the branch's URL.
+
+        @return: Returns the index of the new row.
+        '''
+
+        fields = {'url' : branch.url};
+        for name in self.columns + self.list_columns:
+            if name != 'url':
+                fields[name] = branch.getField(name);
+
+        return self.append(fields);
+
+    def get(self, i, name, default=None):
+        '''
+        @param i: int, the row.
+        @param name: String, the field.
+        @return: Returns the value of the field for the row - a string (or None) for single-valued
+                fields, a list of strings for list fields - or default if there is no such field.
+        '''
+
+        if name in self.values:
+            return self.pool.get(self.values[name][i]);
+        elif name in self.items:
+            offsets = self.offsets[name];
+            strings = self.pool.strings;
+            return [strings[v] for v in self.items[name][offsets[i]:offsets[i + 1]]];
+
+        return default;
+
+    def row(self, i):
+        if i < 0:
+            i += self.length;
+        if i < 0 or i >= self.length:
+            raise IndexError('Row out of range');
+
+        return ArticleRow(self, i);
+
+    def __len__(self):
+        return self.length;
+
+    def __getitem__(self, i):
+        return self.row(i);
+
+    def __iter__(self):
+        for i in xrange(self.length):
+            yield ArticleRow(self, i);
+
+    def column(self, name):
+        '''
+        Generator over the values of a field, in row order.
+        '''
+
+        if name in self.values:
+            get = self.pool.get;
+            for v in self.values[name]:
+                yield get(v);
+        else:
+            for i in xrange(self.length):
+                yield self.get(i, name);
+
+    def where(self, name, value):
+        '''
+        Find the rows where a single-valued field equals a value, by comparing ids rather than
+        strings. For a list field, the rows where any of the values is equal.
+
+        @return: Returns the list of row indices, in order.
+        '''
+
+        vid = self.pool.find(value);
+        if vid == None:
+            return [];
+
+        if name in self.values:
+            return [i for i, v in enumerate(self.values[name]) if v == vid];
+
+        offsets = self.offsets[name];
+        items = self.items[name];
+        return [i for i in xrange(self.length) if vid in items[offsets[i]:offsets[i + 1]]];
+
+    def filter(self, func):
+        '''
+        @param func: Function taking an ArticleRow and returning True to keep it.
+        @return: Returns a new ArticleTable, sharing this one's string pool, with the rows kept.
+        '''
+
+        return self.select([row.index for row in self if func(row)]);
+
+    def select(self, indices):
+        '''
+        @param indices: List of row indices.
+        @return: Returns a new ArticleTable, sharing this one's string pool, with those rows in
+                the order given.
+        '''
+
+        out = ArticleTable(self.columns, self.list_columns, self.pool);
+        for name in self.columns:
+            col = self.values[name];
+            out.values[name] = array('l', [col[i] for i in indices]);
+
+        for name in self.list_columns:
+            offsets = self.offsets[name];
+            items = self.items[name];
+            new_offsets = out.offsets[name];
+            new_items = out.items[name];
+            for i in indices:
+                new_items.extend(items[offsets[i]:offsets[i + 1]]);
+                new_offsets.append(len(new_items));
+
+        out.length = len(indices);
+        return out;
+
+
+class ArticleRow(object):
+    '''
+    A view of one row of an ArticleTable.
+    '''
+
+    __slots__ = ('table', 'index');
+
+    def __init__(self, table, index):
+        self.table = table;
+        self.index = index;
+
+    def getField(self, name, default=None):
+        return self.table.get(self.index, name, default);
+
+    def __getitem__(self, name):
+        return self.table.get(self.index, name);
+
+    def fields(self):
+        '''
+        @return: Returns a dictionary of all the row's fields.
+        '''
+
+        table = self.table;
+        return dict([(name, table.get(self.index, name))
+                     for name in table.columns + table.list_columns]);
+
+
+def fromTree(root, columns=dflt_columns, list_columns=dflt_list_columns):
+    '''
+    Build a table of the articles found by a crawl.
+
+    @param root: The download_pdfs.Branch returned by PDFDownloader.parseStep.
+    @return: Returns an ArticleTable with a row for each leaf (article), in order.
+    '''
+
+    table = ArticleTable(columns, list_columns);
+    for branch in root.leaves():
+        table.appendBranch(branch);
+
+    return table;
@@ -0,0 +1,1524 @@
+"""
+Library for crawling issues and downloading their PDFs on a single event loop thread, for
+services which already run one, where a thread per request would be wasted and would hide how
+much work is waiting.
+
+Python 2 has no asyncio, so this provides the small part of it that is needed, in the same
+shape: an EventLoop built on asyncore (using poll(), so thousands of sockets can be open at
+once), Futures, and Tasks which run generator-based coroutines. A coroutine yields a Future - or
+another coroutine - to wait for it, and raises Return(value) to return a value:
+
+    def titles(downloader):
+        stream = downloader.articles();
+        while True:
+            branch = yield stream.next();
+            if branch == None:
+                break;
+            print(branch.getField('title'));
+
+    downloader = AsyncDownloader(toc_url, 'Nature');
+    downloader.loop.runUntilComplete(titles(downloader));
+
+Cancelling a Task throws CancelledError into its coroutine where it is waiting, and cancels
+whatever it was waiting for, down to the requests, whose connections are closed.
+
+@author: SquidneyPoitier <squidney.poitier@gmail.com>
+@version: 0.1
+"""
+
+import connection_pool as ConnectionPool;
+import download_pdfs as DownloadPDFs;
+import metrics as Metrics;
+from error_handling import DownloadError;
+from collections import deque;
+from os import path;
+import asyncore;
+import errno;
+import hashlib;
+import heapq;
+import os;
+import select;
+import socket;
+import ssl;
+import sys;
+import time;
+import types;
+import urlparse;
+import zlib;
+
+dflt_concurrency = 64;      # Pages and files fetched at once by an AsyncDownloader.
+dflt_max_head = 64*1024;    # The most bytes of response headers accepted.
+
+# Future states
+PENDING = 'pending';
+CANCELLED = 'cancelled';
+FINISHED = 'finished';
+
+class CancelledError(Exception):
+    '''
+    Thrown into a coroutine whose Task has been cancelled, where it is waiting.
+    '''
+    pass;
+
+class Return(Exception):
+    '''
+    Raised by a coroutine to return a value, since generators can't return one in Python 2.
+    '''
+
+    def __init__(self, value=None):
+        Exception.__init__(self, value);
+        self.value = value;
+
+class StaleConnection(Exception):
+    '''
+    Raised by AsyncConnection.send when a reused keep-alive connection turns out to have been
+    closed by the server before anything was received, so the request can be sent again.
+    '''
+    pass;
+
+
+class EventLoop:
+    '''
+    Runs callbacks, timers and the sockets of the AsyncConnections created on it, on the thread
+    which calls run or runUntilComplete. Nothing on it is thread-safe.
+    '''
+
+    def __init__(self):
+        self.map = {};          # fd -> asyncore.dispatcher, for the loop's sockets only.
+        self.ready = deque();   # (func, args) to call on the next pass.
+        self.timers = [];       # Heap of (when, sequence number, Timer).
+        self.seq = 0;
+        self.errors = [];       # Exceptions raised by callbacks.
+
+        if hasattr(select, 'poll'):
+            self.poll = asyncore.poll2;
+        else:
+            self.poll = asyncore.poll;
+
+    def callSoon(self, func, *args):
+        '''
+        Call func(*args) on the next pass of the loop.
+        '''
+        self.ready.append((func, args));
+
+    def callLater(self, delay, func, *args):
+        '''
+        Call func(*args) once delay seconds have passed.
+
+        @return: Returns a Timer, which can be cancelled.
+        '''
+
+        timer = Timer(time.time() + delay, func, args);
+        heapq.heappush(self.timers, (timer.when, self.seq, timer));
+        self.seq += 1;
+        return timer;
+
+    def createFuture(self):
+        return Future(self);
+
+    def createTask(self, coro):
+        '''
+        @param coro: A generator - the result of calling a coroutine.
+        @return: Returns a Task running the coroutine, from the next pass of the loop.
+        '''
+        return Task(self, coro);
+
+    def sleep(self, delay, result=None):
+        '''
+        @return: Returns a Future which is resolved with result after delay seconds.
+        '''
+
+        future = Future(self);
+        timer = self.callLater(delay, _resolve, future, result);
+        future.addDoneCallback(lambda f: timer.cancel());
+        return future;
+
+    def runOnce(self):
+        '''
+        Wait for a socket to be ready or a timer to be due, at most a second, and run
+        everything that is then ready.
+        '''
+
+        timeout = 1.0;
+        if len(self.ready):
+            timeout = 0;
+        elif len(self.timers):
+            timeout = min(timeout, max(0, self.timers[0][0] - time.time()));
+
+        if len(self.map):
+            self.poll(timeout, self.map);
+        elif timeout > 0:
+            time.sleep(timeout);
+
+        now = time.time();
+        while len(self.timers) and self.timers[0][0] <= now:
+            timer = heapq.heappop(self.timers)[2];
+            if not timer.cancelled:
+                self.ready.append((timer.func, timer.args));
+
+        # Only what is ready now - callbacks added by these run on the next pass.
+        for i in range(len(self.ready)):
+            func, args = self.ready.popleft();
+            try:
+                func(*args);
+            except Exception as e:
+                self.errors.append(e);
+
+    def runUntilComplete(self, future):
+        '''
+        Run the loop until a Future is done.
+
+        @param future: The Future, or a generator to run as a Task.
+        @return: Returns the Future's result.
+        @raise: Raises the Future's exception, or CancelledError if it was cancelled.
+        '''
+
+        if isinstance(future, types.GeneratorType):
+            future = self.createTask(future);
+
+        while not future.done():
+            self.runOnce();
+
+        return future.result();
+
+    def close(self):
+        '''
+        Close every socket left open on the loop.
+        '''
+        asyncore.close_all(self.map);
+
+
+class Timer:
+    '''
+    A call scheduled by EventLoop.callLater.
+    '''
+
+    def __init__(self, when, func, args):
+        self.when = when;
+        self.func = func;
+        self.args = args;
+        self.cancelled = False;
+
+    def cancel(self):
+        self.cancelled = True;
+
+
+class Future:
+    '''
+    The result of something which finishes later. Callbacks added to it are called on the loop,
+    with the Future, once it has a result or an exception or is cancelled.
+    '''
+
+    def __init__(self, loop):
+        self.loop = loop;
+        self.state = PENDING;
+        self.value = None;
+        self.exc_info = None;   # (type, value, traceback) of the exception, if there was one.
+        self.callbacks = [];
+
+    def done(self):
+        return self.state != PENDING;
+
+    def cancelled(self):
+        return self.state == CANCELLED;
+
+    def cancel(self):
+        '''
+        @return: Returns True if the Future was cancelled, False if it was already done.
+        '''
+
+        if self.state != PENDING:
+            return False;
+
+        self.state = CANCELLED;
+        self._schedule();
+        return True;
+
+    def result(self):
+        '''
+        @return: Returns the result.
+        @raise: Raises the exception the Future finished with, or CancelledError if it was
+                cancelled.
+        '''
+
+        if self.state == CANCELLED:
+            raise CancelledError();
+        if self.state == PENDING:
+            raise RuntimeError('The result is not ready.');
+        if self.exc_info != None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2];
+
+        return self.value;
+
+    def exception(self):
+        '''
+        @return: Returns the exception the Future finished with, or None.
+        '''
+
+        if self.state == CANCELLED:
+            raise CancelledError();
+        if self.state == PENDING:
+            raise RuntimeError('The result is not ready.');
+
+        return self.exc_info[1] if self.exc_info != None else None;
+
+    def setResult(self, value):
+        if self.state != PENDING:
+            raise RuntimeError('The Future is already done.');
+
+        self.value = value;
+        self.state = FINISHED;
+        self._schedule();
+
+    def setException(self, exc, tb=None):
+        if self.state != PENDING:
+            raise RuntimeError('The Future is already done.');
+
+        self.exc_info = (type(exc), exc, tb);
+        self.state = FINISHED;
+        self._schedule();
+
+    def addDoneCallback(self, func):
+        if self.state != PENDING:
+            self.loop.callSoon(func, self);
+        else:
+            self.callbacks.append(func);
+
+    def _schedule(self):
+        for func in self.callbacks:
+            self.loop.callSoon(func, self);
+        self.callbacks = [];
+
+
+class Task(Future):
+    '''
+    Runs a generator-based coroutine on the loop. The Task's result is the coroutine's, given
+    by raising Return, or None if it just ends.
+    '''
+
+    def __init__(self, loop, coro):
+        Future.__init__(self, loop);
+        self.coro = coro;
+        self.waiting = None;        # The Future the coroutine is waiting for.
+        self.must_cancel = False;
+        loop.callSoon(self._step, None, None);
+
+    def cancel(self):
+        '''
+        Cancel the Task: CancelledError is thrown into the coroutine where it is waiting, and
+        what it was waiting for is cancelled. The coroutine can catch it to clean up.
+
+        @return: Returns False if the Task is already done.
+        '''
+
+        if self.done():
+            return False;
+
+        if self.waiting == None or not self.waiting.cancel():
+            self.must_cancel = True;
+
+        return True;
+
+    def _step(self, value, exc_info):
+        if self.done():
+            return;
+
+        if self.must_cancel:
+            self.must_cancel = False;
+            exc_info = (CancelledError, CancelledError(), None);
+
+        self.waiting = None;
+        try:
+            if exc_info != None:
+                yielded = self.coro.throw(*exc_info);
+            else:
+                yielded = self.coro.send(value);
+        except StopIteration:
+            self.setResult(None);
+            return;
+        except Return as e:
+            self.setResult(e.value);
+            return;
+        except CancelledError:
+            Future.cancel(self);
+            return;
+        except Exception as e:
+            self.setException(e, sys.exc_info()[2]);
+            return;
+
+        if isinstance(yielded, types.GeneratorType):
+            yielded = Task(self.loop, yielded);
+
+        if isinstance(yielded, Future):
+            self.waiting = yielded;
+            yielded.addDoneCallback(self._wakeup);
+            if self.must_cancel and yielded.cancel():
+                self.must_cancel = False;
+        elif yielded == None:
+            # A bare yield lets everything else ready run first.
+            self.loop.callSoon(self._step, None, None);
+        else:
+            error = TypeError('Coroutines must yield Futures or coroutines, not ' +
+                              repr(yielded));
+            self.loop.callSoon(self._step, None, (TypeError, error, None));
+
+    def _wakeup(self, future):
+        if future.cancelled():
+            self._step(None, (CancelledError, CancelledError(), None));
+        elif future.exc_info != None:
+            self._step(None, future.exc_info);
+        else:
+            self._step(future.value, None);
+
+
+def _resolve(future, value):
+    if not future.done():
+        future.setResult(value);
+
+def _nextWaiter(waiters):
+    '''
+    @return: Returns the first Future in a deque which is still waiting, or None.
+    '''
+
+    while len(waiters):
+        future = waiters.popleft();
+        if not future.done():
+            return future;
+
+    return None;
+
+def gather(loop, futures):
+    '''
+    @param futures: List of Futures (or coroutines, run as Tasks).
+    @return: Returns a Future for the list of their results, in order. It finishes with the
+            first exception any of them raises. Cancelling it cancels them all.
+    '''
+
+    futures = [loop.createTask(f) if isinstance(f, types.GeneratorType) else f for f in futures];
+    outer = Future(loop);
+    left = [len(futures)];
+
+    def finished(future):
+        if outer.done():
+            return;
+        if future.cancelled():
+            outer.cancel();
+        elif future.exc_info != None:
+            outer.setException(future.exc_info[1], future.exc_info[2]);
+        else:
+            left[0] -= 1;
+            if left[0] == 0:
+                outer.setResult([f.value for f in futures]);
+
+    def cancelled(outer):
+        if outer.cancelled():
+            for future in futures:
+                future.cancel();
+
+    if len(futures) == 0:
+        outer.setResult([]);
+    for future in futures:
+        future.addDoneCallback(finished);
+    outer.addDoneCallback(cancelled);
+    return outer;
+
+
+class Semaphore:
+    '''
+    Caps how many coroutines do something at once. Waiters are let in in the order they came.
+
+    A coroutine cancelled just as it was let in has to give its place back:
+
+        acquiring = semaphore.acquire();
+        try:
+            yield acquiring;
+        except CancelledError:
+            semaphore.giveBack(acquiring);
+            raise;
+    '''
+
+    def __init__(self, loop, value):
+        self.loop = loop;
+        self.value = value;
+        self.waiters = deque();
+
+    def acquire(self):
+        '''
+        @return: Returns a Future which is resolved once the caller is let in.
+        '''
+
+        future = Future(self.loop);
+        if self.value > 0 and len(self.waiters) == 0:
+            self.value -= 1;
+            future.setResult(True);
+        else:
+            self.waiters.append(future);
+
+        return future;
+
+    def release(self):
+        waiter = _nextWaiter(self.waiters);
+        if waiter != None:
+            waiter.setResult(True);
+        else:
+            self.value += 1;
+
+    def giveBack(self, acquiring):
+        '''
+        Release the place granted to a Future from acquire() if it was, for a caller which was
+        cancelled while waiting for it.
+        '''
+
+        if acquiring.done() and not acquiring.cancelled():
+            self.release();
+
+
+class Queue:
+    '''
+    First-in first-out queue between coroutines. Once it holds maxsize items, putting another
+    waits until one is taken, so a slow consumer holds back its producers.
+    '''
+
+    def __init__(self, loop, maxsize=0):
+        '''
+        @param maxsize: int, the most items held, or 0 for no limit.
+        '''
+
+        self.loop = loop;
+        self.maxsize = maxsize;
+        self.items = deque();
+        self.getters = deque();
+        self.putters = deque();     # (Future, item)
+        self.closed = False;
+
+    def put(self, item):
+        '''
+        @return: Returns a Future which is resolved once the item is in the queue.
+        @raise RuntimeError: Raised if the queue is closed.
+        '''
+
+        if self.closed:
+            raise RuntimeError('The queue is closed.');
+
+        future = Future(self.loop);
+        getter = _nextWaiter(self.getters);
+        if getter != None:
+            getter.setResult(item);
+            future.setResult(None);
+        elif self.maxsize <= 0 or len(self.items) < self.maxsize:
+            self.items.append(item);
+            future.setResult(None);
+        else:
+            self.putters.append((future, item));
+
+        return future;
+
+    def get(self):
+        '''
+        @return: Returns a Future for the next item, or for None once the queue is closed and
+                empty.
+        '''
+
+        future = Future(self.loop);
+        if len(self.items):
+            future.setResult(self.items.popleft());
+            while len(self.putters):
+                putter, item = self.putters.popleft();
+                if not putter.done():
+                    self.items.append(item);
+                    putter.setResult(None);
+                    break;
+        elif self.closed:
+            future.setResult(None);
+        else:
+            self.getters.append(future);
+
+        return future;
+
+    def close(self):
+        '''
+        Stop taking items. Getters get what is left, then None.
+        '''
+
+        self.closed = True;
+        if len(self.items) == 0:
+            while True:
+                getter = _nextWaiter(self.getters);
+                if getter == None:
+                    break;
+                getter.setResult(None);
+
+    def __len__(self):
+        return len(self.items);
+
+
+class AsyncPool:
+    '''
+    Event loop counterpart of connection_pool.ConnectionPool: keep-alive connections per scheme
+    and netloc, capped per host, with requests over the cap waiting for a connection.
+
+    Host names are resolved once, the first time a host is used, and that lookup blocks the loop.
+    '''
+
+    def __init__(self, loop, max_per_host=ConnectionPool.dflt_max_per_host,
+                 max_idle=ConnectionPool.dflt_max_idle, timeout=ConnectionPool.dflt_timeout,
+                 max_redirects=ConnectionPool.dflt_max_redirects):
+        '''
+        @param loop: The EventLoop the requests run on.
+        @param max_per_host: int, the most connections open to a single host at once.
+        @param max_idle: int, the most idle connections kept for reuse per host.
+        @param timeout: Number of seconds a request can go without receiving anything.
+        @param max_redirects: int, the most redirects followed for a single request.
+        '''
+
+        self.loop = loop;
+        self.max_per_host = max_per_host;
+        self.max_idle = max_idle;
+        self.timeout = timeout;
+        self.max_redirects = max_redirects;
+        self.hosts = {};
+        self.ssl_context = None;
+
+    def host(self, scheme, netloc):
+        key = (scheme, netloc);
+        if key not in self.hosts:
+            self.hosts[key] = AsyncHost(self, scheme, netloc);
+
+        return self.hosts[key];
+
+    def request(self, url, headers=None, method='GET', sink=None):
+        '''
+        Perform a request, following redirects.
+
+        @param url: String, the absolute URL.
+        @param headers: Dictionary of extra request headers.
+        @param method: String, the HTTP method.
+        @param sink: Function called with each chunk of the decoded body of a 200 or 206
+                    response as it arrives, instead of the body being kept, or None.
+        @return: Returns a Task for the connection_pool.Response (with an empty body if there
+                was a sink).
+        @raise DownloadError: Raised by the Task if the request could not be made or there are
+                    too many redirects.
+        '''
+        return self.loop.createTask(self._request(url, headers, method, sink));
+
+    def _request(self, url, headers, method, sink):
+        for i in range(self.max_redirects + 1):
+            parsed = urlparse.urlsplit(url);
+            host = self.host(parsed.scheme, parsed.netloc);
+
+            rpath = parsed.path or '/';
+            if parsed.query:
+                rpath += '?' + parsed.query;
+
+            while True:
+                acquiring = host.acquire();
+                try:
+                    conn = yield acquiring;
+                except CancelledError:
+                    if acquiring.done() and not acquiring.cancelled() and \
+                            acquiring.exc_info == None:
+                        host.release(acquiring.value, True);
+                    raise;
+
+                try:
+                    resp = yield conn.send(method, rpath, url, headers, sink);
+                    break;
+                except StaleConnection:
+                    continue;
+
+            if resp.status not in ConnectionPool.redirect_codes or \
+                    resp.getheader('location') == None:
+                raise Return(resp);
+
+            url = urlparse.urljoin(url, resp.getheader('location'));
+            if resp.status == 303:
+                method = 'GET';
+
+        raise DownloadError(DownloadError.ERR_REDIRECT, 'Too many redirects: ' + url);
+
+    def close(self):
+        '''
+        Close the idle connections.
+        '''
+
+        for host in self.hosts.values():
+            host.close();
+
+
+class AsyncHost:
+    '''
+    The connections of an AsyncPool to a single scheme and netloc.
+    '''
+
+    def __init__(self, pool, scheme, netloc):
+        self.pool = pool;
+        self.scheme = scheme;
+        self.netloc = netloc;
+        parsed = urlparse.urlsplit(scheme + '://' + netloc);
+        self.hostname = parsed.hostname;
+        self.port = parsed.port or (443 if scheme == 'https' else 80);
+        self.address = None;        # (family, sockaddr), once resolved.
+
+        self.idle = [];
+        self.open = 0;
+        self.waiters = deque();
+
+    def resolve(self):
+        if self.address == None:
+            info = socket.getaddrinfo(self.hostname, self.port, 0, socket.SOCK_STREAM);
+            self.address = (info[0][0], info[0][4]);
+
+        return self.address;
+
+    def acquire(self):
+        '''
+        @return: Returns a Future for an AsyncConnection - an idle one if there is one, a new
+                one if the host is under its cap, or the next one released otherwise.
+        '''
+
+        future = Future(self.pool.loop);
+        if len(self.idle):
+            conn = self.idle.pop();
+            conn.reused = True;
+            future.setResult(conn);
+        elif self.open < self.pool.max_per_host:
+            self._connect(future);
+        else:
+            self.waiters.append(future);
+
+        return future;
+
+    def _connect(self, future):
+        self.open += 1;
+        try:
+            conn = AsyncConnection(self);
+        except (socket.error, ssl.SSLError) as e:
+            self.open -= 1;
+            Metrics.registry.inc('http_errors_total', host=self.netloc);
+            future.setException(DownloadError(DownloadError.ERR_FETCH, 'Could not connect to ' +
+                                              self.scheme + '://' + self.netloc + ': ' + str(e)));
+            return;
+
+        future.setResult(conn);
+
+    def release(self, conn, keep):
+        '''
+        Give a connection back once its response has been read completely, or once it has been
+        closed (keep False).
+        '''
+
+        if keep:
+            waiter = _nextWaiter(self.waiters);
+            if waiter != None:
+                conn.reused = True;
+                waiter.setResult(conn);
+                return;
+            if len(self.idle) < self.pool.max_idle:
+                self.idle.append(conn);
+                return;
+            conn.shut();
+            conn.given_back = True;
+
+        self.open -= 1;
+        waiter = _nextWaiter(self.waiters);
+        if waiter != None:
+            self._connect(waiter);
+
+    def dropped(self, conn):
+        '''
+        A connection was closed with no request on it. If it was idle, it is let go; if not,
+        it is given back when the request sent on it fails.
+        '''
+
+        if conn in self.idle:
+            self.idle.remove(conn);
+            conn.given_back = True;
+            self.open -= 1;
+
+    def close(self):
+        idle = self.idle;
+        self.idle = [];
+        for conn in idle:
+            conn.shut();
+            conn.given_back = True;
+        self.open -= len(idle);
+
+
+class Exchange:
+    '''
+    A request on an AsyncConnection and the state of reading its response.
+    '''
+
+    def __init__(self, future, method, url, sink):
+        self.future = future;
+        self.method = method;
+        self.url = url;
+        self.sink = sink;
+        self.start = time.time();
+        self.deadline = None;
+        self.received = False;      # Whether any of the response has arrived.
+
+        self.state = 'head';
+        self.status = None;
+        self.headers = [];
+        self.remaining = 0;
+        self.will_close = False;
+        self.streaming = False;
+        self.decoder = None;
+        self.parts = [];
+
+
+class AsyncConnection(asyncore.dispatcher):
+    '''
+    A non-blocking HTTP/1.1 connection, which reads responses as they arrive - with a
+    Content-Length, chunked, or up to the end of the connection - and keeps the connection for
+    the next request when the server allows.
+    '''
+
+    def __init__(self, host):
+        '''
+        Start connecting.
+
+        @param host: The AsyncHost the connection belongs to.
+        @raise socket.error: Raised if the connection can't be started.
+        '''
+
+        pool = host.pool;
+        asyncore.dispatcher.__init__(self, map=pool.loop.map);
+        self.host = host;
+        self.loop = pool.loop;
+        self.reused = False;
+        self.exchange = None;
+        self.out = '';
+        self.inbuf = '';
+        self.handshaking = False;
+        self.want_write = False;
+        self.shut_down = False;
+        self.given_back = False;    # Whether its host has been told it is closed.
+        self.error = None;          # What closed it, if that happened with no request on it.
+        self.timer = None;
+
+        family, address = host.resolve();
+        self.create_socket(family, socket.SOCK_STREAM);
+        try:
+            self.connect(address);
+        except socket.error:
+            self.close();
+            raise;
+
+    def send(self, method, rpath, url, headers=None, sink=None):
+        '''
+        Send a request. The connection is given back to its host when the response has been read.
+
+        @param rpath: String, the path and query to request.
+        @param url: String, the full URL, for the Response and for errors.
+        @return: Returns a Future for the connection_pool.Response.
+        @raise StaleConnection: Raised by the Future if the connection was reused and the server
+                    had closed it.
+        '''
+
+        hdrs = {
+                'Host' : self.host.netloc,
+                'Accept-Encoding' : 'gzip, deflate',
+                'User-Agent' : ConnectionPool.dflt_user_agent
+                };
+        if headers != None:
+            hdrs.update(headers);
+
+        lines = [method + ' ' + rpath + ' HTTP/1.1'];
+        lines += [name + ': ' + str(value) for name, value in hdrs.items()];
+        self.out += '\r\n'.join(lines) + '\r\n\r\n';
+
+        future = Future(self.loop);
+        ex = self.exchange = Exchange(future, method, url, sink);
+        future.addDoneCallback(self._cancelled);
+        if self.shut_down:
+            self._fail(self.error or socket.error(errno.ECONNRESET, 'Connection closed'));
+            return future;
+
+        ex.deadline = time.time() + self.host.pool.timeout;
+        self.timer = self.loop.callLater(self.host.pool.timeout, self._checkTimeout);
+        return future;
+
+    def _cancelled(self, future):
+        # A request cancelled part way leaves the connection in an unknown state.
+        if future.cancelled() and self.exchange != None and self.exchange.future is future:
+            self.exchange = None;
+            self._discard();
+
+    def _checkTimeout(self):
+        ex = self.exchange;
+        self.timer = None;
+        if ex == None:
+            return;
+
+        now = time.time();
+        if now >= ex.deadline:
+            self._fail(socket.timeout('timed out'));
+        else:
+            self.timer = self.loop.callLater(ex.deadline - now, self._checkTimeout);
+
+    # asyncore callbacks
+
+    def readable(self):
+        return not self.connecting and not (self.handshaking and self.want_write);
+
+    def writable(self):
+        if self.connecting:
+            return True;
+        if self.handshaking:
+            return self.want_write;
+
+        return len(self.out) > 0;
+
+    def handle_connect(self):
+        if self.host.scheme == 'https':
+            pool = self.host.pool;
+            if pool.ssl_context == None:
+                pool.ssl_context = ssl.create_default_context();
+            self.socket = pool.ssl_context.wrap_socket(self.socket,
+                                                       server_hostname=self.host.hostname,
+                                                       do_handshake_on_connect=False);
+            self.handshaking = True;
+            self.want_write = True;
+
+    def _handshake(self):
+        try:
+            self.socket.do_handshake();
+        except ssl.SSLWantReadError:
+            self.want_write = False;
+            return;
+        except ssl.SSLWantWriteError:
+            self.want_write = True;
+            return;
+
+        self.handshaking = False;
+        self.want_write = False;
+
+    def handle_write(self):
+        if self.handshaking:
+            self._handshake();
+            return;
+
+        if len(self.out) == 0:
+            return;
+
+        try:
+            sent = self.socket.send(self.out);
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return;
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return;
+            raise;
+
+        self.out = self.out[sent:];
+
+    def handle_read(self):
+        if self.handshaking:
+            self._handshake();
+            return;
+
+        while self._readOnce():
+            # Data already decrypted isn't signalled by poll.
+            if not isinstance(self.socket, ssl.SSLSocket) or not self.socket.pending():
+                return;
+
+    def _readOnce(self):
+        '''
+        @return: Returns True if data was received and the connection is still open.
+        '''
+
+        try:
+            data = self.socket.recv(DownloadPDFs.dflt_chunk_size);
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return False;
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return False;
+            raise;
+
+        if not data:
+            self._eof();
+            return False;
+
+        self._received(data);
+        return not self.shut_down;
+
+    def handle_close(self):
+        # What was sent before the connection closed may complete the response.
+        try:
+            while not self.shut_down and not self.handshaking and self._readOnce():
+                pass;
+        except socket.error as e:
+            self._fail(e);
+            return;
+
+        if not self.shut_down:
+            self._eof();
+
+    def handle_expt(self):
+        self._fail(socket.error(errno.ECONNRESET, 'Connection error'));
+
+    def handle_error(self):
+        self._fail(sys.exc_info()[1]);
+
+    # Reading responses
+
+    def _received(self, data):
+        ex = self.exchange;
+        if ex == None:
+            # Nothing was asked for. The server is closing the connection, or misbehaving.
+            self._discard();
+            return;
+
+        Metrics.registry.inc('http_received_bytes_total', len(data), host=self.host.netloc);
+        ex.received = True;
+        ex.deadline = time.time() + self.host.pool.timeout;
+        self.inbuf += data;
+        try:
+            self._parse(ex);
+        except (ValueError, zlib.error, IOError, OSError) as e:
+            self._fail(e);
+
+    def _parse(self, ex):
+        while self.exchange is ex and len(self.inbuf):
+            if ex.state == 'head':
+                end = self.inbuf.find('\r\n\r\n');
+                if end < 0:
+                    if len(self.inbuf) > dflt_max_head:
+                        raise ValueError('Response headers too long');
+                    return;
+
+                head = self.inbuf[:end];
+                self.inbuf = self.inbuf[end + 4:];
+                self._head(ex, head);
+            elif ex.state in ('body', 'chunk'):
+                data = self.inbuf[:ex.remaining];
+                self.inbuf = self.inbuf[len(data):];
+                ex.remaining -= len(data);
+                self._deliver(ex, data);
+                if ex.remaining == 0:
+                    if ex.state == 'body':
+                        self._complete(ex);
+                    else:
+                        ex.state = 'chunk_end';
+            elif ex.state == 'eof':
+                data = self.inbuf;
+                self.inbuf = '';
+                self._deliver(ex, data);
+            elif ex.state == 'chunk_end':
+                if len(self.inbuf) < 2:
+                    return;
+                self.inbuf = self.inbuf[2:];
+                ex.state = 'chunk_size';
+            else:
+                # 'chunk_size', or 'trailer' after the last chunk.
+                end = self.inbuf.find('\r\n');
+                if end < 0:
+                    return;
+
+                line = self.inbuf[:end];
+                self.inbuf = self.inbuf[end + 2:];
+                if ex.state == 'trailer':
+                    if line == '':
+                        self._complete(ex);
+                    continue;
+
+                size = int(line.split(';')[0].strip(), 16);
+                if size == 0:
+                    ex.state = 'trailer';
+                else:
+                    ex.state = 'chunk';
+                    ex.remaining = size;
+
+    def _head(self, ex, head):
+        lines = head.split('\r\n');
+        version, status = lines[0].split(None, 2)[:2];
+        status = int(status);
+        if 100 <= status < 200:
+            # Interim response, the real one follows.
+            return;
+
+        headers = [];
+        for line in lines[1:]:
+            if line[:1] in (' ', '\t') and len(headers):
+                name, value = headers[-1];
+                headers[-1] = (name, value + ' ' + line.strip());
+            elif ':' in line:
+                name, value = line.split(':', 1);
+                headers.append((name.strip().lower(), value.strip()));
+
+        ex.status = status;
+        ex.headers = headers;
+        hdrs = dict(headers);
+        Metrics.registry.observe('http_request_seconds', time.time() - ex.start,
+                                 host=self.host.netloc);
+        Metrics.registry.inc('http_responses_total', host=self.host.netloc, status=status);
+
+        connection = hdrs.get('connection', '').lower();
+        ex.will_close = connection == 'close' or \
+                        (version == 'HTTP/1.0' and connection != 'keep-alive');
+        ex.streaming = ex.sink != None and status in (200, 206);
+        ex.decoder = ConnectionPool.decoder(hdrs.get('content-encoding'));
+
+        if ex.method == 'HEAD' or status in (204, 304):
+            self._complete(ex);
+        elif 'chunked' in hdrs.get('transfer-encoding', '').lower():
+            ex.state = 'chunk_size';
+        elif hdrs.get('content-length') != None:
+            ex.state = 'body';
+            ex.remaining = int(hdrs['content-length']);
+            if ex.remaining == 0:
+                self._complete(ex);
+        else:
+            ex.state = 'eof';
+            ex.will_close = True;
+
+    def _deliver(self, ex, data):
+        if ex.decoder != None:
+            data = ex.decoder.decompress(data);
+        if ex.streaming:
+            ex.sink(data);
+        else:
+            ex.parts.append(data);
+
+    def _complete(self, ex):
+        if ex.decoder != None:
+            ex.decoder, decoder = None, ex.decoder;
+            self._deliver(ex, decoder.flush());
+
+        self.exchange = None;
+        if self.timer != None:
+            self.timer.cancel();
+            self.timer = None;
+
+        resp = ConnectionPool.Response(ex.url, ex.status, ex.headers, ''.join(ex.parts));
+        if ex.will_close or len(self.inbuf):
+            self._discard();
+        else:
+            self.host.release(self, True);
+
+        if not ex.future.done():
+            ex.future.setResult(resp);
+
+    def _eof(self):
+        ex = self.exchange;
+        if ex != None and ex.state == 'eof':
+            try:
+                self._complete(ex);
+            except zlib.error as e:
+                self._fail(e);
+            return;
+
+        if ex != None:
+            self._fail(socket.error(errno.ECONNRESET, 'Connection closed'));
+        elif not self.shut_down:
+            self._lost(socket.error(errno.ECONNRESET, 'Connection closed'));
+
+    def _fail(self, e):
+        ex = self.exchange;
+        if ex == None:
+            self._lost(e);
+            return;
+
+        self.exchange = None;
+        self._discard();
+        if ex.future.done():
+            return;
+
+        if self.reused and not ex.received:
+            ex.future.setException(StaleConnection());
+            return;
+
+        Metrics.registry.inc('http_errors_total', host=self.host.netloc);
+        ex.future.setException(DownloadError(DownloadError.ERR_FETCH, 'Could not retrieve ' +
+                                             ex.url + ': ' + str(e)));
+
+    def _lost(self, e):
+        '''
+        The connection failed with no request on it - while idle, or before the request it was
+        acquired for was sent (e.g. a failed TLS handshake), which then fails with the error.
+        '''
+
+        if self.error == None:
+            self.error = e;
+        if not self.shut_down:
+            self.shut();
+        self.host.dropped(self);
+
+    def _discard(self):
+        '''
+        Close the connection and give up its place with the host.
+        '''
+
+        if not self.shut_down:
+            self.shut();
+        if not self.given_back:
+            self.given_back = True;
+            self.host.release(self, False);
+
+    def shut(self):
+        '''
+        Close the socket, without telling the host.
+        '''
+
+        self.shut_down = True;
+        if self.timer != None:
+            self.timer.cancel();
+            self.timer = None;
+        self.close();
+
+
+class AsyncDownloader:
+    '''
+    Event loop counterpart of download_pdfs.PDFDownloader. Pages and files are fetched by
+    coroutines on a single loop, at most concurrency at once, and articles are handed out as
+    their pages are done (see articles) rather than once the whole tree is built.
+
+    The mode and the parsing of pages are those of a PDFDownloader, which does the parsing on the
+    loop thread. The response cache, file store, journal, index and snapshots are not used.
+    '''
+
+    def __init__(self, toc_url, use_mode, loop=None, pool=None, concurrency=dflt_concurrency):
+        '''
+        @param toc_url: String, table of contents URL.
+        @param use_mode: String, hash key to the journal settings.
+        @param loop: EventLoop to run on. Defaults to a new one.
+        @param pool: AsyncPool to make requests through. Defaults to a new one on the loop.
+        @param concurrency: int, the most pages and files fetched at once, and the most articles
+                    waiting to be taken from a stream.
+        '''
+
+        if loop == None:
+            loop = EventLoop();
+        if pool == None:
+            pool = AsyncPool(loop);
+
+        self.downloader = DownloadPDFs.PDFDownloader(toc_url, use_mode);
+        self.url = toc_url;
+        self.fmode = self.downloader.fmode;
+        self.loop = loop;
+        self.pool = pool;
+        self.concurrency = concurrency;
+        self.limit = Semaphore(loop, concurrency);
+        self.numbered = 0;      # Files named so far, to number the next.
+
+    def fetch(self, url):
+        '''
+        Coroutine - retrieves a page.
+
+        @param url: String, the absolute URL of the page.
+        @return: The body of the response, as a string of bytes.
+        @raise DownloadError: Raised if the page could not be retrieved.
+        '''
+
+        acquiring = self.limit.acquire();
+        try:
+            yield acquiring;
+        except CancelledError:
+            self.limit.giveBack(acquiring);
+            raise;
+
+        try:
+            resp = yield self.pool.request(url);
+        finally:
+            self.limit.release();
+
+        if resp.status != 200:
+            raise DownloadError(DownloadError.ERR_HTTP,
+                                'HTTP ' + str(resp.status) + ' retrieving ' + url);
+
+        raise Return(resp.body);
+
+    def crawlStep(self, branch):
+        '''
+        Coroutine - fetches and parses the page for a single branch, as a step of
+        PDFDownloader.parseStep does. A page that fails has the exception stored in the branch's
+        error property and no children.
+
+        @param branch: The download_pdfs.Branch to fetch the page for.
+        @return: Returns the list of child Branch items, in the order they appear on the page.
+        '''
+
+        step = str(branch.step);
+        try:
+            data = yield self.fetch(branch.url);
+            children = self.downloader.parsePage(branch, data);
+        except DownloadError as e:
+            Metrics.registry.inc('pages_total', step=step, result='error');
+            branch.error = e;
+            raise Return([]);
+
+        Metrics.registry.inc('pages_total', step=step, result='ok');
+        raise Return(children);
+
+    def articles(self, step=0, url=None, keep_tree=False):
+        '''
+        Start crawling, from the table of contents or any other page.
+
+        @param step: int, the step to start from (0-based index).
+        @param url: String, the URL of the page for that step. Defaults to the table of
+                    contents URL.
+        @param keep_tree: Boolean, if True each branch keeps its children, so the stream's root
+                    ends up holding the whole tree as from parseStep. Otherwise they are let go
+                    once the articles have been taken.
+        @return: Returns an ArticleStream.
+        '''
+
+        if url == None:
+            url = self.url;
+
+        return ArticleStream(self, DownloadPDFs.Branch(url, step), keep_tree);
+
+    def parseStep(self, step=0, url=None):
+        '''
+        Coroutine - crawls the whole tree, as PDFDownloader.parseStep does.
+
+        @return: Returns the root Branch item.
+        '''
+
+        stream = self.articles(step, url, True);
+        try:
+            while True:
+                branch = yield stream.next();
+                if branch == None:
+                    break;
+        finally:
+            stream.cancel();
+
+        raise Return(stream.root);
+
+    def download(self, url, dest, checksum=None):
+        '''
+        Coroutine - downloads a file to disk as it arrives, via dest + '.part', computing its
+        SHA-256 along the way.
+
+        @param url: String, the absolute URL of the file.
+        @param dest: String, where to save the file.
+        @param checksum: String, the expected SHA-256 hex digest, if known.
+        @return: Returns a download_pdfs.DownloadedFile item.
+        @raise DownloadError: Raised if the file could not be retrieved, or with ERR_INTEGRITY if
+                    it doesn't match the checksum.
+        '''
+
+        acquiring = self.limit.acquire();
+        try:
+            yield acquiring;
+        except CancelledError:
+            self.limit.giveBack(acquiring);
+            raise;
+
+        start = time.time();
+        part = dest + '.part';
+        digest = hashlib.sha256();
+        size = [0];
+        done = False;
+        try:
+            f = open(part, 'wb');
+            try:
+                def sink(chunk):
+                    f.write(chunk);
+                    digest.update(chunk);
+                    size[0] += len(chunk);
+
+                # A body with an encoding would be decoded anyway, but ask for the file as it is.
+                resp = yield self.pool.request(url, {'Accept-Encoding' : 'identity'}, sink=sink);
+            finally:
+                f.close();
+
+            if resp.status != 200:
+                raise DownloadError(DownloadError.ERR_HTTP,
+                                    'HTTP ' + str(resp.status) + ' retrieving ' + url);
+
+            digest = digest.hexdigest();
+            if checksum != None and checksum.lower() != digest:
+                raise DownloadError(DownloadError.ERR_INTEGRITY,
+                                    'Checksum mismatch for ' + url + ': ' + digest);
+
+            if path.exists(dest) and os.name == 'nt':
+                os.remove(dest);
+            os.rename(part, dest);
+            done = True;
+        finally:
+            self.limit.release();
+            if not done and path.exists(part):
+                os.remove(part);
+
+        Metrics.registry.observe('download_seconds', time.time() - start);
+        Metrics.registry.inc('downloads_total', result='ok');
+        raise Return(DownloadPDFs.DownloadedFile(url, dest, size[0], digest));
+
+    def downloadFiles(self, branch, location):
+        '''
+        Coroutine - downloads an article's PDF and supplementary PDFs at once, into its files
+        property, as PDFDownloader.downloadPDFs does. Files are numbered in the order articles
+        are given to this. A file that fails is left as None, with the first exception stored
+        in the branch's error property.
+
+        @param branch: The article's Branch item.
+        @param location: String, the directory to save the files in.
+        @return: Returns the list of DownloadedFile items for the files downloaded.
+        '''
+
+        if location and not path.isdir(location):
+            os.makedirs(location);
+
+        urls = [];
+        if branch.getField('pdf') != None:
+            urls.append(branch.getField('pdf'));
+        urls += branch.getField('supp_pdf', []);
+
+        branch.files = [None]*len(urls);
+        tasks = [];
+        for i, url in enumerate(urls):
+            url = urlparse.urljoin(branch.url, url);
+            fname = str(self.numbered).zfill(4) + '_' + DownloadPDFs.fileName(url);
+            self.numbered += 1;
+            tasks.append(self._downloadTask(branch, i, url, path.join(location, fname)));
+
+        yield gather(self.loop, tasks);
+        raise Return([f for f in branch.files if f != None]);
+
+    def _downloadTask(self, branch, i, url, dest):
+        try:
+            branch.files[i] = yield self.download(url, dest);
+        except (DownloadError, IOError, OSError) as e:
+            Metrics.registry.inc('downloads_total', result='error');
+            if branch.error == None:
+                branch.error = e;
+
+    def downloadIssue(self, location, step=0, url=None):
+        '''
+        Coroutine - crawls the issue and downloads each article's files as soon as its page is
+        done. At most concurrency articles are downloading at once, which holds back the crawl.
+
+        @param location: String, the directory to save the files in.
+        @return: Returns the list of DownloadedFile items, in the order they finished.
+        '''
+
+        stream = self.articles(step, url);
+        slots = Semaphore(self.loop, self.concurrency);
+        files = [];
+        tasks = set();
+
+        def finished(task):
+            tasks.discard(task);
+            slots.release();
+            if not task.cancelled() and task.exc_info == None:
+                files.extend(task.value);
+
+        try:
+            while True:
+                yield slots.acquire();
+                branch = yield stream.next();
+                if branch == None:
+                    break;
+
+                task = self.loop.createTask(self.downloadFiles(branch, location));
+                tasks.add(task);
+                task.addDoneCallback(finished);
+
+            yield gather(self.loop, list(tasks));
+        finally:
+            stream.cancel();
+            for task in list(tasks):
+                task.cancel();
+
+        raise Return(files);
+
+
+class ArticleStream:
+    '''
+    Asynchronous iterator over the articles of a crawl, in the order their pages are done:
+
+        while True:
+            branch = yield stream.next();
+            if branch == None:
+                break;
+
+    Pages are crawled depth first, so the branches waiting to be crawled are only those linked
+    from the pages done so far. At most concurrency pages are being crawled, and articles not yet
+    taken count against that, so an idle consumer stops the crawl rather than letting articles
+    pile up. Articles whose page failed are handed out too, with their error set.
+    '''
+
+    def __init__(self, downloader, root, keep_tree=False):
+        '''
+        Start the crawl. See AsyncDownloader.articles.
+        '''
+
+        self.downloader = downloader;
+        self.loop = downloader.loop;
+        self.root = root;
+        self.keep_tree = keep_tree;
+        self.queue = Queue(self.loop, downloader.concurrency);
+        self.pending = [root];      # Stack of branches to crawl.
+        self.active = set();        # Tasks crawling branches.
+        self.changed = None;        # Future resolved when one of them finishes.
+        self.finished = False;      # Whether next() has returned None.
+        self.task = self.loop.createTask(self._run());
+
+    def next(self):
+        '''
+        @return: Returns a Future for the next article's Branch, or for None once they have all
+                been returned (or the stream was cancelled).
+        '''
+
+        if self.finished:
+            future = Future(self.loop);
+            future.setResult(None);
+            return future;
+
+        future = self.queue.get();
+        future.addDoneCallback(self._checkEnd);
+        return future;
+
+    def _checkEnd(self, future):
+        if not future.cancelled() and future.value == None:
+            self.finished = True;
+
+    def cancel(self):
+        '''
+        Stop crawling, cancelling the pages in progress. Once the articles already found have
+        been taken, next() returns None.
+        '''
+        self.task.cancel();
+
+    def _run(self):
+        last = self.downloader.fmode.nsteps - 1;
+        try:
+            while len(self.pending) or len(self.active):
+                if len(self.pending) == 0 or len(self.active) >= self.downloader.concurrency:
+                    self.changed = Future(self.loop);
+                    yield self.changed;
+                    continue;
+
+                branch = self.pending.pop();
+                task = self.loop.createTask(self._crawl(branch, last));
+                self.active.add(task);
+                task.addDoneCallback(self._crawled);
+        finally:
+            for task in list(self.active):
+                task.cancel();
+            self.queue.close();
+
+    def _crawled(self, task):
+        self.active.discard(task);
+        self._wake();
+
+    def _wake(self):
+        if self.changed != None and not self.changed.done():
+            self.changed.setResult(None);
+
+    def _crawl(self, branch, last):
+        children = yield self.downloader.crawlStep(branch);
+        if not self.keep_tree:
+            branch.children = [];
+
+        # Reversed onto the stack, so they come off it in page order.
+        self.pending.extend(reversed([c for c in children if c.step <= last]));
+        self._wake();
+        if branch.step == last:
+            yield self.queue.put(branch);
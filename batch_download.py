@@ -0,0 +1,471 @@
+"""
+Library for crawling many issues, from any number of journals, in a single run. Requests for all
+the issues are interleaved across hosts by a HostScheduler, which keeps every worker busy while
+a token bucket per host stops any one publisher from being sent more than its share.
+
+@author: SquidneyPoitier <squidney.poitier@gmail.com>
+@version: 0.1
+"""
+
+import download_pdfs as DownloadPDFs;
+import connection_pool as ConnectionPool;
+import metrics as Metrics;
+from collections import deque;
+from os import path;
+import threading;
+import time;
+import urlparse;
+
+dflt_rate = 2.0;        # Requests per second to a single host.
+dflt_burst = 4;         # Requests a host can be sent at once after being left idle.
+dflt_revalidation_cost = 0.25;  # Tokens taken by a conditional request (see RateLimiter).
+
+class TokenBucket:
+    '''
+    Token bucket rate limiter. Tokens are added at a fixed rate up to the burst size, and each
+    request takes one. Not thread-safe on its own - RateLimiter only uses it under its lock.
+    '''
+
+    def __init__(self, rate=dflt_rate, burst=dflt_burst, now=None):
+        '''
+        @param rate: Number of tokens added per second.
+        @param burst: The most tokens the bucket holds. It starts full.
+        @param now: The current time, from time.time(), if already known.
+        '''
+
+        if now == None:
+            now = time.time();
+
+        self.rate = float(rate);
+        self.burst = float(burst);
+        self.tokens = self.burst;
+        self.last = now;
+
+    def refill(self, now):
+        if now > self.last:
+            self.tokens = min(self.burst, self.tokens + (now - self.last)*self.rate);
+            self.last = now;
+
+    def wait(self, now, cost=1):
+        '''
+        @param now: The current time.
+        @param cost: Number of tokens wanted.
+        @return: Returns the number of seconds until they are available, 0 if they are now.
+        '''
+
+        self.refill(now);
+        if self.tokens >= cost:
+            return 0;
+
+        return (cost - self.tokens)/self.rate;
+
+    def take(self, now, cost=1):
+        '''
+        Take tokens if they are available.
+
+        @param now: The current time.
+        @param cost: Number of tokens to take.
+        @return: Returns True if they were taken.
+        '''
+
+        if self.wait(now, cost) > 0:
+            return False;
+
+        self.tokens -= cost;
+        return True;
+
+    def refund(self, tokens):
+        self.tokens = min(self.burst, self.tokens + tokens);
+
+
+class RateLimiter:
+    '''
+    Thread-safe set of token buckets, one per host, charged for every request made to the host.
+    A ConnectionPool given one calls acquire() before each request it sends - including each
+    redirect, to the host redirected to, and each attempt at resuming a download.
+
+    A HostScheduler using the same limiter takes a host's token when it starts a task, and hands
+    it to the task's thread as a reservation, which the task's first request to that host uses
+    instead of taking another. A reservation that isn't used is given back when the task ends.
+    '''
+
+    def __init__(self, rate=dflt_rate, burst=dflt_burst, host_limits=None,
+                 revalidation_cost=dflt_revalidation_cost):
+        '''
+        @param rate: Number of requests per second to a host, for hosts not in host_limits.
+        @param burst: int, the burst size for hosts not in host_limits.
+        @param host_limits: Dictionary mapping netlocs to (rate, burst) tuples.
+        @param revalidation_cost: Number of tokens a conditional request takes, e.g. one 
+                    revalidating a page in the ResponseCache, which is answered by a 304 without
+                    a body when the page hasn't changed.
+        '''
+
+        self.rate = rate;
+        self.burst = burst;
+        self.host_limits = dict(host_limits or {});
+        self.revalidation_cost = revalidation_cost;
+
+        self.lock = threading.Lock();
+        self.buckets = {};
+        self.local = threading.local();
+
+    def bucket(self, host, now):
+        '''
+        Called with the lock held.
+        '''
+
+        if host not in self.buckets:
+            rate, burst = self.host_limits.get(host, (self.rate, self.burst));
+            self.buckets[host] = TokenBucket(rate, burst, now);
+
+        return self.buckets[host];
+
+    def take(self, host, now):
+        '''
+        Take a token for a host if one is available.
+
+        @return: Returns 0 if the token was taken, otherwise the number of seconds until one
+                will be available.
+        '''
+
+        with self.lock:
+            bucket = self.bucket(host, now);
+            if bucket.take(now):
+                return 0;
+            return bucket.wait(now);
+
+    def acquire(self, host, conditional=False):
+        '''
+        Charge a request to a host, waiting until the host has the tokens for it.
+
+        @param host: String, the netloc the request is sent to.
+        @param conditional: Boolean, True for a conditional request (see revalidation_cost).
+        '''
+
+        cost = self.revalidation_cost if conditional else 1;
+        if getattr(self.local, 'reserved', None) == host:
+            self.local.reserved = None;
+            if cost < 1:
+                with self.lock:
+                    self.bucket(host, time.time()).refund(1 - cost);
+            return;
+
+        while True:
+            with self.lock:
+                now = time.time();
+                bucket = self.bucket(host, now);
+                if bucket.take(now, cost):
+                    return;
+                delay = bucket.wait(now, cost);
+            time.sleep(delay);
+
+    def reserve(self, host):
+        '''
+        Hand a token already taken for host to the calling thread's next request to it.
+        '''
+        self.local.reserved = host;
+
+    def unreserve(self):
+        '''
+        Give back the calling thread's reservation, if it wasn't used.
+        '''
+
+        host = getattr(self.local, 'reserved', None);
+        self.local.reserved = None;
+        if host != None:
+            with self.lock:
+                self.bucket(host, time.time()).refund(1);
+
+
+class HostScheduler:
+    '''
+    A pool of worker threads, used in place of download_pdfs.CrawlPool, which keeps a queue of
+    tasks per host. Each free worker takes the next task from the next host in turn whose token
+    bucket has a token, so that no host is sent requests faster than its rate and workers never
+    sit waiting on one host while another has work ready.
+
+    Without a limiter, a task takes one token from the host of the URL it was submitted for,
+    however many requests it makes. With a RateLimiter shared with the ConnectionPool the tasks
+    make their requests through, every request is charged to the host it is actually sent to.
+
+    Tasks within a host are run in the order they were submitted.
+    '''
+
+    def __init__(self, workers=DownloadPDFs.dflt_workers, rate=dflt_rate, burst=dflt_burst,
+                 host_limits=None, controller=None, limiter=None):
+        '''
+        Starts the worker threads.
+
+        @param workers: int, the number of threads.
+        @param rate: Number of requests per second to a host, for hosts not in host_limits.
+        @param burst: int, the burst size for hosts not in host_limits.
+        @param host_limits: Dictionary mapping netlocs to (rate, burst) tuples.
+        @param controller: adaptive_limits.AIMDController, or None. If given, a host's tasks are
+                    only started while fewer than its current limit are running, so workers are
+                    not tied up waiting for connections to a host that has been throttled.
+        @param limiter: RateLimiter which the tasks' ConnectionPool charges each request to, or
+                    None. If given, its rates are used rather than rate, burst and host_limits.
+        '''
+
+        self.controller = controller;
+        self.per_request = limiter != None;
+        if limiter == None:
+            limiter = RateLimiter(rate, burst, host_limits);
+        self.limiter = limiter;
+        self.running = {};          # host -> number of tasks running
+
+        self.cond = threading.Condition();
+        self.queues = {};           # host -> deque of tasks
+        self.ready = deque();       # hosts with queued tasks, in turn order
+        self.pending = 0;           # Tasks submitted and not yet finished.
+        self.closing = False;
+        self.errors = [];
+        self.dispatched = {};       # host -> number of tasks started
+
+        self.threads = [];
+        for i in range(max(1, workers)):
+            thread = threading.Thread(target=self._work);
+            thread.daemon = True;
+            thread.start();
+            self.threads.append(thread);
+
+    def submitFor(self, url, func, *args):
+        '''
+        Queue func(*args), a task which makes a request to url, behind the other tasks for the
+        same host.
+        '''
+
+        host = urlparse.urlsplit(url).netloc;
+        with self.cond:
+            if host not in self.queues:
+                queue = self.queues[host] = deque();
+                Metrics.registry.set('scheduler_queue_depth', queue.__len__, host=host);
+                Metrics.registry.set('scheduler_running', 
+                                     lambda host=host: self.running.get(host, 0), host=host);
+            if len(self.queues[host]) == 0:
+                self.ready.append(host);
+
+            self.queues[host].append((func, args));
+            self.pending += 1;
+            self.cond.notify();
+
+    def submit(self, func, *args):
+        '''
+        Queue a task which doesn't make a request. It is run as soon as a worker is free.
+        '''
+        self.submitFor('', func, *args);
+
+    def join(self):
+        '''
+        Wait for all the queued tasks, including those submitted along the way, to finish.
+        '''
+
+        with self.cond:
+            while self.pending:
+                self.cond.wait(1);
+
+    def close(self):
+        '''
+        Stop the workers once the queued tasks have finished.
+        '''
+
+        self.join();
+        with self.cond:
+            self.closing = True;
+            self.cond.notify_all();
+
+        for thread in self.threads:
+            thread.join();
+
+        self.threads = [];
+        for host in self.queues:
+            Metrics.registry.remove('scheduler_queue_depth', host=host);
+            Metrics.registry.remove('scheduler_running', host=host);
+
+    def stats(self):
+        '''
+        @return: Returns a dictionary keyed by host, with the number of tasks 'started' and still
+                'queued' for each.
+        '''
+
+        with self.cond:
+            out = {};
+            for host, queue in self.queues.items():
+                out[host] = {'started' : self.dispatched.get(host, 0), 'queued' : len(queue)};
+
+            return out;
+
+    def _next(self):
+        '''
+        Take the next runnable task, waiting if there isn't one. Called with the lock held.
+
+        @return: Returns the task, or None if the scheduler is closing.
+        '''
+
+        while True:
+            if self.closing:
+                return None;
+
+            now = time.time();
+            delay = None;
+            for i in range(len(self.ready)):
+                host = self.ready[0];
+                self.ready.rotate(-1);
+
+                # Tasks which don't make a request (host '') are never limited.
+                wait = 0;
+                if host != '':
+                    if self.controller != None and \
+                        self.running.get(host, 0) >= self.controller.limit(host):
+                        # Woken again when one of its tasks finishes.
+                        continue;
+                    wait = self.limiter.take(host, now);
+                    
+                if wait == 0:
+                    queue = self.queues[host];
+                    func, args = queue.popleft();
+                    if len(queue) == 0:
+                        self.ready.remove(host);
+                    self.dispatched[host] = self.dispatched.get(host, 0) + 1;
+                    self.running[host] = self.running.get(host, 0) + 1;
+                    return (host, func, args);
+
+                if delay == None or wait < delay:
+                    delay = wait;
+
+            # Nothing can run yet - sleep until the first token is due, or a task is submitted.
+            self.cond.wait(delay);
+
+    def _work(self):
+        while True:
+            with self.cond:
+                task = self._next();
+            if task == None:
+                return;
+
+            host, func, args = task;
+            if self.per_request and host != '':
+                self.limiter.reserve(host);
+            try:
+                func(*args);
+            except Exception as e:
+                # Tasks are expected to handle their own errors, but a worker should never die.
+                with self.cond:
+                    self.errors.append(e);
+            finally:
+                if self.per_request:
+                    self.limiter.unreserve();
+                with self.cond:
+                    self.pending -= 1;
+                    self.running[host] -= 1;
+                    self.cond.notify_all();
+
+
+class BatchDownloader:
+    '''
+    Crawls a batch of issues together on one HostScheduler and one connection pool.
+    '''
+
+    def __init__(self, workers=DownloadPDFs.dflt_workers, rate=dflt_rate, burst=dflt_burst,
+                 host_limits=None, pool=None, cache=None, streaming=False, controller=None,
+                 store=None, parse_pool=None, journal=None, index=None, snapshots=None):
+        '''
+        @param workers: int, the number of threads shared by all the issues.
+        @param rate: Number of requests per second to a host, for hosts not in host_limits.
+        @param burst: int, the burst size for hosts not in host_limits.
+        @param host_limits: Dictionary mapping netlocs to (rate, burst) tuples.
+        @param pool: ConnectionPool to make requests through. Defaults to a new pool which 
+                    charges every request to the batch's RateLimiter, and reports to the 
+                    controller if there is one. A pool given here is only rate limited per 
+                    request if it was made with a limiter; otherwise each task is charged one
+                    request (see HostScheduler).
+        @param cache: ResponseCache, or None.
+        @param streaming: Boolean, passed on to each PDFDownloader.
+        @param controller: adaptive_limits.AIMDController adjusting the concurrency for each 
+                    host, or None for fixed limits.
+        @param store: file_store.FileStore shared by all the issues, or None.
+        @param parse_pool: download_pdfs.ParsePool shared by all the issues, or None.
+        @param journal: crawl_journal.CrawlJournal shared by all the issues, or None. With a
+                    journal, running a batch again resumes each issue where it got to.
+        @param index: article_index.ArticleIndex shared by all the issues, or None.
+        @param snapshots: toc_refresh.TOCSnapshots shared by all the issues, or None. With
+                    snapshots, running a batch again only fetches the articles which are new or
+                    have changed in each issue, so polling it costs little more than a fetch of
+                    each table of contents.
+        '''
+
+        self.workers = workers;
+        self.rate = rate;
+        self.burst = burst;
+        self.host_limits = host_limits;
+        self.controller = controller;
+        if pool == None:
+            self.limiter = RateLimiter(rate, burst, host_limits);
+            pool = ConnectionPool.ConnectionPool(controller=controller, limiter=self.limiter);
+        else:
+            self.limiter = pool.limiter;
+        self.pool = pool;
+        self.cache = cache;
+        self.streaming = streaming;
+        self.store = store;
+        self.parse_pool = parse_pool;
+        self.journal = journal;
+        self.index = index;
+        self.snapshots = snapshots;
+
+        self.issues = [];
+        self.errors = [];   # Exceptions raised by tasks of the last run (see run).
+
+    def add(self, toc_url, use_mode):
+        '''
+        Add an issue to the batch.
+
+        @param toc_url: String, table of contents URL.
+        @param use_mode: String, hash key to the journal settings.
+        @return: Returns the PDFDownloader for the issue.
+        '''
+
+        downloader = DownloadPDFs.PDFDownloader(toc_url, use_mode, self.workers, self.pool,
+                                                self.cache, self.streaming, self.store,
+                                                self.parse_pool, self.journal, self.index,
+                                                self.snapshots);
+        self.issues.append(downloader);
+        return downloader;
+
+    def run(self, location=None):
+        '''
+        Crawl all the issues added so far and, if a location is given, download their PDFs.
+
+        @param location: String, a directory to download the PDFs to, in a subdirectory per issue
+                    (numbered in the order they were added). Pass None to only crawl.
+        @return: Returns a list of (PDFDownloader, root Branch) tuples, in the order the issues
+                were added. When refreshing, each PDFDownloader's report says what changed.
+                Pages and files which failed have the error in their branch's error property,
+                and anything else a task raised is left in errors.
+        '''
+
+        scheduler = HostScheduler(self.workers, self.rate, self.burst, self.host_limits,
+                                  self.controller, self.limiter);
+        try:
+            roots = [];
+            for downloader in self.issues:
+                roots.append(downloader.startCrawl(scheduler));
+            scheduler.join();
+            for downloader, root in zip(self.issues, roots):
+                downloader.finishCrawl(root);
+
+            if location != None:
+                queued = [];
+                for i, (downloader, root) in enumerate(zip(self.issues, roots)):
+                    issue_loc = path.join(location, str(i).zfill(4));
+                    jobs = downloader.queueDownloads(scheduler, root, issue_loc);
+                    queued.append((downloader, jobs, issue_loc));
+                scheduler.join();
+
+                for downloader, jobs, issue_loc in queued:
+                    downloader.finishDownloads(jobs, issue_loc);
+        finally:
+            scheduler.close();
+            self.errors = list(scheduler.errors);
+
+        return zip(self.issues, roots);
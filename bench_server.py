@@ -0,0 +1,434 @@
+"""
+A local stand-in for a publisher's web site, for benchmarking. The pages are generated from a
+mode's locations - every field the mode looks for is put where the mode will look for it - so
+the markup follows the mode (e.g. modes/Nature.xml) rather than a copy of the real site.
+
+Table of contents:  /toc
+Articles:           /art/<i>
+PDFs:               /pdf/<i>.pdf and /supp/<i>-<j>.pdf
+
+@author: SquidneyPoitier <squidney.poitier@gmail.com>
+@version: 0.1
+"""
+
+import settings_manager as SettingsManager;
+import pdf_file as PDFFile;
+from pdf_file import Name, Ref, Stream;
+from cgi import escape;
+from cStringIO import StringIO;
+import BaseHTTPServer;
+import SocketServer;
+import hashlib;
+import random;
+import socket;
+import threading;
+import time;
+
+dflt_articles = 50;
+dflt_authors = 4;           # Authors per article.
+dflt_supp = 2;              # Supplementary files per article.
+dflt_page_size = 32*1024;   # Approximate size of each HTML page, in bytes.
+dflt_pdf_pages = 4;
+dflt_pdf_size = 256*1024;   # Approximate size of each PDF, in bytes.
+dflt_latency = 0.0;         # Seconds added before every response.
+dflt_error_rate = 0.0;      # Fraction of article pages and PDFs answered with a 503.
+
+filler = ('Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor '
+          'incididunt ut labore et dolore magna aliqua. ');
+
+class SyntheticPublisher:
+    '''
+    Generates the pages and PDFs of a single issue.
+    '''
+
+    def __init__(self, fmode, articles=dflt_articles, authors=dflt_authors, supp=dflt_supp,
+                 page_size=dflt_page_size, pdf_pages=dflt_pdf_pages, pdf_size=dflt_pdf_size,
+                 error_rate=dflt_error_rate, seed=0):
+        '''
+        @param fmode: The fetchMode the pages are made for. It must have two steps: a table of
+                    contents linking to article pages.
+        @param articles: int, the number of articles in the issue.
+        @param authors: int, authors per article.
+        @param supp: int, supplementary files per article.
+        @param page_size: int, approximate size of each page, padded out with paragraphs.
+        @param pdf_pages: int, pages per PDF.
+        @param pdf_size: int, approximate size of each PDF.
+        @param error_rate: Fraction (0 to 1) of article pages and PDFs which fail with a 503.
+                    Which ones fail is fixed by the seed.
+        @param seed: int, seed for choosing the failures.
+        '''
+
+        self.fmode = fmode;
+        self.articles = articles;
+        self.authors = authors;
+        self.supp = supp;
+        self.page_size = page_size;
+        self.pdf_pages = pdf_pages;
+        self.pdf_size = pdf_size;
+        self.error_rate = error_rate;
+        self.seed = seed;
+
+        self.pages = {};
+        self.lock = threading.Lock();
+
+    def fails(self, path):
+        '''
+        @return: Returns True if the request for a path should fail.
+        '''
+
+        if self.error_rate <= 0 or path == '/toc':
+            return False;
+
+        h = hashlib.sha1(str(self.seed) + path).digest();
+        return random.Random(h).random() < self.error_rate;
+
+    def get(self, path):
+        '''
+        @param path: String, the request path.
+        @return: Returns a tuple of (content type, body), or None if there is no such page.
+        '''
+
+        with self.lock:
+            if path in self.pages:
+                return self.pages[path];
+
+        try:
+            if path == '/toc':
+                page = ('text/html', self.tocPage());
+            elif path.startswith('/art/'):
+                page = ('text/html', self.articlePage(self.number(path[5:])));
+            elif path.startswith('/pdf/') and path.endswith('.pdf'):
+                page = ('application/pdf', self.pdf(path, self.number(path[5:-4])));
+            elif path.startswith('/supp/') and path.endswith('.pdf'):
+                i, j = path[6:-4].split('-');
+                page = ('application/pdf', self.pdf(path, self.number(i), self.number(j)));
+            else:
+                return None;
+        except ValueError:
+            return None;
+
+        with self.lock:
+            self.pages[path] = page;
+
+        return page;
+
+    def number(self, s):
+        i = int(s);
+        if i < 0 or i >= self.articles:
+            raise ValueError(s);
+        return i;
+
+    def value(self, name, i, j=0):
+        '''
+        The value of a field for article i (and the j-th of a list field).
+        '''
+
+        if name == 'link':
+            return '/art/' + str(i);
+        elif name == 'pdf':
+            return '/pdf/' + str(i) + '.pdf';
+        elif name == 'supp_pdf':
+            return '/supp/' + str(i) + '-' + str(j) + '.pdf';
+        elif name == 'authors':
+            return 'Author ' + str(i) + '-' + str(j);
+        elif name == 'title':
+            return 'Synthetic article ' + str(i);
+        elif name == 'journal':
+            return 'Nature';
+        elif name == 'volume':
+            return '500';
+        elif name == 'issue':
+            return '7460';
+        elif name == 'year':
+            return '2013';
+        elif name == 'pages':
+            return str(10*i + 1) + '-' + str(10*i + 9);
+        elif name == 'doi':
+            return '10.1038/bench' + str(i);
+
+        return name + ' ' + str(i) + '-' + str(j);
+
+    def count(self, name):
+        if name == 'authors':
+            return self.authors;
+        elif name.startswith('supp_'):
+            return self.supp;
+        return 1;
+
+    def tocPage(self):
+        fmode = self.fmode;
+        link = fmode.links[0];
+        root = link.tags[0].predicate();
+
+        page = Node(None);
+        for i in range(self.articles):
+            item = page.add(link.tags[0], True);
+            item.insert(link.tags[1:], self.value('link', i));
+            for name, loc in fmode.fields[0]:
+                if loc.tags[0].predicate() == root:
+                    target, tags = item, loc.tags[1:];
+                else:
+                    target, tags = page, loc.tags;
+                count = self.count(name);
+                for j in range(count):
+                    target.insert(tags, self.value(name, i, j), count > 1);
+
+        return self.html(page);
+
+    def articlePage(self, i):
+        page = Node(None);
+        for name, loc in self.fmode.fields[1]:
+            count = self.count(name);
+            for j in range(count):
+                page.insert(loc.tags, self.value(name, i, j), count > 1);
+
+        return self.html(page);
+
+    def html(self, page):
+        out = StringIO();
+        out.write('<!DOCTYPE html>\n<html><head><title>Synthetic issue</title></head><body>\n');
+        page.render(out);
+
+        # Pad with text the mode doesn't look at, as on a real page.
+        while out.tell() < self.page_size:
+            out.write('<p class="filler">' + filler*8 + '</p>\n');
+
+        out.write('</body></html>\n');
+        return out.getvalue();
+
+    def pdf(self, path, i, j=None):
+        '''
+        A PDF of self.pdf_pages pages, its content different for each path.
+        '''
+
+        out = StringIO();
+        writer = PDFFile.PDFWriter(out, '1.4');
+        catalog = writer.allocate();
+        pages_root = writer.allocate();
+        font = writer.allocate();
+        writer.writeObject(font, {Name('Type') : Name('Font'), Name('Subtype') : Name('Type1'),
+                                  Name('BaseFont') : Name('Helvetica')});
+
+        per_page = max(1, self.pdf_size//self.pdf_pages//(len(path) + 30));
+        kids = [];
+        for p in range(self.pdf_pages):
+            lines = ['BT /F1 9 Tf 40 800 Td 11 TL'];
+            for n in range(per_page):
+                lines.append('(' + path + ' page ' + str(p) + ' line ' + str(n) + ') \'');
+            lines.append('ET');
+            content = '\n'.join(lines);
+
+            num = writer.allocate();
+            writer.writeObject(num, Stream({}, data=content));
+            page = writer.allocate();
+            writer.writeObject(page, {
+                                      Name('Type') : Name('Page'),
+                                      Name('Parent') : Ref(pages_root),
+                                      Name('MediaBox') : [0, 0, 595, 842],
+                                      Name('Contents') : Ref(num),
+                                      Name('Resources') : {Name('Font') : {Name('F1') : Ref(font)}}
+                                      });
+            kids.append(Ref(page));
+
+        writer.writeObject(pages_root, {Name('Type') : Name('Pages'), Name('Kids') : kids,
+                                        Name('Count') : len(kids)});
+        writer.writeObject(catalog, {Name('Type') : Name('Catalog'),
+                                     Name('Pages') : Ref(pages_root)});
+        writer.finish({Name('Root') : Ref(catalog)});
+        return out.getvalue();
+
+
+class Node:
+    '''
+    An element of a generated page. Locations sharing their first tags share elements, as they
+    would on a real page (e.g. the 'dl' holding every citation field).
+    '''
+
+    def __init__(self, tag):
+        self.tag = tag;
+        self.attrs = [];
+        self.text = None;
+        self.children = [];
+
+    def add(self, tag, new=False):
+        '''
+        The child element for a tag, reusing an existing one unless new is True.
+        '''
+
+        if not new:
+            key = tag.predicate();
+            for child in self.children:
+                if child.tag.predicate() == key:
+                    return child;
+
+        child = Node(tag);
+        self.children.append(child);
+        return child;
+
+    def insert(self, tags, value, repeat=False):
+        '''
+        Add the elements for a location, putting the value in the last one (in the attribute it
+        is read from, or as its text).
+
+        @param repeat: Boolean, True to always add a new last element, so that each value of a
+                    list field gets its own.
+        '''
+
+        node = self;
+        for n, tag in enumerate(tags):
+            last = (n == len(tags) - 1);
+            node = node.add(tag, last and repeat);
+
+        if tags[-1].use_at():
+            node.attrs.append((tags[-1].get_at(), value));
+        else:
+            node.text = value;
+
+    def render(self, out):
+        if self.tag == None:
+            for child in self.children:
+                child.render(out);
+            return;
+
+        tag = self.tag;
+        attrs = '';
+        if tag.has_id():
+            attrs += ' id="' + escape(tag.get_id(), True) + '"';
+        if tag.has_class():
+            attrs += ' class="' + escape(tag.get_class(), True) + '"';
+
+        for name, value in self.attrs:
+            attrs += ' ' + name + '="' + escape(value, True) + '"';
+
+        out.write('<' + tag.name + attrs + '>' + escape(self.text or ''));
+        for child in self.children:
+            child.render(out);
+        out.write('</' + tag.name + '>\n');
+
+
+class BenchServer:
+    '''
+    Serves a SyntheticPublisher on a local port, in a background thread.
+    '''
+
+    def __init__(self, publisher, latency=dflt_latency, port=0):
+        '''
+        Starts the server.
+
+        @param publisher: The SyntheticPublisher.
+        @param latency: Seconds to wait before every response.
+        @param port: int, the port, 0 for any free one.
+        '''
+
+        self.publisher = publisher;
+        self.latency = latency;
+        self.requests = 0;
+
+        self.server = ThreadingServer(('127.0.0.1', port), RequestHandler);
+        self.server.bench = self;
+        self.port = self.server.server_address[1];
+        self.url = 'http://127.0.0.1:' + str(self.port);
+
+        self.thread = threading.Thread(target=self.server.serve_forever);
+        self.thread.daemon = True;
+        self.thread.start();
+
+    def close(self):
+        '''
+        Stop the server, and close the connections kept open by clients.
+        '''
+
+        self.server.shutdown();
+        self.server.server_close();
+        self.server.closeConnections();
+
+    def __enter__(self):
+        return self;
+
+    def __exit__(self, *args):
+        self.close();
+
+
+class ThreadingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True;
+    allow_reuse_address = True;
+    request_queue_size = 128;
+
+    def __init__(self, address, handler):
+        BaseHTTPServer.HTTPServer.__init__(self, address, handler);
+        self.lock = threading.Lock();
+        self.connections = set();
+
+    def process_request_thread(self, request, client_address):
+        with self.lock:
+            self.connections.add(request);
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(self, request, client_address);
+        finally:
+            with self.lock:
+                self.connections.discard(request);
+
+    def closeConnections(self):
+        with self.lock:
+            connections = list(self.connections);
+
+        for conn in connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR);
+            except socket.error:
+                pass;
+
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1';
+    wbufsize = 64*1024;
+    disable_nagle_algorithm = True;
+
+    def log_message(self, *args):
+        pass;
+
+    def do_GET(self):
+        bench = self.server.bench;
+        bench.requests += 1;
+        if bench.latency > 0:
+            time.sleep(bench.latency);
+
+        path = self.path.split('?')[0];
+        page = None;
+        if bench.publisher.fails(path):
+            status = 503;
+        else:
+            page = bench.publisher.get(path);
+            status = 200 if page != None else 404;
+
+        if page == None:
+            self.send_response(status);
+            self.send_header('Content-Length', '0');
+            self.end_headers();
+            return;
+
+        ctype, body = page;
+        self.send_response(200);
+        self.send_header('Content-Type', ctype);
+        self.send_header('Content-Length', str(len(body)));
+        self.end_headers();
+        self.wfile.write(body);
+        self.wfile.flush();
+
+
+def serve(use_mode='Nature', port=8000, latency=dflt_latency, **kwargs):
+    '''
+    Serve a synthetic issue until interrupted, for trying things by hand.
+    '''
+
+    fmode = SettingsManager.SettingsReader().getMode(use_mode);
+    server = BenchServer(SyntheticPublisher(fmode, **kwargs), latency, port);
+    print('Serving ' + use_mode + ' issue at ' + server.url + '/toc');
+    try:
+        while True:
+            time.sleep(1);
+    except KeyboardInterrupt:
+        server.close();
+
+if __name__ == '__main__':
+    serve();
@@ -0,0 +1,321 @@
+"""
+Benchmarks for mode loading, page extraction, crawling and PDF merging, run against a synthetic
+issue served locally (see bench_server), so the numbers can be reproduced offline.
+
+Results can be saved as a JSON baseline, and later runs compared against it to catch
+regressions.
+
+Usage: python benchmark.py [options]            (see --help)
+
+@author: SquidneyPoitier <squidney.poitier@gmail.com>
+@version: 0.1
+"""
+
+import settings_manager as SettingsManager;
+import download_pdfs as DownloadPDFs;
+import connection_pool as ConnectionPool;
+import make_pdf as MakePDF;
+import bench_server as BenchServer;
+import tracing as Tracing;
+from os import path;
+import argparse;
+import json;
+import platform;
+import shutil;
+import sys;
+import tempfile;
+import time;
+
+baseline_format = 1;
+dflt_repeat = 5;
+dflt_tolerance = 0.2;       # Fractional slow-down allowed before a result counts as a regression.
+
+benchmarks = ('mode_load', 'extract', 'crawl', 'merge');
+
+class Result:
+    '''
+    A single measurement.
+    '''
+
+    def __init__(self, name, value, unit, higher_is_better=False):
+        self.name = name;
+        self.value = value;
+        self.unit = unit;
+        self.higher_is_better = higher_is_better;
+
+    def toDict(self):
+        return {'value' : self.value, 'unit' : self.unit,
+                'higher_is_better' : self.higher_is_better};
+
+
+def median(values):
+    values = sorted(values);
+    n = len(values);
+    if n % 2:
+        return values[n//2];
+    return (values[n//2 - 1] + values[n//2])/2.0;
+
+def timed(func, repeat):
+    '''
+    @return: Returns the median time of func() over repeat calls, and the last value it returned.
+    '''
+
+    times = [];
+    out = None;
+    for i in range(repeat):
+        start = time.time();
+        out = func();
+        times.append(time.time() - start);
+
+    return median(times), out;
+
+
+def benchModeLoad(opts, server, work):
+    '''
+    SettingsReader.getMode, from nothing (caches cleared) reading the XML, from nothing reading a
+    snapshot of it (see build_snapshot), and again once cached.
+    '''
+
+    snapshot_file = path.join(work['dir'], 'modes.snapshot');
+    no_snapshot = path.join(work['dir'], 'none.snapshot');
+    SettingsManager.writeSnapshot(snapshot_file=snapshot_file);
+
+    def cold():
+        SettingsManager.clearCaches();
+        return SettingsManager.SettingsReader(snapshot_file=no_snapshot).getMode(opts.mode);
+
+    def coldSnapshot():
+        SettingsManager.clearCaches();
+        return SettingsManager.SettingsReader(snapshot_file=snapshot_file).getMode(opts.mode);
+
+    def warm():
+        return SettingsManager.SettingsReader().getMode(opts.mode);
+
+    cold_time, fmode = timed(cold, opts.repeat);
+    snap_time, fmode = timed(coldSnapshot, opts.repeat);
+    warm_time, fmode = timed(warm, opts.repeat);
+    return [Result('mode_load_cold', cold_time, 's'),
+            Result('mode_load_cold_snapshot', snap_time, 's'),
+            Result('mode_load_warm', warm_time, 's')];
+
+def benchExtract(opts, server, work):
+    '''
+    Parsing and extracting the fields from a page, per page, for the table of contents and for
+    the article pages.
+    '''
+
+    downloader = DownloadPDFs.PDFDownloader(server.url + '/toc', opts.mode,
+                                            pool=ConnectionPool.ConnectionPool());
+    toc = downloader.fetch(server.url + '/toc');
+    count = min(opts.articles, 20);
+    articles = [];
+    for i in range(count):
+        url = server.url + '/art/' + str(i);
+        try:
+            articles.append((url, downloader.fetch(url)));
+        except Exception:
+            # Failures injected by --error-rate.
+            continue;
+
+    def parseToc():
+        return downloader.parsePage(DownloadPDFs.Branch(server.url + '/toc', 0), toc);
+
+    def parseArticles():
+        for url, data in articles:
+            downloader.parsePage(DownloadPDFs.Branch(url, 1), data);
+
+    toc_time, children = timed(parseToc, opts.repeat);
+    art_time, out = timed(parseArticles, opts.repeat);
+    downloader.pool.close();
+
+    return [Result('extract_toc', toc_time, 's/page'),
+            Result('extract_article', art_time/max(1, len(articles)), 's/page')];
+
+def benchCrawl(opts, server, work):
+    '''
+    PDFDownloader.parseStep end to end, fetching every page from the server, on a fresh
+    connection pool each time.
+    '''
+
+    def crawl():
+        pool = ConnectionPool.ConnectionPool();
+        downloader = DownloadPDFs.PDFDownloader(server.url + '/toc', opts.mode, opts.workers,
+                                                pool);
+        root = downloader.parseStep();
+        pool.close();
+        return root;
+
+    crawl_time, root = timed(crawl, opts.repeat);
+    pages = len(list(root.walk()));
+    work['root'] = root;
+    return [Result('crawl_pages_per_s', pages/crawl_time, 'pages/s', True)];
+
+def benchMerge(opts, server, work):
+    '''
+    make_pdf.mergePDFs over the article PDFs, in MB of input per second.
+    '''
+
+    pool = ConnectionPool.ConnectionPool();
+    downloader = DownloadPDFs.PDFDownloader(server.url + '/toc', opts.mode, opts.workers, pool);
+    root = work.get('root');
+    if root == None:
+        root = downloader.parseStep();
+    files = downloader.downloadPDFs(root, path.join(work['dir'], 'pdfs'));
+    pool.close();
+    size = sum([f.size for f in files]);
+    output = path.join(work['dir'], 'merged.pdf');
+
+    merge_time, out = timed(lambda: MakePDF.mergePDFs([f.path for f in files], output),
+                            opts.repeat);
+    return [Result('merge_mb_per_s', size/merge_time/(1024*1024), 'MB/s', True)];
+
+bench_funcs = {
+               'mode_load' : benchModeLoad,
+               'extract' : benchExtract,
+               'crawl' : benchCrawl,
+               'merge' : benchMerge
+               };
+
+
+def run(opts):
+    '''
+    Start the server and run the benchmarks chosen in opts.
+
+    @return: Returns the results as a dictionary, in the baseline format.
+    '''
+
+    fmode = SettingsManager.SettingsReader().getMode(opts.mode);
+    publisher = BenchServer.SyntheticPublisher(fmode, opts.articles, page_size=opts.page_size,
+                                               pdf_pages=opts.pdf_pages, pdf_size=opts.pdf_size,
+                                               error_rate=opts.error_rate, seed=opts.seed);
+
+    work = {'dir' : tempfile.mkdtemp(prefix='journalswipe-bench-')};
+    results = [];
+    try:
+        with BenchServer.BenchServer(publisher, opts.latency) as server:
+            for name in opts.only:
+                results += bench_funcs[name](opts, server, work);
+    finally:
+        shutil.rmtree(work['dir'], True);
+
+    config = dict([(k, getattr(opts, k)) for k in ('mode', 'articles', 'page_size', 'pdf_pages',
+                                                   'pdf_size', 'latency', 'error_rate', 'seed',
+                                                   'workers', 'repeat')]);
+    return {
+            'format' : baseline_format,
+            'time' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python' : platform.python_version(),
+            'platform' : platform.platform(),
+            'config' : config,
+            'results' : dict([(r.name, r.toDict()) for r in results])
+            };
+
+def compare(current, baseline, tolerance=dflt_tolerance):
+    '''
+    Compare results against a baseline.
+
+    @param current: Dictionary returned by run().
+    @param baseline: Dictionary in the same format, e.g. loaded from a saved run.
+    @param tolerance: Fraction a result may be worse than the baseline by before it counts as a
+                regression.
+    @return: Returns a tuple of a list of report lines and a list of the names that regressed.
+    '''
+
+    lines = [];
+    regressed = [];
+    if baseline and current['config'] != baseline.get('config'):
+        lines.append('Warning: the baseline was run with a different configuration.');
+
+    for name in sorted(current['results']):
+        cur = current['results'][name];
+        base = baseline.get('results', {}).get(name);
+        if base == None or not base['value']:
+            lines.append('%-24s %12.6g %-8s (no baseline)' % (name, cur['value'], cur['unit']));
+            continue;
+
+        ratio = cur['value']/base['value'];
+        if cur['higher_is_better']:
+            worse = ratio < 1/(1 + tolerance);
+        else:
+            worse = ratio > 1 + tolerance;
+
+        flag = 'REGRESSED' if worse else 'ok';
+        if worse:
+            regressed.append(name);
+        lines.append('%-24s %12.6g %-8s baseline %12.6g  x%.2f  %s' %
+                     (name, cur['value'], cur['unit'], base['value'], ratio, flag));
+
+    return lines, regressed;
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(description='Benchmark JournalSwipe against a local '
+                                                 'synthetic publisher.');
+    parser.add_argument('--mode', default='Nature', help='mode to generate pages for and use');
+    parser.add_argument('--articles', type=int, default=BenchServer.dflt_articles);
+    parser.add_argument('--page-size', type=int, default=BenchServer.dflt_page_size,
+                        help='bytes per HTML page');
+    parser.add_argument('--pdf-pages', type=int, default=BenchServer.dflt_pdf_pages);
+    parser.add_argument('--pdf-size', type=int, default=BenchServer.dflt_pdf_size,
+                        help='bytes per PDF');
+    parser.add_argument('--latency', type=float, default=BenchServer.dflt_latency,
+                        help='seconds added to every response');
+    parser.add_argument('--error-rate', type=float, default=BenchServer.dflt_error_rate,
+                        help='fraction of article pages and PDFs that fail with a 503');
+    parser.add_argument('--seed', type=int, default=0);
+    parser.add_argument('--workers', type=int, default=DownloadPDFs.dflt_workers);
+    parser.add_argument('--repeat', type=int, default=dflt_repeat,
+                        help='runs of each benchmark, the median is reported');
+    parser.add_argument('--only', nargs='+', choices=benchmarks, default=list(benchmarks));
+    parser.add_argument('--save', metavar='FILE', help='write the results to FILE as JSON');
+    parser.add_argument('--compare', metavar='FILE', help='compare with a saved baseline and '
+                        'exit with status 2 if anything regressed');
+    parser.add_argument('--tolerance', type=float, default=dflt_tolerance,
+                        help='fractional slow-down allowed by --compare');
+    parser.add_argument('--trace', metavar='FILE', help='write a Chrome trace of the run to FILE, '
+                        'to open in chrome://tracing or ui.perfetto.dev');
+
+    return parser.parse_args(argv[1:]);
+
+def main(argv):
+    '''
+    Runs the benchmarks.
+
+    @param argv: The command line arguments.
+    @return: Returns 2 if there were regressions, 1 on error, 0 otherwise.
+    '''
+
+    opts = parseArgs(argv);
+    if opts.trace:
+        Tracing.tracer.enable();
+    current = run(opts);
+    if opts.trace:
+        Tracing.tracer.disable();
+        Tracing.tracer.write(opts.trace);
+        print('Wrote the trace to ' + opts.trace);
+
+    baseline = None;
+    if opts.compare:
+        try:
+            with open(opts.compare, 'rb') as f:
+                baseline = json.load(f);
+        except (IOError, ValueError) as e:
+            sys.stderr.write('Could not read the baseline: ' + str(e) + '\n');
+            return 1;
+
+    lines, regressed = compare(current, baseline or {}, opts.tolerance);
+    print('\n'.join(lines));
+
+    if opts.save:
+        with open(opts.save, 'wb') as f:
+            json.dump(current, f, indent=1, sort_keys=True);
+        print('Saved results to ' + opts.save);
+
+    if len(regressed):
+        print('Regressions: ' + ', '.join(regressed));
+        return 2;
+
+    return 0;
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv));
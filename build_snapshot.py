@@ -0,0 +1,43 @@
+"""
+Compiles the settings file and every mode registered in it into a snapshot, which is read in
+place of the XML at start-up for as long as none of the files change.
+
+Usage: python build_snapshot.py [settings_file [snapshot_file]]
+
+A snapshot written anywhere but the default location is only read by a SettingsReader given its
+snapshot_file.
+
+@author: SquidneyPoitier <squidney.poitier@gmail.com>
+@version: 0.1
+"""
+
+import settings_manager as SettingsManager;
+import sys;
+
+
+def main(argv):
+    """
+    Writes the snapshot.
+    
+    @param argv: The command line arguments.
+    @return: Returns 1 on error, 0 otherwise.
+    """
+    
+    settings_file = SettingsManager.dflt_settings_file;
+    snapshot_file = SettingsManager.dflt_snapshot_file;
+    if len(argv) > 1:
+        settings_file = argv[1];
+    if len(argv) > 2:
+        snapshot_file = argv[2];
+    
+    try:
+        names = SettingsManager.writeSnapshot(settings_file, snapshot_file);
+    except Exception as e:
+        sys.stderr.write('Could not write the snapshot: ' + str(e) + '\n');
+        return 1;
+    
+    print('Wrote ' + str(len(names)) + ' mode(s) to ' + snapshot_file + ': ' + ', '.join(names));
+    return 0;
+    
+if __name__ == '__main__':
+    sys.exit(main(sys.argv));
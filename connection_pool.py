@@ -0,0 +1,494 @@
+"""
+Library for keeping HTTP connections open between requests, so that the table of contents, the
+article pages and the PDFs of an issue are all fetched over the same few connections to the
+publisher rather than opening a new one for every request.
+
+@author: SquidneyPoitier <squidney.poitier@gmail.com>
+@version: 0.1
+"""
+
+from error_handling import DownloadError;
+import metrics as Metrics;
+import httplib;
+import socket;
+import threading;
+import time;
+import urlparse;
+import zlib;
+
+dflt_max_per_host = 16;     # Connections open to a single host at once.
+dflt_max_idle = 16;         # Idle connections kept for reuse, per host.
+dflt_max_redirects = 5;
+dflt_timeout = 30;
+dflt_user_agent = 'JournalSwipe/0.1';
+
+redirect_codes = (301, 302, 303, 307, 308);
+
+class ConnectionPool:
+    '''
+    Thread-safe pool of keep-alive connections, kept separately for each scheme and netloc. The
+    number of connections open to a host at once is capped, and requests over the cap wait for a
+    connection to be released. The cap can be adjusted per host as the run goes by an
+    adaptive_limits.AIMDController.
+
+    Requests ask for gzip or deflate encoded responses, which are decoded before being returned.
+    '''
+
+    def __init__(self, max_per_host=dflt_max_per_host, max_idle=dflt_max_idle,
+                 timeout=dflt_timeout, max_redirects=dflt_max_redirects, controller=None,
+                 limiter=None):
+        '''
+        @param max_per_host: int, the most connections open to a single host at once.
+        @param max_idle: int, the most idle connections kept for reuse per host. Connections
+                        released beyond this are closed.
+        @param timeout: Number of seconds to wait on a socket.
+        @param max_redirects: int, the most redirects followed for a single request.
+        @param controller: adaptive_limits.AIMDController, or None. If given, it is told the
+                        latency and outcome of every request, and the connections open to a host
+                        are capped by its limit for the host as well as by max_per_host.
+        @param limiter: batch_download.RateLimiter, or None. If given, every request - each
+                        redirect and each retry included - is charged to the host it is sent to,
+                        waiting for a token if the host has none.
+        '''
+
+        self.max_per_host = max_per_host;
+        self.max_idle = max_idle;
+        self.timeout = timeout;
+        self.max_redirects = max_redirects;
+        self.controller = controller;
+        self.limiter = limiter;
+
+        self.lock = threading.Lock();
+        self.hosts = {};
+
+        # Labels the pool's gauges, so those of pools to the same host are kept apart.
+        self.name = str(id(self));
+
+    def host(self, scheme, netloc):
+        '''
+        Get the HostPool for a scheme and netloc, creating it if needed.
+        '''
+
+        key = (scheme, netloc);
+        with self.lock:
+            if key not in self.hosts:
+                self.hosts[key] = HostPool(scheme, netloc, self);
+
+            return self.hosts[key];
+
+    def request(self, url, headers=None, method='GET'):
+        '''
+        Perform a request and read the whole response, following redirects.
+
+        @param url: String, the absolute URL.
+        @param headers: Dictionary of extra request headers.
+        @param method: String, the HTTP method.
+        @return: Returns a Response item with the decoded body.
+        @raise DownloadError: Raised if the request could not be made or there are too many
+                    redirects.
+        '''
+
+        conn, resp, url = self.open(url, headers, method);
+        try:
+            body = resp.read();
+            Metrics.registry.inc('http_received_bytes_total', len(body), host=conn.host.netloc);
+            body = decode(body, resp.getheader('content-encoding'));
+        except (httplib.HTTPException, socket.error, zlib.error) as e:
+            conn.discard();
+            raise DownloadError(DownloadError.ERR_FETCH, 'Could not read ' + url + ': ' + str(e));
+
+        conn.release(resp);
+
+        return Response(url, resp.status, resp.getheaders(), body);
+
+    def open(self, url, headers=None, method='GET'):
+        '''
+        Perform a request, following redirects, without reading the body. The caller must read
+        the response and then call release() on the connection (or discard() if the read failed).
+
+        @param url: String, the absolute URL.
+        @param headers: Dictionary of extra request headers.
+        @param method: String, the HTTP method.
+        @return: Returns a tuple of (PooledConnection, httplib.HTTPResponse, final URL).
+        @raise DownloadError: Raised if the request could not be made or there are too many
+                    redirects.
+        '''
+
+        conditional = headers != None and \
+            ('If-None-Match' in headers or 'If-Modified-Since' in headers);
+        for i in range(self.max_redirects + 1):
+            parsed = urlparse.urlsplit(url);
+            if self.limiter != None:
+                self.limiter.acquire(parsed.netloc, conditional);
+            conn = self.host(parsed.scheme, parsed.netloc).acquire();
+
+            path = parsed.path or '/';
+            if parsed.query:
+                path += '?' + parsed.query;
+
+            resp = conn.send(method, path, headers);
+            if resp.status not in redirect_codes or resp.getheader('location') == None:
+                return conn, resp, url;
+
+            # Drain the redirect body so the connection can be reused.
+            try:
+                resp.read();
+                conn.release(resp);
+            except (httplib.HTTPException, socket.error):
+                conn.discard();
+
+            url = urlparse.urljoin(url, resp.getheader('location'));
+            if resp.status == 303:
+                method = 'GET';
+
+        raise DownloadError(DownloadError.ERR_REDIRECT, 'Too many redirects: ' + url);
+
+    def stats(self):
+        '''
+        Counts of what the pool has been doing, to check that connections are being reused.
+
+        @return: Dictionary keyed by 'scheme://netloc', each value a dictionary with the number of
+                'requests' made, connections 'opened', requests which 'reused' a connection,
+                connections currently 'idle' and currently 'active'.
+        '''
+
+        with self.lock:
+            hosts = self.hosts.items();
+
+        out = {};
+        for (scheme, netloc), host in hosts:
+            out[scheme + '://' + netloc] = host.stats();
+
+        return out;
+
+    def close(self):
+        '''
+        Close all the idle connections.
+        '''
+
+        with self.lock:
+            hosts = self.hosts.values();
+
+        for host in hosts:
+            host.close();
+
+
+class HostPool:
+    '''
+    The connections to a single host.
+    '''
+
+    def __init__(self, scheme, netloc, pool):
+        self.scheme = scheme;
+        self.netloc = netloc;
+        self.pool = pool;
+
+        self.lock = threading.Condition();
+        self.idle = [];
+
+        self.requests = 0;
+        self.opened = 0;
+        self.reused = 0;
+        self.active = 0;
+
+        self.labels = {'pool' : pool.name, 'scheme' : scheme, 'host' : netloc};
+        Metrics.registry.set('http_connections_active', lambda: self.active, **self.labels);
+        Metrics.registry.set('http_connections_idle', lambda: len(self.idle), **self.labels);
+
+    def limit(self):
+        '''
+        @return: Returns the number of connections currently allowed to the host.
+        '''
+
+        pool = self.pool;
+        if pool.controller == None:
+            return pool.max_per_host;
+
+        return min(pool.max_per_host, pool.controller.limit(self.netloc));
+
+    def acquire(self):
+        '''
+        Take an idle connection, or open a new one. Blocks while the limit of connections is
+        already in use.
+
+        @return: A PooledConnection.
+        '''
+
+        with self.lock:
+            while self.active >= self.limit():
+                self.lock.wait();
+            self.active += 1;
+            if len(self.idle):
+                return PooledConnection(self, self.idle.pop(), True);
+
+        return PooledConnection(self, self.connect(), False);
+
+    def connect(self):
+        '''
+        Open a new httplib connection to the host.
+        '''
+
+        with self.lock:
+            self.opened += 1;
+
+        if self.scheme == 'https':
+            return httplib.HTTPSConnection(self.netloc, timeout=self.pool.timeout);
+
+        return httplib.HTTPConnection(self.netloc, timeout=self.pool.timeout);
+
+    def release(self, conn, keep):
+        '''
+        Give a connection back to the pool.
+
+        @param conn: The httplib connection.
+        @param keep: Boolean, whether the connection can be reused.
+        '''
+
+        with self.lock:
+            self.active -= 1;
+            if keep and len(self.idle) < self.pool.max_idle:
+                self.idle.append(conn);
+                conn = None;
+
+            # The limit may have changed as well, so wake everyone to recheck it.
+            self.lock.notify_all();
+
+        if conn != None:
+            conn.close();
+
+    def stats(self):
+        with self.lock:
+            return {
+                    'requests' : self.requests,
+                    'opened' : self.opened,
+                    'reused' : self.reused,
+                    'idle' : len(self.idle),
+                    'active' : self.active
+                    };
+
+    def close(self):
+        '''
+        Close the idle connections, and stop reporting the gauges - which would otherwise keep
+        the HostPool alive in the metrics registry.
+        '''
+
+        with self.lock:
+            idle = self.idle;
+            self.idle = [];
+
+        for conn in idle:
+            conn.close();
+
+        Metrics.registry.remove('http_connections_active', **self.labels);
+        Metrics.registry.remove('http_connections_idle', **self.labels);
+
+
+class PooledConnection:
+    '''
+    A connection checked out of a HostPool. Call exactly one of release() or discard() once done.
+    '''
+
+    def __init__(self, host, conn, reused):
+        self.host = host;
+        self.conn = conn;
+        self.reused = reused;
+
+    def send(self, method, path, headers=None):
+        '''
+        Send a request and read the response headers. A reused connection which turns out to have
+        been closed by the server is replaced by a new one and the request is sent again.
+
+        @return: The httplib.HTTPResponse.
+        @raise DownloadError: Raised if the request fails.
+        '''
+
+        hdrs = {
+                'Accept-Encoding' : 'gzip, deflate',
+                'User-Agent' : dflt_user_agent
+                };
+        if headers != None:
+            hdrs.update(headers);
+
+        host = self.host;
+        controller = host.pool.controller;
+        while True:
+            start = time.time();
+            try:
+                self.conn.request(method, path, headers=hdrs);
+                resp = self.conn.getresponse();
+                break;
+            except (httplib.HTTPException, socket.error) as e:
+                self.conn.close();
+                if not self.reused:
+                    Metrics.registry.inc('http_errors_total', host=host.netloc);
+                    if controller != None:
+                        controller.record(host.netloc, time.time() - start, None, e);
+                    self.discard();
+                    raise DownloadError(DownloadError.ERR_FETCH, 'Could not retrieve ' +
+                                        host.scheme + '://' + host.netloc + path + ': ' + str(e));
+
+                # Stale keep-alive connection, try once on a fresh one.
+                self.conn = host.connect();
+                self.reused = False;
+
+        latency = time.time() - start;
+        Metrics.registry.observe('http_request_seconds', latency, host=host.netloc);
+        Metrics.registry.inc('http_responses_total', host=host.netloc, status=resp.status);
+        if controller != None:
+            controller.record(host.netloc, latency, resp.status);
+
+        with host.lock:
+            host.requests += 1;
+            if self.reused:
+                host.reused += 1;
+
+        return resp;
+
+    def release(self, resp):
+        '''
+        Give the connection back once the response has been read completely.
+
+        @param resp: The httplib.HTTPResponse that was read.
+        '''
+
+        if self.conn != None:
+            self.host.release(self.conn, not resp.will_close);
+            self.conn = None;
+
+    def discard(self):
+        '''
+        Close the connection rather than reusing it, e.g. after an error part way through a read.
+        '''
+
+        if self.conn != None:
+            self.host.release(self.conn, False);
+            self.conn = None;
+
+
+class Response:
+    '''
+    A fully read response.
+    '''
+
+    def __init__(self, url, status, headers, body):
+        '''
+        @param url: String, the final URL after redirects.
+        @param status: int, the HTTP status code.
+        @param headers: List of (name, value) tuples, names in lower case.
+        @param body: String, the decoded body.
+        '''
+
+        self.url = url;
+        self.status = status;
+        self.headers = dict(headers);
+        self.body = body;
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default);
+
+
+def decode(data, encoding):
+    '''
+    Undo the Content-Encoding of a response body.
+
+    @param data: String, the body as received.
+    @param encoding: String, the Content-Encoding header (None if there wasn't one).
+    @return: Returns the decoded body.
+    @raise zlib.error: Raised if the body is not validly encoded.
+    '''
+
+    if encoding == None:
+        return data;
+
+    encoding = encoding.strip().lower();
+    if encoding in ('gzip', 'x-gzip'):
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS);
+    elif encoding == 'deflate':
+        # Servers disagree on whether deflate means zlib-wrapped or raw deflate data.
+        try:
+            return zlib.decompress(data);
+        except zlib.error:
+            return zlib.decompress(data, -zlib.MAX_WBITS);
+
+    return data;
+
+
+def decoder(encoding):
+    '''
+    A decompressor for undoing the Content-Encoding of a response body a chunk at a time.
+
+    @param encoding: String, the Content-Encoding header (None if there wasn't one).
+    @return: Returns an object with the decompress and flush methods of a zlib decompression 
+            object, or None if the body isn't encoded.
+    '''
+
+    if encoding == None:
+        return None;
+
+    encoding = encoding.strip().lower();
+    if encoding in ('gzip', 'x-gzip'):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS);
+    elif encoding == 'deflate':
+        return DeflateDecoder();
+
+    return None;
+
+
+class DeflateDecoder:
+    '''
+    Streaming decompressor for the deflate Content-Encoding, which like decode() accepts both
+    zlib-wrapped and raw deflate data. Which one a body is is decided from its first two bytes,
+    the length of the zlib header.
+    '''
+
+    def __init__(self):
+        self.obj = None;
+        self.head = '';
+
+    def decompress(self, data):
+        '''
+        @param data: String, the next chunk of the body.
+        @return: Returns as much of the decoded body as is available.
+        @raise zlib.error: Raised if the body is not validly encoded.
+        '''
+
+        if self.obj != None:
+            return self.obj.decompress(data);
+
+        self.head += data;
+        if len(self.head) < 2:
+            return '';
+
+        data, self.head = self.head, '';
+        self.obj = zlib.decompressobj();
+        try:
+            return self.obj.decompress(data);
+        except zlib.error:
+            self.obj = zlib.decompressobj(-zlib.MAX_WBITS);
+            return self.obj.decompress(data);
+
+    def flush(self):
+        if self.obj == None:
+            # Too short for a zlib header.
+            self.obj = zlib.decompressobj(-zlib.MAX_WBITS);
+            return self.obj.decompress(self.head) + self.obj.flush();
+
+        return self.obj.flush();
+
+
+_default_pool = None;
+_default_lock = threading.Lock();
+
+def defaultPool():
+    '''
+    The pool shared by everything in the process that doesn't ask for its own.
+
+    @return: A ConnectionPool.
+    '''
+
+    global _default_pool;
+    with _default_lock:
+        if _default_pool == None:
+            _default_pool = ConnectionPool();
+
+        return _default_pool;
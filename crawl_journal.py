@@ -0,0 +1,219 @@
+"""
+Library for checkpointing crawls as they go, so that a crawl which is interrupted - a worker
+killed, a machine preempted - carries on where it stopped when it is run again rather than
+fetching every page a second time.
+
+The journal is a SQLite database holding every branch of each crawl with the fields found for it
+and whether its page has been done, and every file downloaded for it with its hash. Each page is
+recorded, with the branches for its links, in a single transaction once it has been parsed, so
+the journal always describes a tree that was actually seen.
+
+@author: SquidneyPoitier <squidney.poitier@gmail.com>
+@version: 0.1
+"""
+
+from os import path;
+import json;
+import sqlite3;
+import threading;
+
+dflt_journal_file = path.join(path.dirname(path.abspath(__file__)), 'journal.sqlite');
+journal_format = 1;     # Stored as the database's user_version.
+
+# Branch states
+PENDING = 'pending';    # Found, but its page hasn't been done (or it is a leaf, never fetched).
+DONE = 'done';          # Its page was fetched and parsed, and its children recorded.
+ERROR = 'error';        # Its page failed. Retried when the crawl is resumed.
+
+schema = '''
+CREATE TABLE IF NOT EXISTS crawls (
+    id INTEGER PRIMARY KEY,
+    mode TEXT NOT NULL,
+    url TEXT NOT NULL,
+    step INTEGER NOT NULL,
+    UNIQUE (mode, url, step)
+);
+CREATE TABLE IF NOT EXISTS branches (
+    id INTEGER PRIMARY KEY,
+    crawl INTEGER NOT NULL,
+    parent INTEGER,
+    url TEXT NOT NULL,
+    step INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    fields TEXT NOT NULL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS branches_crawl ON branches (crawl);
+CREATE TABLE IF NOT EXISTS files (
+    branch INTEGER NOT NULL,
+    idx INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    PRIMARY KEY (branch, idx)
+);
+''';
+
+class CrawlJournal:
+    '''
+    Thread-safe journal of crawls, kept in a SQLite database. Crawls are identified by their
+    mode, starting URL and starting step, so running the same crawl again finds its branches.
+
+    Branches are referred to by their row id, which download_pdfs.PDFDownloader keeps in each
+    Branch's journal_id.
+    '''
+
+    def __init__(self, fname=dflt_journal_file):
+        '''
+        Opens the journal, creating it if needed.
+
+        @param fname: String, the database file.
+        '''
+
+        self.fname = fname;
+        self.lock = threading.Lock();
+        self.conn = sqlite3.connect(fname, check_same_thread=False);
+        self.conn.text_factory = str;
+
+        with self.lock:
+            # Write-ahead logging lets each page be committed cheaply; a commit is lost only if
+            # the machine itself goes down, never if just the process does.
+            self.conn.execute('PRAGMA journal_mode=WAL');
+            self.conn.execute('PRAGMA synchronous=NORMAL');
+            self.conn.executescript(schema);
+            self.conn.execute('PRAGMA user_version=' + str(journal_format));
+            self.conn.commit();
+
+    def crawl(self, mode, url, step=0):
+        '''
+        @param mode: String, the mode the crawl uses.
+        @param url: String, the URL it starts from.
+        @param step: int, the step it starts from.
+        @return: Returns the id of the crawl, adding it if it's new.
+        '''
+
+        with self.lock:
+            with self.conn:
+                self.conn.execute('INSERT OR IGNORE INTO crawls (mode, url, step) VALUES (?, ?, ?)',
+                                  (mode, url, step));
+                row = self.conn.execute('SELECT id FROM crawls WHERE mode=? AND url=? AND step=?',
+                                        (mode, url, step)).fetchone();
+
+        return row[0];
+
+    def load(self, crawl):
+        '''
+        @param crawl: int, the crawl id.
+        @return: Returns the crawl's branches, in the order they were found (so each comes
+                after its parent, and siblings are in page order), as a list of (id, parent id,
+                URL, step, state, fields dictionary, error) tuples. The root's parent is None.
+        '''
+
+        with self.lock:
+            rows = self.conn.execute('SELECT id, parent, url, step, state, fields, error '
+                                     'FROM branches WHERE crawl=? ORDER BY id',
+                                     (crawl,)).fetchall();
+
+        return [(i, parent, url, step, state, json.loads(fields), error)
+                for i, parent, url, step, state, fields, error in rows];
+
+    def start(self, crawl, branch):
+        '''
+        Record the root of a crawl, setting its journal_id.
+        '''
+
+        with self.lock:
+            with self.conn:
+                cur = self.conn.execute('INSERT INTO branches (crawl, parent, url, step, state, '
+                                        'fields) VALUES (?, NULL, ?, ?, ?, ?)',
+                                        (crawl, branch.url, branch.step, PENDING,
+                                         json.dumps(branch.fields)));
+        branch.journal_id = cur.lastrowid;
+
+    def finish(self, branch, children):
+        '''
+        Record that a branch's page has been done, with its fields and the branches for its
+        links, setting their journal_ids.
+
+        @param branch: The Branch, already recorded.
+        @param children: List of its child Branch items, in page order.
+        '''
+
+        with self.lock:
+            with self.conn:
+                self.conn.execute('UPDATE branches SET state=?, fields=?, error=NULL WHERE id=?',
+                                  (DONE, json.dumps(branch.fields), branch.journal_id));
+                for child in children:
+                    cur = self.conn.execute('INSERT INTO branches (crawl, parent, url, step, '
+                                            'state, fields) SELECT crawl, id, ?, ?, ?, ? '
+                                            'FROM branches WHERE id=?',
+                                            (child.url, child.step, PENDING,
+                                             json.dumps(child.fields), branch.journal_id));
+                    child.journal_id = cur.lastrowid;
+
+    def fail(self, branch, error):
+        '''
+        Record that a branch's page failed.
+        '''
+
+        with self.lock:
+            with self.conn:
+                self.conn.execute('UPDATE branches SET state=?, error=? WHERE id=?',
+                                  (ERROR, str(error), branch.journal_id));
+
+    def addFile(self, branch, i, f):
+        '''
+        Record a file downloaded for a branch.
+
+        @param branch: The Branch, already recorded.
+        @param i: int, the index of the file in the branch's files.
+        @param f: The download_pdfs.DownloadedFile.
+        '''
+
+        with self.lock:
+            with self.conn:
+                self.conn.execute('INSERT OR REPLACE INTO files (branch, idx, url, path, size, '
+                                  'sha256) VALUES (?, ?, ?, ?, ?, ?)',
+                                  (branch.journal_id, i, f.url, f.path, f.size, f.checksum));
+
+    def getFile(self, branch, i):
+        '''
+        @return: Returns a tuple of the URL, path, size and SHA-256 of the file recorded for a
+                branch, or None if there isn't one.
+        '''
+
+        if branch.journal_id == None:
+            return None;
+
+        with self.lock:
+            return self.conn.execute('SELECT url, path, size, sha256 FROM files '
+                                     'WHERE branch=? AND idx=?',
+                                     (branch.journal_id, i)).fetchone();
+
+    def forget(self, mode, url, step=0):
+        '''
+        Remove a crawl, so that running it again starts from scratch.
+        '''
+
+        with self.lock:
+            with self.conn:
+                row = self.conn.execute('SELECT id FROM crawls WHERE mode=? AND url=? AND step=?',
+                                        (mode, url, step)).fetchone();
+                if row == None:
+                    return;
+
+                self.conn.execute('DELETE FROM files WHERE branch IN '
+                                  '(SELECT id FROM branches WHERE crawl=?)', row);
+                self.conn.execute('DELETE FROM branches WHERE crawl=?', row);
+                self.conn.execute('DELETE FROM crawls WHERE id=?', row);
+
+    def close(self):
+        with self.lock:
+            self.conn.close();
+
+    def __enter__(self):
+        return self;
+
+    def __exit__(self, *args):
+        self.close();
@@ -6,8 +6,37 @@ files for later assembly.
 @version: 0.1
 """
 import settings_manager as SettingsManager;
+import connection_pool as ConnectionPool;
+import file_store as FileStore;
+import article_table as ArticleTable;
+import crawl_journal as CrawlJournal;
+import toc_refresh as TOCRefresh;
+import metrics as Metrics;
+import tracing as Tracing;
+from error_handling import DownloadError;
+from general_utils import unique;
 from lxml import etree;
+from os import path;
+import hashlib;
+import httplib;
+import multiprocessing;
+import os;
+import re;
+import socket;
+import sqlite3;
 import urlparse;
+import threading;
+import time;
+import Queue;
+import zlib;
+
+dflt_workers = 16;      # Number of threads used to crawl the step tree.
+dflt_chunk_size = 64*1024;  # Bytes read and written at a time when downloading files.
+dflt_retries = 3;       # Times an interrupted download is resumed before giving up.
+
+manifest_name = 'manifest.json';
+
+content_range = re.compile(r'bytes\s+(\d+)-(\d+)/(\d+|\*)');
 
 class PDFDownloader:
     """
@@ -19,20 +48,78 @@ class PDFDownloader:
     use_mode = '';          # What method to search journal - hash key.
     download_loc = '';      # Download location TODO: Replace with default.
     fmode = None;
+    workers = dflt_workers;
+    pool = None;
+    cache = None;
+    streaming = False;
+    store = None;
+    parse_pool = None;
+    journal = None;
+    index = None;
+    snapshots = None;
+    report = None;          # toc_refresh.RefreshReport for the current crawl.
+    snapshot = None;        # The snapshot saved by finishCrawl.
     
-    def __init__(self, toc_url, use_mode):
+    def __init__(self, toc_url, use_mode, workers=dflt_workers, pool=None, cache=None,
+                 streaming=False, store=None, parse_pool=None, journal=None, index=None,
+                 snapshots=None):
         '''
         Instantiate the class with the URL from the table of contents of the
         issue and the hash key for the use mode.
         
         @param toc_url:    String, table of contents URL.
         @param use_mode:   String, hash key to the journal settings.
+        @param workers:    int, the number of pages fetched and parsed at once.
+        @param pool:       ConnectionPool to make requests through. Defaults to
+                           the pool shared by the whole process, so connections
+                           are reused between downloaders as well.
+        @param cache:      ResponseCache to keep pages in between runs, or None
+                           to always fetch them in full.
+        @param streaming:  Boolean, if True pages are parsed as they arrive and 
+                           only the parts of them the mode looks at are kept 
+                           (see StreamExtractor). Pages are still read in full
+                           when there is a cache.
+        @param store:      FileStore to keep downloaded files in, or None to save
+                           them directly. With a store, files are hard links
+                           into it, files it already has are not downloaded 
+                           again, and each download directory gets a manifest.
+        @param parse_pool: ParsePool to parse pages in, or None to parse them
+                           in the crawl threads. Ignored when streaming without
+                           a cache.
+        @param journal:    crawl_journal.CrawlJournal to checkpoint the crawl and
+                           the downloads in, or None. With a journal, a crawl 
+                           which was interrupted carries on from where it got 
+                           to, and files already downloaded are kept.
+        @param index:      article_index.ArticleIndex to add the articles found
+                           and their files to, or None. Article pages the index
+                           has under a DOI are not fetched again, and their 
+                           files are not downloaded again while they are still
+                           where the index says.
+        @param snapshots:  toc_refresh.TOCSnapshots to refresh the issue against,
+                           or None. When refreshing, only the pages of articles
+                           which are new, or listed differently, since the last
+                           crawl are fetched and only their files downloaded
+                           (see finishCrawl).
         '''
         
+        self.workers = workers;
+        self.streaming = streaming;
+        if pool == None:
+            pool = ConnectionPool.defaultPool();
+        self.pool = pool;
+        self.cache = cache;
+        self.store = store;
+        self.parse_pool = parse_pool;
+        self.journal = journal;
+        self.index = index;
+        self.snapshots = snapshots;
+        self._local = threading.local();
+        
         # Get the use mode.
         sr = SettingsManager.SettingsReader();
         try:
             self.fmode = sr.getMode(use_mode);
+            self.use_mode = use_mode;
             fmode = self.fmode;
         except:
             raise;
@@ -42,39 +129,164 @@ class PDFDownloader:
         
         self.base_url = urlparse.urlparse(url).netloc;
         base_url = self.base_url;
-       
-        # Build the step items
-        
-        
-        # Build the tables of contents from the URL.
-       
-        ''' 
-        Invalid code, for the moment.
-       
-        tree = etree.parse(url, parser=parser, base_url=base_url);
-        
-        all_articles = tree.findall(fmode.allTags(fmode.articleTag));
-        
-        # Null-initialization of these tables.
-        nArticles = len(all_articles);
-        self.nArticles = nArticles;
-        self.titles = ['']*nArticles;
-        self.links = ['']*nArticles;        
-        self.authors = [['']]*nArticles;
-        self.abstract = ['']*nArticles;
-        
-        # Iterate through the table of contents and generate the table.
-        for i, article in enumerate(all_articles):
-            link = article.find('.//a');
-            if(link == None):
-                print(etree.tounicode(article));
-                continue;
-                
-            self.titles[i] = link.text;
-            self.links[i] = link.get('href');
+        
+    def fetch(self, url, parser=None):
+        '''
+        Retrieves a page, through the response cache if there is one.
+        
+        @param url: String, the absolute URL of the page.
+        @param parser: String, the type of parser the page will be read with 
+                    (see fetchMode.parsers). Pass None for pages which are not 
+                    parsed, and so are not cached.
+        @return: The body of the response, as a string of bytes.
+        @raise DownloadError: Raised if the page could not be retrieved.
+        '''
+        
+        if self.cache != None and parser != None:
+            resp = self.cache.fetch(self.pool, url, parser);
+        else:
+            resp = self.pool.request(url);
+        if resp.status != 200:
+            raise DownloadError(DownloadError.ERR_HTTP, 
+                                'HTTP ' + str(resp.status) + ' retrieving ' + url);
+        
+        return resp.body;
+    
+    def articleTable(self, root):
+        '''
+        Collects the articles found by a crawl into an ArticleTable, which 
+        holds them far more compactly than the Branch tree.
+        
+        @param root: The Branch item returned by parseStep.
+        @return: Returns an ArticleTable with a row for each article, in order.
+        '''
+        
+        return ArticleTable.fromTree(root);
+    
+    def getParser(self, step):
+        '''
+        lxml parsers can't be shared between threads, so each thread gets its own copy of the 
+        parser for each step.
+        
+        @param step: int, the step (0-based index).
+        @return: The parser for the step, owned by the calling thread.
+        '''
+        
+        local = self._local;
+        if not hasattr(local, 'parsers'):
+            local.parsers = {};
+        
+        if step not in local.parsers:
+            local.parsers[step] = self.fmode.sparsers[step].copy();
+        
+        return local.parsers[step];
+    
+    def parsePage(self, branch, data):
+        '''
+        Parses a page fetched for a branch, filling in the fields found on it and creating a child
+        branch for each link to the next step.
+        
+        Fields whose location starts from the same tag as the link location (e.g. the 'article'
+        holding both the title and the link on a table of contents) are stored on the child they
+        belong to, all others are stored on the branch itself.
+        
+        @param branch: The Branch item the page belongs to.
+        @param data: String, the page contents.
+        @return: Returns the list of child Branch items, in the order they appear on the page.
+        @raise DownloadError: Raised if the page could not be parsed.
+        '''
+        
+        try:
+            tree = etree.fromstring(data, self.getParser(branch.step), base_url=branch.url);
+        except etree.LxmlError:
+            tree = None;
+        
+        if tree is None:
+            raise DownloadError(DownloadError.ERR_PARSE);
+        
+        return self.extract(branch, tree);
+    
+    def parseStream(self, branch, chunk_size=dflt_chunk_size):
+        '''
+        Fetches and parses the page for a branch at the same time, feeding each chunk to a 
+        StreamExtractor as it is received, then fills in the branch as parsePage does.
+        
+        @param branch: The Branch item to fetch the page for.
+        @param chunk_size: int, bytes read at a time.
+        @return: Returns the list of child Branch items, in the order they appear on the page.
+        @raise DownloadError: Raised if the page could not be retrieved or parsed.
+        '''
+        
+        step = branch.step;
+        conn, resp, url = self.pool.open(branch.url);
+        try:
+            if resp.status != 200:
+                resp.read();
+                conn.release(resp);
+                raise DownloadError(DownloadError.ERR_HTTP, 
+                                    'HTTP ' + str(resp.status) + ' retrieving ' + url);
+            
+            decoder = ConnectionPool.decoder(resp.getheader('content-encoding'));
+            extractor = StreamExtractor(self.fmode.roots[step], self.fmode.stypes[step] == 'HTML');
+            while True:
+                chunk = resp.read(chunk_size);
+                if not chunk:
+                    break;
+                Metrics.registry.inc('http_received_bytes_total', len(chunk), 
+                                     host=conn.host.netloc);
+                if decoder != None:
+                    chunk = decoder.decompress(chunk);
+                extractor.feed(chunk);
+            
+            if decoder != None:
+                extractor.feed(decoder.flush());
+            tree = extractor.close();
+        except (httplib.HTTPException, socket.error, zlib.error) as e:
+            conn.discard();
+            raise DownloadError(DownloadError.ERR_FETCH, 
+                                'Interrupted retrieving ' + url + ': ' + str(e));
+        except etree.LxmlError:
+            conn.discard();
+            raise DownloadError(DownloadError.ERR_PARSE);
+        
+        conn.release(resp);
+        return self.extract(branch, tree);
+    
+    def extract(self, branch, tree):
+        '''
+        Evaluates the mode's locations for the branch's step on a parsed page.
+        
+        @param branch: The Branch item the page belongs to.
+        @param tree: The parsed page.
+        @return: Returns the list of child Branch items, in the order they appear on the page.
+        '''
+        
+        return self.applyRecord(branch, extractRecord(self.fmode, branch.step, branch.url, tree));
+    
+    def applyRecord(self, branch, record):
         '''
+        Fills in a branch from the record of what was found on its page (see extractRecord).
         
-    def parseStep(self, step):
+        @param branch: The Branch item the page belongs to.
+        @param record: The record.
+        @return: Returns the list of child Branch items, in the order they appear on the page.
+        '''
+        
+        page_fields, items = record;
+        for name, values in page_fields:
+            branch.setField(name, values);
+        
+        children = [];
+        for url, fields in items:
+            child = Branch(url, branch.step+1, branch);
+            for name, values in fields:
+                child.setField(name, values);
+            children.append(child);
+        
+        branch.children = children;
+        return children;
+        
+    def parseStep(self, step=0, url=None):
         '''
         This function is called recursively and is used to step through all
         the sub-branches of a given step.
@@ -96,18 +308,1185 @@ class PDFDownloader:
         substeps of a given step have been parsed, it can iterate over each
         of the substeps and flesh out the matrix structure of the tree.
         
-        Since this operation is by its very nature highly parallel, we'll 
-        try to do this in as threadsafe a manner as possible, to allow for
-        code optimisation.
+        Since this operation is by its very nature highly parallel, each page
+        is fetched and parsed as a task on a CrawlPool of self.workers threads,
+        and the tasks for its sub-branches are queued as soon as its links are
+        known. Each branch's children are created in page order before any of
+        them is fetched, so the tree comes back in the same order regardless of
+        which requests finish first.
+        
+        Pages that fail are not retried; the exception is stored in the
+        branch's error property and its children are left empty.
+        
+        With a journal, a crawl it already has is resumed (see startCrawl).
+        When refreshing, only the pages of new and changed articles are
+        fetched.
         
-        @param step: A Step item telling us what we are looking for on a 
-                    given step.
+        @param step: int, the step to start from (0-based index).
+        @param url: String, the URL of the page for that step. Defaults to the
+                    table of contents URL.
         @return: Returns a Branch item with information about the full tree
                 substructure
         '''
-        pass
-
+        
+        pool = CrawlPool(self.workers);
+        try:
+            root = self.startCrawl(pool, step, url);
+            pool.join();
+        finally:
+            pool.close();
+        
+        self.finishCrawl(root);
+        return root;
+    
+    def startCrawl(self, pool, step=0, url=None):
+        '''
+        Creates the root branch for a crawl and queues the crawl on a pool 
+        (see crawl), without waiting for it.
+        
+        If there is a journal and it has this crawl, the tree is rebuilt from
+        it instead, and only the pages which weren't done - or which failed -
+        are queued. When refreshing, a crawl the journal has with nothing left
+        to do is one that finished, so it is started again.
+        
+        @param pool: CrawlPool (or anything with its submitFor method) to run 
+                    the crawl on.
+        @param step: int, the step to start from (0-based index).
+        @param url: String, the URL of the page for that step. Defaults to the
+                    table of contents URL.
+        @return: Returns the root Branch item. It is filled in as the crawl 
+                progresses.
+        '''
+        
+        if url == None:
+            url = self.url;
+        
+        if self.snapshots != None:
+            self.report = TOCRefresh.RefreshReport(self.snapshots.load(self.use_mode, url));
+            self.snapshot = None;
+        
+        journal = self.journal;
+        if journal == None:
+            root = Branch(url, step);
+            self.crawl(pool, root);
+            return root;
+        
+        crawl = journal.crawl(self.use_mode, url, step);
+        rows = journal.load(crawl);
+        if len(rows) == 0:
+            root = Branch(url, step);
+            journal.start(crawl, root);
+            self.crawl(pool, root);
+            return root;
+        
+        branches = {};
+        queue = [];
+        for i, parent, burl, bstep, state, fields, error in rows:
+            branch = Branch(burl, bstep, branches.get(parent));
+            branch.fields = fields;
+            branch.journal_id = i;
+            branches[i] = branch;
+            if branch.parent != None:
+                branch.parent.children.append(branch);
+            
+            if state != CrawlJournal.DONE and bstep < self.fmode.nsteps:
+                queue.append(branch);
+        
+        if self.snapshots != None and len(queue) == 0:
+            journal.forget(self.use_mode, url, step);
+            return self.startCrawl(pool, step, url);
+        
+        Metrics.registry.inc('journal_restored_total', len(rows) - len(queue));
+        for branch in queue:
+            pool.submitFor(branch.url, self._crawl, pool, branch);
+        
+        return branches[rows[0][0]];
+    
+    def crawl(self, pool, root):
+        '''
+        Queues the crawl of the tree below a branch on a pool, without waiting
+        for it, so that several crawls can share one pool (see parseStep).
+        
+        @param pool: CrawlPool (or anything with its submitFor method) to run 
+                    the crawl on.
+        @param root: The Branch item to start from. It is filled in as the 
+                    crawl progresses.
+        '''
+        pool.submitFor(root.url, self._crawl, pool, root);
+    
+    def _crawl(self, pool, branch):
+        '''
+        Pool task - fetches and parses the page for a single branch and queues its children.
+        
+        Anything else that goes wrong with the page - the journal, the index or the cache 
+        failing, or a parse worker raising - is stored in the branch's error property like a
+        DownloadError, so the branch never looks done when it isn't.
+        '''
+        
+        try:
+            self._crawlPage(pool, branch);
+        except Exception as e:
+            Metrics.registry.inc('pages_total', step=str(branch.step), result='error');
+            branch.error = e;
+            if self.journal != None:
+                try:
+                    self.journal.fail(branch, e);
+                except sqlite3.Error:
+                    # The journal may be what failed.
+                    pass;
+    
+    def _crawlPage(self, pool, branch):
+        registry = Metrics.registry;
+        tracer = Tracing.tracer;
+        step = str(branch.step);
+        refresh = None;
+        if self.snapshots != None:
+            refresh = self._refreshArticle(branch);
+            if refresh == 'unchanged':
+                registry.inc('pages_total', step=step, result='unchanged');
+                if self.journal != None:
+                    self.journal.finish(branch, []);
+                return;
+        
+        # An article listed differently is fetched again, even if it is indexed.
+        if self.index != None and refresh != 'changed' and self._restoreArticle(branch):
+            registry.inc('pages_total', step=step, result='indexed');
+            if self.journal != None:
+                self.journal.finish(branch, []);
+            return;
+        
+        try:
+            if self.streaming and self.cache == None:
+                with registry.timer('page_stream_seconds', step=step), \
+                        tracer.span('stream', 'crawl', step=branch.step, url=branch.url):
+                    children = self.parseStream(branch);
+            else:
+                with registry.timer('page_fetch_seconds', step=step), \
+                        tracer.span('fetch', 'crawl', step=branch.step, url=branch.url):
+                    data = self.fetch(branch.url, self.fmode.stypes[branch.step]);
+                
+                with registry.timer('page_parse_seconds', step=step), \
+                        tracer.span('parse', 'crawl', step=branch.step, url=branch.url):
+                    if self.parse_pool != None:
+                        record = self.parse_pool.parse(self.use_mode, branch.step, branch.url,
+                                                       data);
+                        children = self.applyRecord(branch, record);
+                    else:
+                        children = self.parsePage(branch, data);
+        except DownloadError as e:
+            registry.inc('pages_total', step=step, result='error');
+            branch.error = e;
+            if self.journal != None:
+                self.journal.fail(branch, e);
+            return;
+        
+        registry.inc('pages_total', step=step, result='ok');
+        if self.journal != None:
+            self.journal.finish(branch, children);
+        if self.index != None and branch.step == self.fmode.nsteps - 1:
+            self.index.addBranch(branch, self.fieldNames());
+        
+        for child in children:
+            if child.step < self.fmode.nsteps:
+                pool.submitFor(child.url, self._crawl, pool, child);
+    
+    def _refreshArticle(self, branch):
+        '''
+        Compare an article page's branch, before it is fetched, against the last snapshot of 
+        the issue, and fill in its fields from the snapshot if the table of contents lists the 
+        article just as it did then.
+        
+        @return: Returns 'unchanged' if the branch was filled in, 'added' or 'changed' if its 
+                page has to be fetched, or None if it isn't an article page.
+        '''
+        
+        if branch.step != self.fmode.nsteps - 1 or branch.parent == None:
+            return None;
+        
+        # Until its page is parsed, a branch only has the fields found for its link.
+        branch.fingerprint = TOCRefresh.fingerprint(branch.url, branch.fields);
+        report = self.report;
+        entry = None;
+        if report.previous != None:
+            entry = report.previous['articles'].get(branch.url);
+        
+        if entry == None:
+            result = 'added';
+        elif entry['fingerprint'] != branch.fingerprint:
+            result = 'changed';
+        else:
+            result = 'unchanged';
+            branch.fields = dict(entry['fields']);
+        
+        report.add(result, branch.url);
+        Metrics.registry.inc('refresh_articles_total', result=result);
+        return result;
+    
+    def finishCrawl(self, root):
+        '''
+        Wraps up a crawl from startCrawl once it has finished: writes anything
+        queued for the index and, when refreshing, works out which articles 
+        are no longer listed and saves the new snapshot of the issue.
+        
+        Articles whose pages failed keep what the last snapshot had for them,
+        if anything, so they are fetched again next time. If a page above the
+        articles failed, the articles it would have listed can't be told from 
+        removed ones, so none are taken as removed.
+        
+        @param root: The root Branch item returned by startCrawl.
+        @return: Returns the toc_refresh.RefreshReport, or None if not 
+                refreshing.
+        '''
+        
+        if self.index != None:
+            self.index.flush();
+        
+        if self.snapshots == None:
+            return None;
+        
+        report = self.report;
+        last = self.fmode.nsteps - 1;
+        previous = {'order' : [], 'articles' : {}, 'digest' : None};
+        if report.previous != None:
+            previous = report.previous;
+        
+        order = [];
+        articles = {};
+        listed = [];
+        complete = True;
+        for branch in root.walk():
+            if branch.step < last and branch.error != None:
+                complete = False;
+            if branch.step != last or branch.parent == None or branch.url in articles:
+                continue;
+            
+            listed.append((branch.url, branch.fingerprint));
+            entry = previous['articles'].get(branch.url);
+            if branch.error != None:
+                if entry == None:
+                    continue;
+            elif entry == None or entry['fingerprint'] != branch.fingerprint \
+                    or branch.fingerprint == None:
+                entry = {'fingerprint' : branch.fingerprint, 'fields' : dict(branch.fields), 
+                         'files' : []};
+            
+            order.append(branch.url);
+            articles[branch.url] = dict(entry);
+        
+        seen = set([url for url, fp in listed]);
+        for url in previous['order']:
+            if url in seen:
+                continue;
             
+            entry = previous['articles'][url];
+            if complete:
+                report.removed.append(url);
+                report.removed_files += [f[1] for f in entry['files'] if f != None];
+            else:
+                order.append(url);
+                articles[url] = dict(entry);
+        
+        Metrics.registry.inc('refresh_articles_total', len(report.removed), result='removed');
+        report.complete = complete;
+        report.digest = TOCRefresh.listDigest(listed);
+        self.snapshot = {
+                         'url' : root.url,
+                         'digest' : report.digest if complete else previous['digest'],
+                         'order' : order,
+                         'articles' : articles
+                         };
+        self.snapshots.save(self.use_mode, root.url, self.snapshot);
+        
+        return report;
+    
+    def fieldNames(self):
+        '''
+        @return: Returns the names of all the fields the mode finds, over every step.
+        '''
+        return unique([name for fields in self.fmode.fields for name, loc in fields]);
+    
+    def _restoreArticle(self, branch):
+        '''
+        Fill in an article page's fields from the index instead of fetching it, if the index 
+        has it under a DOI - looked up by the DOI if one was found on the way to the page, by 
+        its URL otherwise.
+        
+        @return: Returns True if the branch was filled in.
+        '''
+        
+        if branch.step != self.fmode.nsteps - 1:
+            return False;
+        
+        record = None;
+        if branch.getField('doi') != None:
+            record = self.index.get(branch.getField('doi'));
+        if record == None:
+            record = self.index.getURL(branch.url);
+        if record == None or record.get('doi') == None:
+            return False;
+        
+        for name, loc in self.fmode.fields[branch.step]:
+            if name in record:
+                branch.fields[name] = record[name];
+        
+        return True;
+    
+    def download(self, url, dest, checksum=None, retries=dflt_retries, 
+                 chunk_size=dflt_chunk_size):
+        '''
+        Download a file to disk, a chunk at a time, so the file is never held 
+        in memory. The data goes to dest + '.part' until it is complete, and a 
+        download which is interrupted (in this call or a previous run) carries
+        on from the end of the partial file with a Range request.
+        
+        The SHA-256 of the file is computed as the data is written.
+        
+        If there is a FileStore, the file is added to it and dest is made a 
+        link to it. A URL the store already has the file for, or a checksum
+        matching a file in the store, is linked without downloading anything.
+        
+        @param url: String, the absolute URL of the file.
+        @param dest: String, where to save the file.
+        @param checksum: String, the expected SHA-256 hex digest, if known.
+        @param retries: int, times to resume an interrupted download.
+        @param chunk_size: int, bytes read and written at a time.
+        @return: Returns a DownloadedFile item.
+        @raise DownloadError: Raised if the file could not be retrieved, or 
+                    with ERR_INTEGRITY if it doesn't match the checksum.
+        '''
+        
+        store = self.store;
+        if store != None:
+            if checksum != None and store.has(checksum):
+                digest = checksum.lower();
+            else:
+                digest = store.lookup(url);
+                
+            if digest != None and (checksum == None or checksum.lower() == digest):
+                store.remember(url, digest);
+                size = store.link(digest, dest);
+                Metrics.registry.inc('downloads_total', result='linked');
+                return DownloadedFile(url, dest, size, digest);
+        
+        start = time.time();
+        part = dest + '.part';
+        for attempt in range(retries + 1):
+            try:
+                size, digest = self._download(url, part, chunk_size);
+                break;
+            except DownloadError as e:
+                if e.err_code != DownloadError.ERR_FETCH or attempt == retries:
+                    raise;
+        
+        if checksum != None and checksum.lower() != digest:
+            os.remove(part);
+            raise DownloadError(DownloadError.ERR_INTEGRITY, 
+                                'Checksum mismatch for ' + url + ': ' + digest);
+        
+        if store != None:
+            store.add(part, digest, url);
+            store.link(digest, dest);
+        else:
+            if path.exists(dest) and os.name == 'nt':
+                os.remove(dest);
+            os.rename(part, dest);
+        
+        Metrics.registry.observe('download_seconds', time.time() - start);
+        Metrics.registry.inc('downloads_total', result='ok');
+        return DownloadedFile(url, dest, size, digest);
+    
+    def _download(self, url, part, chunk_size):
+        '''
+        A single attempt at download(), appending to the partial file.
+        
+        @return: Returns a tuple of the total size and the hex digest.
+        '''
+        
+        offset = 0;
+        if path.isfile(part):
+            offset = path.getsize(part);
+        
+        # Ranges are counted in encoded bytes, so ask for the file as it is.
+        headers = {'Accept-Encoding' : 'identity'};
+        if offset:
+            headers['Range'] = 'bytes=' + str(offset) + '-';
         
+        conn, resp, final = self.pool.open(url, headers);
+        decoder = None;
+        try:
+            total = None;
+            if resp.status == 206:
+                match = content_range.match(resp.getheader('content-range', ''));
+                if match == None or int(match.group(1)) != offset:
+                    # Not the range we asked for, start over.
+                    conn.discard();
+                    os.remove(part);
+                    raise DownloadError(DownloadError.ERR_FETCH, 
+                                        'Bad Content-Range for ' + url);
+                if match.group(3) != '*':
+                    total = int(match.group(3));
+            elif resp.status == 416 and offset:
+                # The previous attempt got everything but didn't get to rename the file.
+                resp.read();
+                conn.release(resp);
+                return offset, self._hashFile(part, chunk_size).hexdigest();
+            elif resp.status == 200:
+                offset = 0;
+                if resp.getheader('content-length') != None:
+                    total = int(resp.getheader('content-length'));
+            else:
+                resp.read();
+                conn.release(resp);
+                raise DownloadError(DownloadError.ERR_HTTP, 
+                                    'HTTP ' + str(resp.status) + ' retrieving ' + url);
+            
+            if offset:
+                digest = self._hashFile(part, chunk_size);
+                mode = 'ab';
+            else:
+                digest = hashlib.sha256();
+                mode = 'wb';
+            
+            # Servers which ignore the request for identity encoding can't be resumed, but can
+            # still be streamed.
+            decoder = ConnectionPool.decoder(resp.getheader('content-encoding'));
+            
+            size = offset;
+            received = 0;
+            with open(part, mode) as f:
+                while True:
+                    chunk = resp.read(chunk_size);
+                    if not chunk:
+                        break;
+                    received += len(chunk);
+                    
+                    if decoder != None:
+                        chunk = decoder.decompress(chunk);
+                    f.write(chunk);
+                    digest.update(chunk);
+                    size += len(chunk);
+                
+                if decoder != None:
+                    chunk = decoder.flush();
+                    f.write(chunk);
+                    digest.update(chunk);
+                    size += len(chunk);
+            
+            Metrics.registry.inc('download_bytes_total', received, host=conn.host.netloc);
+                    
+            # Content-Length counts the encoded bytes when there is an encoding.
+            if decoder != None:
+                got = received;
+            else:
+                got = size;
                 
+            if total != None and got < total:
+                raise httplib.IncompleteRead('', total - got);
+        except (httplib.HTTPException, socket.error, zlib.error) as e:
+            conn.discard();
+            if decoder != None and path.exists(part):
+                os.remove(part);
+            raise DownloadError(DownloadError.ERR_FETCH, 
+                                'Interrupted retrieving ' + url + ': ' + str(e));
+        except BaseException:
+            # Anything else, e.g. the partial file can't be written. The connection must still
+            # go back, or the host's slot is never freed. (Does nothing if it already has.)
+            conn.discard();
+            raise;
+        
+        conn.release(resp);
+        return size, digest.hexdigest();
+    
+    def _hashFile(self, fname, chunk_size):
+        digest = hashlib.sha256();
+        with open(fname, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size);
+                if not chunk:
+                    break;
+                digest.update(chunk);
+        
+        return digest;
+    
+    def downloadPDFs(self, root, location=None):
+        '''
+        Download the article PDFs and supplementary PDFs found in a tree 
+        returned by parseStep, on a CrawlPool of self.workers threads. Each 
+        article's files are listed, in order, in the files property of its 
+        branch.
+        
+        @param root: The Branch item returned by parseStep.
+        @param location: String, the directory to save the files in. Defaults
+                    to download_loc.
+        @return: Returns the list of DownloadedFile items, in article order.
+        '''
+        
+        pool = CrawlPool(self.workers);
+        try:
+            jobs = self.queueDownloads(pool, root, location);
+            pool.join();
+        finally:
+            pool.close();
+        
+        return self.finishDownloads(jobs, location);
+    
+    def finishDownloads(self, jobs, location=None):
+        '''
+        Collects the files downloaded by jobs from queueDownloads, once they 
+        have all finished, and writes the manifest if there is a FileStore.
+        
+        @param jobs: The list returned by queueDownloads.
+        @param location: String, the directory the files were saved in.
+        @return: Returns the list of DownloadedFile items, in article order.
+        '''
+        
+        if location == None:
+            location = self.download_loc;
+        
+        files = [branch.files[i] for branch, i, url, dest in jobs if branch.files[i] != None];
+        if self.store != None:
+            FileStore.writeManifest(path.join(location, manifest_name), files);
+        if self.index != None:
+            self.index.flush();
+        if self.snapshot != None:
+            self._saveFiles(jobs, location);
+        
+        return files;
+    
+    def queueDownloads(self, pool, root, location=None):
+        '''
+        Queues the downloads for downloadPDFs on a pool, without waiting for 
+        them.
+        
+        @param pool: CrawlPool (or anything with its submitFor method) to run 
+                    the downloads on.
+        @param root: The Branch item returned by parseStep.
+        @param location: String, the directory to save the files in. Defaults
+                    to download_loc.
+        @return: Returns the list of queued jobs, as (branch, index in the 
+                branch's files, URL, destination) tuples. Files the journal 
+                or the index has a record of, which are still where they were
+                saved, are included but not queued again. Files found through
+                the index are left where they are, rather than appearing at
+                their destination. When refreshing, the files of articles 
+                which haven't changed are moved to their destinations instead 
+                of being downloaded again.
+        '''
+        
+        if location == None:
+            location = self.download_loc;
+        
+        if location and not path.isdir(location):
+            os.makedirs(location);
+        
+        jobs = [];
+        for branch in root.leaves():
+            urls = [];
+            if branch.getField('pdf') != None:
+                urls.append(branch.getField('pdf'));
+            urls += branch.getField('supp_pdf', []);
             
+            branch.files = [None]*len(urls);
+            for i, url in enumerate(urls):
+                url = urlparse.urljoin(branch.url, url);
+                fname = str(len(jobs)).zfill(4) + '_' + fileName(url);
+                jobs.append((branch, i, url, path.join(location, fname)));
+        
+        if self.snapshot != None:
+            self._reuseFiles(jobs);
+        
+        for job in jobs:
+            if job[0].files[job[1]] != None:
+                continue;
+            if self.journal != None and self._restoreFile(*job):
+                continue;
+            if self.index != None and self._indexedFile(*job):
+                continue;
+            pool.submitFor(job[2], self._downloadTask, *job);
+        
+        return jobs;
+    
+    def _reuseFiles(self, jobs):
+        '''
+        Fill in the files of articles which haven't changed since the last snapshot with the 
+        ones downloaded for them then, if they are still there, moving them to their new 
+        destinations - which shift when articles are added or removed before them. Files are
+        only reused from the directory they are going to.
+        
+        Every file is moved aside before any is moved into place, so none is overwritten by 
+        another. A file which can't be moved is downloaded again.
+        '''
+        
+        articles = self.snapshot['articles'];
+        moves = [];
+        for branch, i, url, dest in jobs:
+            entry = articles.get(branch.url);
+            if branch.fingerprint == None or entry == None or \
+                    entry['fingerprint'] != branch.fingerprint or i >= len(entry['files']) or \
+                    entry['files'][i] == None:
+                continue;
+            
+            furl, fpath, size, checksum = entry['files'][i];
+            same_dir = path.dirname(path.abspath(fpath)) == path.dirname(path.abspath(dest));
+            if furl != url or not same_dir or not path.isfile(fpath) or \
+                    path.getsize(fpath) != size:
+                continue;
+            
+            moves.append((branch, i, url, dest, fpath, size, checksum));
+        
+        moved = [];
+        for move in moves:
+            branch, i, url, dest, fpath, size, checksum = move;
+            try:
+                if fpath != dest:
+                    os.rename(fpath, dest + '.moving');
+                moved.append(move);
+            except OSError:
+                pass;
+        
+        for branch, i, url, dest, fpath, size, checksum in moved:
+            try:
+                if fpath != dest:
+                    if os.name == 'nt' and path.exists(dest):
+                        os.remove(dest);
+                    os.rename(dest + '.moving', dest);
+            except OSError:
+                continue;
+            
+            branch.files[i] = DownloadedFile(url, dest, size, checksum);
+            Metrics.registry.inc('downloads_total', result='unchanged');
+    
+    def _saveFiles(self, jobs, location):
+        '''
+        Record the files of the articles in the snapshot saved by finishCrawl, and save it again.
+        The files the last snapshot had for articles which have been removed, or whose files 
+        have all been downloaded again, are deleted if they are in the same directory and 
+        nothing has taken their place.
+        '''
+        
+        articles = self.snapshot['articles'];
+        current = set();
+        files = {};
+        for branch, i, url, dest in jobs:
+            current.add(path.abspath(dest));
+            if branch.url not in articles:
+                continue;
+            
+            f = branch.files[i];
+            if branch.url not in files:
+                files[branch.url] = [None]*len(branch.files);
+            if f != None:
+                current.add(path.abspath(f.path));
+                files[branch.url][i] = [f.url, f.path, f.size, f.checksum];
+        
+        for url, entry in files.items():
+            articles[url]['files'] = entry;
+        self.snapshots.save(self.use_mode, self.snapshot['url'], self.snapshot);
+        
+        previous = self.report.previous;
+        if previous == None:
+            return;
+        
+        location = path.abspath(location);
+        for url, entry in previous['articles'].items():
+            if url in articles and (url not in files or None in files[url]):
+                continue;
+            
+            for f in entry['files']:
+                if f == None:
+                    continue;
+                fpath = path.abspath(f[1]);
+                if fpath in current or path.dirname(fpath) != location or not path.isfile(fpath):
+                    continue;
+                try:
+                    os.remove(fpath);
+                except OSError:
+                    pass;
+    
+    def _restoreFile(self, branch, i, url, dest):
+        '''
+        Fill in a file from the journal if it was already downloaded to dest.
+        
+        @return: Returns True if it was.
+        '''
+        
+        record = self.journal.getFile(branch, i);
+        if record == None:
+            return False;
+        
+        rurl, rpath, size, checksum = record;
+        if rurl != url or rpath != dest or not path.isfile(dest) or path.getsize(dest) != size:
+            return False;
+        
+        branch.files[i] = DownloadedFile(url, dest, size, checksum);
+        Metrics.registry.inc('downloads_total', result='journal');
+        return True;
+    
+    def _indexedFile(self, branch, i, url, dest):
+        '''
+        Fill in a file from the index if it was downloaded for the article's DOI before, and is
+        still where it was saved.
+        
+        @return: Returns True if it was.
+        '''
+        
+        doi = branch.getField('doi');
+        if doi == None:
+            return False;
+        
+        record = self.index.getFile(doi, url);
+        if record == None:
+            return False;
+        
+        fpath, size, checksum = record;
+        if not path.isfile(fpath) or path.getsize(fpath) != size:
+            return False;
+        
+        branch.files[i] = DownloadedFile(url, fpath, size, checksum);
+        Metrics.registry.inc('downloads_total', result='indexed');
+        return True;
+    
+    def _downloadTask(self, branch, i, url, dest):
+        try:
+            with Tracing.tracer.span('download', 'download', url=url):
+                branch.files[i] = self.download(url, dest);
+            if self.journal != None and branch.journal_id != None:
+                self.journal.addFile(branch, i, branch.files[i]);
+            if self.index != None:
+                self.index.addFile(branch.getField('doi'), branch.files[i]);
+        except Exception as e:
+            # Not just failed downloads - the journal or index failing to record one too.
+            Metrics.registry.inc('downloads_total', result='error');
+            if branch.error == None:
+                branch.error = e;
+
+
+class Branch:
+    '''
+    A single node in the tree built by PDFDownloader.parseStep: one page at one step, the 
+    information found for it and a branch for each link found on its page.
+    '''
+    
+    url = None;
+    step = 0;
+    parent = None;
+    error = None;
+    files = ();
+    journal_id = None;      # The branch's id in a crawl_journal.CrawlJournal.
+    fingerprint = None;     # See toc_refresh.fingerprint, set for articles when refreshing.
+    
+    def __init__(self, url, step, parent=None):
+        '''
+        @param url: String, the absolute URL of the page.
+        @param step: int, the step the page belongs to (0-based index).
+        @param parent: The Branch this was linked from, or None for the root.
+        '''
+        
+        self.url = url;
+        self.step = step;
+        self.parent = parent;
+        self.fields = {};
+        self.children = [];
+    
+    def setField(self, name, values):
+        '''
+        Store the values found for a field. Fields listed in fetchMode.listFields keep the full 
+        list, the others keep only the first value (None if nothing was found).
+        
+        @param name: String, the field name (see fetchMode.stepFields).
+        @param values: List of strings.
+        '''
+        
+        if name in SettingsManager.fetchMode.listFields:
+            self.fields[name] = values;
+        elif len(values):
+            self.fields[name] = values[0];
+        else:
+            self.fields[name] = None;
+    
+    def getField(self, name, default=None):
+        '''
+        Look up a field on this branch, or failing that on the nearest branch above it that has it.
+        '''
+        
+        branch = self;
+        while branch != None:
+            if name in branch.fields:
+                return branch.fields[name];
+            branch = branch.parent;
+        
+        return default;
+    
+    def walk(self):
+        '''
+        Generator over this branch and all the branches below it, depth first, in page order.
+        '''
+        
+        stack = [self];
+        while len(stack):
+            branch = stack.pop();
+            yield branch;
+            stack.extend(reversed(branch.children));
+    
+    def leaves(self):
+        '''
+        Generator over the branches at the bottom of the tree (generally the articles), in order.
+        '''
+        
+        for branch in self.walk():
+            if len(branch.children) == 0:
+                yield branch;
+
+
+class StreamExtractor:
+    '''
+    Parses a page incrementally, as chunks of it are fed in, and keeps only the subtrees rooted at
+    elements matching the first tag of one of a set of locations. Everything outside them is 
+    thrown away as soon as it has been parsed, so memory use depends on the size of the parts of
+    the page the mode looks at rather than on the size of the page.
+    
+    The kept subtrees are collected, in document order, under a single element, on which the 
+    locations can be evaluated as on the full page.
+    '''
+    
+    def __init__(self, roots, html=True):
+        '''
+        @param roots: List of fetchMode.Loc items whose first tags mark the subtrees to keep (see
+                    fetchMode.stepRoots).
+        @param html: Boolean, True to parse as HTML, False for XML.
+        '''
+        
+        self.roots = roots;
+        if html:
+            self.parser = etree.HTMLPullParser(events=('start', 'end'));
+        else:
+            self.parser = etree.XMLPullParser(events=('start', 'end'));
+        
+        self.kept = etree.Element('kept');
+        self.depth = 0;     # How deep we are inside a kept subtree, 0 if outside.
+    
+    def feed(self, data):
+        '''
+        Parse the next chunk of the page.
+        
+        @param data: String, the chunk.
+        '''
+        
+        self.parser.feed(data);
+        self._process();
+    
+    def close(self):
+        '''
+        Finish parsing.
+        
+        @return: Returns the element containing the kept subtrees.
+        '''
+        
+        self.parser.close();
+        self._process();
+        return self.kept;
+    
+    def _process(self):
+        for event, element in self.parser.read_events():
+            if event == 'start':
+                if self.depth:
+                    self.depth += 1;
+                else:
+                    for loc in self.roots:
+                        if loc.isItem(element):
+                            self.depth = 1;
+                            break;
+            elif self.depth:
+                self.depth -= 1;
+                if self.depth == 0:
+                    self.kept.append(element);
+            else:
+                # Nothing under here is needed - any kept subtrees have already been moved out.
+                element.clear();
+                while element.getprevious() is not None:
+                    del element.getparent()[0];
+
+
+class ParsePool:
+    '''
+    A pool of worker processes for parsing pages, so that parsing isn't held to one core by the 
+    GIL. Pages are sent to the workers as strings and only the text found on them comes back 
+    (see extractRecord), never the parsed tree. Each worker loads a mode the first time it is 
+    given a page for it and keeps it for the rest of its life.
+    
+    The crawl threads still do the fetching, and each waits for the page it sent, so the pool 
+    should have about as many processes as there are cores. Create it before starting anything 
+    that uses threads, since the workers are forked from the process as it is at that point.
+    '''
+    
+    def __init__(self, processes=None):
+        '''
+        @param processes: int, the number of worker processes. Defaults to the number of cores.
+        '''
+        
+        self.pool = multiprocessing.Pool(processes);
+    
+    def parse(self, use_mode, step, url, data):
+        '''
+        Parse a page in one of the workers.
+        
+        @param use_mode: String, hash key to the journal settings.
+        @param step: int, the step the page belongs to (0-based index).
+        @param url: String, the absolute URL of the page.
+        @param data: String, the page contents.
+        @return: Returns the record of what was found on the page (see extractRecord).
+        @raise DownloadError: Raised if the page could not be parsed.
+        '''
+        
+        tracer = Tracing.tracer;
+        record, recorded = self.pool.apply(_parseTask, (use_mode, step, url, data, 
+                                                        tracer.enabled));
+        tracer.extend(recorded);
+        if record == None:
+            raise DownloadError(DownloadError.ERR_PARSE);
+        
+        return record;
+    
+    def close(self):
+        '''
+        Stop the workers.
+        '''
+        
+        self.pool.close();
+        self.pool.join();
+    
+    def __enter__(self):
+        return self;
+    
+    def __exit__(self, *args):
+        self.close();
+
+
+_worker_modes = {};     # use_mode -> (fetchMode, parsers by step), in a ParsePool worker.
+
+def _parseTask(use_mode, step, url, data, trace=False):
+    '''
+    ParsePool task - parse a page and extract its record, or None if it can't be parsed.
+    
+    @param trace: bool, whether to trace the work done, as the process sending it does.
+    @return: Returns a tuple of the record and the trace events recorded (see Tracer.drain).
+    '''
+    
+    tracer = Tracing.tracer;
+    tracer.enabled = trace;
+    with tracer.span('parse_worker', 'parse', step=step, url=url):
+        if use_mode not in _worker_modes:
+            fmode = SettingsManager.SettingsReader().getMode(use_mode);
+            _worker_modes[use_mode] = (fmode, [p.copy() for p in fmode.sparsers]);
+        fmode, parsers = _worker_modes[use_mode];
+        
+        try:
+            tree = etree.fromstring(data, parsers[step], base_url=url);
+        except etree.LxmlError:
+            tree = None;
+        
+        record = None;
+        if tree is not None:
+            record = extractRecord(fmode, step, url, tree);
+    
+    return (record, tracer.drain());
+
+
+def extractRecord(fmode, step, url, tree):
+    '''
+    Evaluates a mode's locations for a step on a parsed page.
+    
+    Fields whose location starts from the same tag as the link location (e.g. the 'article' 
+    holding both the title and the link on a table of contents) belong to the child branch for 
+    that link, all others belong to the page's own branch.
+    
+    All the locations are found in a single walk of the page by the step's LocTrie (see 
+    fetchMode.stepTrie), rather than each searching the page for itself.
+    
+    @param fmode: The fetchMode.
+    @param step: int, the step the page belongs to (0-based index).
+    @param url: String, the absolute URL of the page.
+    @param tree: The parsed page.
+    @return: Returns a tuple of the page's fields, as a list of (field name, list of strings) 
+            tuples, and a list of (absolute URL, fields) tuples for its links to the next step, in 
+            page order. Only plain lists, tuples and strings, so it can be pickled.
+    '''
+    
+    ll = None;
+    if step < len(fmode.links):
+        ll = fmode.links[step];
+    
+    page_fields = fmode.fields[step];
+    item_fields = [];
+    if ll != None:
+        root = ll.tags[0].predicate();
+        item_fields = [(name, loc) for name, loc in page_fields 
+                       if loc.tags[0].predicate() == root];
+        page_fields = [(name, loc) for name, loc in page_fields 
+                       if loc.tags[0].predicate() != root];
+    
+    trie = fmode.tries[step];
+    if trie == None:
+        return _extractEach(step, url, tree, ll, page_fields, item_fields);
+    
+    # The trie's locations are the link, if any, then the fields in fmode.fields order.
+    index = dict([(name, i + (ll != None)) for i, (name, loc) in enumerate(fmode.fields[step])]);
+    
+    with Tracing.tracer.span('locs', 'extract', step=step, locs=len(trie.locs)):
+        origins, found = trie.match(tree);
+    
+    fields = [(name, trie.text(found, index[name])) for name, loc in page_fields];
+    
+    items = [];
+    if ll != None:
+        links = trie.byOrigin(found, 0);
+        values = [(name, trie.byOrigin(found, index[name])) for name, loc in item_fields];
+        for origin in origins:
+            if origin not in links:
+                continue;
+            
+            items.append((urlparse.urljoin(url, links[origin][0]),
+                          [(name, by_origin.get(origin, [])) for name, by_origin in values]));
+    
+    return (fields, items);
+
+def _extractEach(step, url, tree, ll, page_fields, item_fields):
+    '''
+    extractRecord for steps without a LocTrie, evaluating the locations one by one.
+    '''
+    
+    tracer = Tracing.tracer;
+    fields = [];
+    for name, loc in page_fields:
+        with tracer.span('loc', 'extract', step=step, field=name):
+            fields.append((name, loc.text(tree)));
+    
+    items = [];
+    if ll != None:
+        with tracer.span('links', 'extract', step=step, fields=len(item_fields)) as span:
+            for item in ll.items(tree):
+                links = ll.text(item, True);
+                if len(links) == 0:
+                    continue;
+                
+                items.append((urlparse.urljoin(url, links[0]),
+                              [(name, loc.text(item, True)) for name, loc in item_fields]));
+            
+            if tracer.enabled:
+                span.args['links'] = len(items);
+    
+    return (fields, items);
+
+
+class DownloadedFile:
+    '''
+    A file saved by PDFDownloader.download.
+    '''
+    
+    def __init__(self, url, path, size, checksum):
+        '''
+        @param url: String, where it was downloaded from.
+        @param path: String, where it was saved.
+        @param size: int, the size in bytes.
+        @param checksum: String, the SHA-256 hex digest.
+        '''
+        
+        self.url = url;
+        self.path = path;
+        self.size = size;
+        self.checksum = checksum;
+
+
+def fileName(url):
+    '''
+    A file name for a downloaded file, from the last part of its URL.
+    
+    @param url: String, the URL.
+    @return: Returns the file name, with anything unsafe replaced by '_'.
+    '''
+    
+    name = urlparse.urlsplit(url).path.rstrip('/').split('/')[-1];
+    name = re.sub(r'[^A-Za-z0-9._-]', '_', name).lstrip('.');
+    if name == '':
+        name = hashlib.sha1(url).hexdigest()[:12];
+    if not name.lower().endswith('.pdf'):
+        name += '.pdf';
+    
+    return name;
+
+
+class CrawlPool:
+    '''
+    A bounded pool of worker threads. Tasks are allowed to submit further tasks, and join() only
+    returns once every task, including those submitted along the way, has finished.
+    '''
+    
+    def __init__(self, workers=dflt_workers):
+        '''
+        Starts the worker threads.
+        
+        @param workers: int, the number of threads.
+        '''
+        
+        self.queue = Queue.Queue();
+        self.errors = [];
+        self.threads = [];
+        
+        self.name = str(id(self));
+        Metrics.registry.set('crawl_queue_depth', self.queue.qsize, pool=self.name);
+        
+        for i in range(max(1, workers)):
+            thread = threading.Thread(target=self._work);
+            thread.daemon = True;
+            thread.start();
+            self.threads.append(thread);
+    
+    def submit(self, func, *args):
+        '''
+        Queue func(*args) to be run on one of the workers.
+        '''
+        self.queue.put((func, args));
+    
+    def submitFor(self, url, func, *args):
+        '''
+        Queue func(*args), a task which makes a request to url. The URL is 
+        ignored here, but lets schedulers which limit requests per host (see 
+        batch_download.HostScheduler) be used in place of this pool.
+        '''
+        self.submit(func, *args);
+    
+    def join(self):
+        '''
+        Wait for all the queued tasks to finish.
+        '''
+        self.queue.join();
+    
+    def close(self):
+        '''
+        Stop the workers once the queue is drained.
+        '''
+        
+        for thread in self.threads:
+            self.queue.put(None);
+        
+        for thread in self.threads:
+            thread.join();
+            
+        self.threads = [];
+        Metrics.registry.remove('crawl_queue_depth', pool=self.name);
+    
+    def _work(self):
+        while True:
+            task = self.queue.get();
+            try:
+                if task == None:
+                    return;
+                
+                func, args = task;
+                try:
+                    func(*args);
+                except Exception as e:
+                    # Tasks are expected to handle their own errors, but a worker should never die.
+                    self.errors.append(e);
+            finally:
+                self.queue.task_done();
@@ -81,5 +81,38 @@ class ModeException(JSError):
     _err_strings = {
         ERR_NO_LINK : "Link locations must be specified from the first link to the page containing the PDF.",
         ERR_NO_TAG : "No tag was specified in a Mode XML location list."
-                    };  
-         
+                    };
+
+class DownloadError(JSError):
+    '''
+    Class for errors in fetching and parsing pages in download_pdfs.
+    '''
+    
+    ERR_FETCH = -2;
+    ERR_PARSE = -3;
+    ERR_HTTP = -4;
+    ERR_REDIRECT = -5;
+    ERR_INTEGRITY = -6;
+    
+    _err_strings = {
+        ERR_FETCH : "The page could not be retrieved.",
+        ERR_PARSE : "The page could not be parsed with the mode's parser.",
+        ERR_HTTP : "The server responded with an error status.",
+        ERR_REDIRECT : "The request was redirected too many times.",
+        ERR_INTEGRITY : "The downloaded file does not match its expected checksum."
+                    };
+
+class PDFError(JSError):
+    '''
+    Class for errors in reading and writing PDF files.
+    '''
+    
+    ERR_BAD_PDF = -2;
+    ERR_ENCRYPTED = -3;
+    ERR_FILTER = -4;
+    
+    _err_strings = {
+        ERR_BAD_PDF : "The file is not a PDF, or is too badly damaged to read.",
+        ERR_ENCRYPTED : "Encrypted PDFs are not supported.",
+        ERR_FILTER : "The PDF uses a stream filter which is not supported."
+                    };
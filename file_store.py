@@ -0,0 +1,182 @@
+"""
+Library for keeping downloaded files by the hash of their content, so a PDF served under several
+URLs, or a supplementary file repeated across issues, is only stored (and, once its URL is known,
+only downloaded) once. Each issue's files are then made to appear where PDFDownloader would have
+saved them as hard links into the store.
+
+@author: SquidneyPoitier <squidney.poitier@gmail.com>
+@version: 0.1
+"""
+
+from os import path;
+import json;
+import os;
+import shutil;
+import threading;
+
+dflt_store_location = path.join(path.dirname(path.abspath(__file__)), 'store');
+index_name = 'urls.log';
+
+class FileStore:
+    '''
+    Thread-safe content-addressed file store. Files are kept under objects/, named by their
+    SHA-256 and sharded into two levels of directories by its first four hex digits, e.g.
+    objects/3f/a9/3fa9....
+
+    The store also remembers which URL gave which file, in an append-only log of JSON lines, so
+    a URL already downloaded in any earlier run can be linked straight from the store.
+    '''
+
+    def __init__(self, location=dflt_store_location):
+        '''
+        Opens the store, creating it if needed, and reads the URL index.
+
+        @param location: String, the store directory.
+        '''
+
+        self.location = location;
+        self.lock = threading.Lock();
+        self.urls = {};         # URL -> SHA-256 hex digest
+
+        self.stored = 0;        # Files added which weren't already in the store.
+        self.duplicates = 0;    # Files added which were.
+        self.skipped = 0;       # Downloads avoided because the URL or checksum was known.
+
+        objects = path.join(location, 'objects');
+        if not path.isdir(objects):
+            os.makedirs(objects);
+
+        self.index = path.join(location, index_name);
+        if path.isfile(self.index):
+            with open(self.index, 'rb') as f:
+                for line in f:
+                    try:
+                        url, digest = json.loads(line);
+                    except ValueError:
+                        # A line cut short by a crash.
+                        continue;
+                    self.urls[url] = digest;
+
+    def objectFile(self, digest):
+        '''
+        @param digest: String, the SHA-256 hex digest.
+        @return: Returns the location of the file with that hash in the store.
+        '''
+
+        digest = digest.lower();
+        return path.join(self.location, 'objects', digest[0:2], digest[2:4], digest);
+
+    def has(self, digest):
+        return path.isfile(self.objectFile(digest));
+
+    def lookup(self, url):
+        '''
+        @param url: String, the absolute URL.
+        @return: Returns the SHA-256 of the file last downloaded from the URL, or None if it
+                hasn't been, or the file is no longer in the store.
+        '''
+
+        with self.lock:
+            digest = self.urls.get(url);
+
+        if digest == None or not self.has(digest):
+            return None;
+
+        return digest;
+
+    def add(self, fname, digest, url=None):
+        '''
+        Move a file into the store. If a file with the same hash is already there, the new one
+        is deleted instead.
+
+        @param fname: String, the file to add.
+        @param digest: String, its SHA-256 hex digest.
+        @param url: String, the URL it was downloaded from, to record in the index.
+        @return: Returns the location of the file in the store.
+        '''
+
+        dest = self.objectFile(digest);
+        with self.lock:
+            if path.isfile(dest):
+                os.remove(fname);
+                self.duplicates += 1;
+            else:
+                if not path.isdir(path.dirname(dest)):
+                    os.makedirs(path.dirname(dest));
+                shutil.move(fname, dest);
+                self.stored += 1;
+
+            if url != None and self.urls.get(url) != digest:
+                self.urls[url] = digest;
+                with open(self.index, 'ab') as f:
+                    f.write(json.dumps([url, digest]) + '\n');
+
+        return dest;
+
+    def remember(self, url, digest):
+        '''
+        Record that a URL gives a file already in the store, and count the download it saved.
+        '''
+
+        with self.lock:
+            self.skipped += 1;
+            if self.urls.get(url) != digest:
+                self.urls[url] = digest;
+                with open(self.index, 'ab') as f:
+                    f.write(json.dumps([url, digest]) + '\n');
+
+    def link(self, digest, dest):
+        '''
+        Make a file in the store appear at dest, as a hard link where possible and as a copy
+        where not (e.g. across file systems). Anything already at dest is replaced.
+
+        @param digest: String, the SHA-256 hex digest of a file in the store.
+        @param dest: String, where the file should appear.
+        @return: Returns the size of the file.
+        '''
+
+        src = self.objectFile(digest);
+        if path.lexists(dest):
+            os.remove(dest);
+
+        try:
+            os.link(src, dest);
+        except (AttributeError, OSError):
+            shutil.copyfile(src, dest);
+
+        return path.getsize(src);
+
+    def stats(self):
+        '''
+        @return: Dictionary with the number of 'urls' in the index, and counts of files 'stored',
+                'duplicates' found already in the store, and downloads 'skipped'.
+        '''
+
+        with self.lock:
+            return {
+                    'urls' : len(self.urls),
+                    'stored' : self.stored,
+                    'duplicates' : self.duplicates,
+                    'skipped' : self.skipped
+                    };
+
+
+def writeManifest(fname, files):
+    '''
+    Write a JSON manifest of downloaded files, saying where each came from and what it contains.
+
+    @param fname: String, the manifest to write.
+    @param files: List of download_pdfs.DownloadedFile items.
+    '''
+
+    entries = [];
+    for f in files:
+        entries.append({
+                        'url' : f.url,
+                        'path' : path.basename(f.path),
+                        'size' : f.size,
+                        'sha256' : f.checksum
+                        });
+
+    with open(fname, 'wb') as f:
+        json.dump(entries, f, indent=1);
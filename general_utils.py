@@ -20,4 +20,37 @@ def boolString(val):
     @return: Boolean of whether or not it's true.
     '''
     
-    return val.lower() in ['true', 't', '1', 'yes', 'y'];
\ No newline at end of file
+    return val.lower() in ['true', 't', '1', 'yes', 'y'];
+
+def xpathLiteral(val):
+    '''
+    Quotes a string for use as a literal in an XPath expression. XPath 1.0 has no escape characters,
+    so strings containing both kinds of quote are built up with concat().
+    
+    @param val: String to quote.
+    @return: String, the XPath literal.
+    '''
+    
+    if "'" not in val:
+        return "'" + val + "'";
+    elif '"' not in val:
+        return '"' + val + '"';
+    
+    return "concat('" + val.replace("'", "', \"'\", '") + "')";
+
+def unique(items):
+    '''
+    Removes repeated items from a list, keeping the first of each.
+    
+    @param items: List of hashable items.
+    @return: Returns a new list, in the original order.
+    '''
+    
+    seen = set();
+    out = [];
+    for item in items:
+        if item not in seen:
+            seen.add(item);
+            out.append(item);
+    
+    return out;
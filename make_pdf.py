@@ -1,8 +1,691 @@
 """
-Library for taking individual PDFs and building them into a single PDF, 
+Library for taking individual PDFs and building them into a single PDF,
 checking for duplicate pages and trying to assemble them in the right order.
 
 @author: SquidneyPoitier <squidney.poitier@gmail.com>
 @version: 0.1
 
-"""
\ No newline at end of file
+"""
+
+import pdf_file as PDFFile;
+from pdf_file import Ref, Name, Stream;
+from error_handling import PDFError;
+import metrics as Metrics;
+import tracing as Tracing;
+from collections import deque;
+import bisect;
+import hashlib;
+import heapq;
+import os;
+import re;
+
+re_content_ws = re.compile(r'[\x00\t\n\x0c\r ]+');
+re_page_range = re.compile(ur'([A-Za-z]*)\s*(\d+)(?:\s*[-\u2010-\u2015]+\s*([A-Za-z]*)\s*(\d+))?',
+                           re.UNICODE);
+re_digits = re.compile(r'^\s*(\d+)\s*$');
+
+resource_depth = 3;     # How deep into a page's resources fingerprints look.
+
+class PDFMerger:
+    '''
+    Merges PDFs into a single output file, one input at a time. Each input's pages, and every
+    object they refer to, are renumbered and written to the output as they are read, and the
+    input is closed before the next one is opened. The only things kept for the whole run are
+    the offset of each object written and a reference to each page, so memory use does not grow
+    with the size of the inputs.
+
+    Duplicate pages (such as a page shared by two neighbouring articles) can be skipped. Each page
+    is fingerprinted and looked up in an index of the fingerprints of the pages added from earlier
+    inputs, so finding duplicates takes a single pass however many pages there are. Repeated pages
+    within one input (blank pages, separators, etc.) are the article's own, and are kept.
+
+    Pages can also be added to a PDF that has already been merged, as an incremental update: the
+    new objects, a new root for the page tree and a new cross-reference section are appended to
+    the end of the file, and everything already in it is left as it is.
+    '''
+
+    def __init__(self, output, version='1.7', skip_duplicates=True, update=False):
+        '''
+        Opens the output and writes the PDF header.
+
+        @param output: String, the location of the merged PDF.
+        @param version: String, the PDF version for the header.
+        @param skip_duplicates: Boolean, whether to leave out pages identical to one already added.
+        @param update: Boolean, True to add pages to the end of output, which must already be a
+                    PDF, rather than overwrite it.
+        @raise PDFError: Raised if updating and the existing output can't be read.
+        '''
+
+        self.output = output;
+        self.closed = False;
+
+        self.skip_duplicates = skip_duplicates;
+        self.index = {};        # Fingerprint -> (file name, page number) of the first page seen.
+        self.dropped = [];      # DroppedPage items, in the order found.
+
+        self.kids = [];         # Children of the root of the page tree.
+        self.count = 0;         # Number of pages under them.
+        self.pages = [];        # The pages added.
+        self.trailer = {};
+
+        if update:
+            self.openUpdate();
+            return;
+
+        self.f = open(output, 'wb');
+        self.writer = PDFFile.PDFWriter(self.f, version);
+        self.start = None;
+
+        # Written last, once all the pages are known.
+        self.catalog = self.writer.allocate();
+        self.pages_root = self.writer.allocate();
+        self.root_dict = {Name('Type') : Name('Pages')};
+
+    def openUpdate(self):
+        '''
+        Read what's needed of the existing output - its trailer, the root of its page tree and, if
+        skipping duplicates, the fingerprints of its pages - then open it for appending.
+        '''
+
+        reader = PDFFile.PDFReader(self.output);
+        try:
+            if reader.startxref == None:
+                raise PDFError(PDFError.ERR_BAD_PDF, 'Cannot update damaged file ' + self.output);
+
+            catalog = reader.resolve(reader.trailer['Root']);
+            pages_root = catalog.get('Pages') if isinstance(catalog, dict) else None;
+            root_dict = reader.resolve(pages_root);
+            if not isinstance(pages_root, Ref) or not isinstance(root_dict, dict):
+                raise PDFError(PDFError.ERR_BAD_PDF, 'No page tree in ' + self.output);
+
+            self.catalog = reader.trailer['Root'].num;
+            self.pages_root = pages_root.num;
+            self.root_dict = dict(root_dict);
+            self.kids = list(reader.resolve(self.root_dict.pop('Kids', [])));
+            self.count = reader.resolve(self.root_dict.pop('Count', len(self.kids)));
+            for key in ('Info', 'ID'):
+                if key in reader.trailer:
+                    self.trailer[key] = reader.trailer[key];
+
+            if self.skip_duplicates:
+                fingerprinter = Fingerprinter(reader);
+                for i, (ref, page) in enumerate(reader.pages()):
+                    try:
+                        self.index.setdefault(fingerprinter.page(page), (self.output, i + 1));
+                    except PDFError:
+                        pass;
+
+            update = (reader.trailer['Size'], reader.startxref);
+            xref_stream = reader.xref_stream;
+            gens = reader.gens;
+        finally:
+            reader.close();
+
+        self.f = open(self.output, 'r+b');
+        self.f.seek(0, 2);
+        self.start = self.f.tell();
+        self.writer = PDFFile.PDFWriter(self.f, update=update, xref_stream=xref_stream, gens=gens);
+
+        # The update must start on a new line.
+        self.f.seek(-1, 2);
+        if self.f.read(1) not in '\r\n':
+            self.writer.write('\n');
+
+    def append(self, fname):
+        '''
+        Append all the pages of a PDF.
+
+        @param fname: String, the location of the PDF.
+        @return: Returns the number of pages added.
+        @raise PDFError: Raised if the file can't be read. Nothing is written to the output in
+                    that case unless the file is damaged part way through its pages.
+        '''
+
+        registry = Metrics.registry;
+        tracer = Tracing.tracer;
+        with registry.timer('merge_file_seconds'), tracer.span('merge_file', 'merge', file=fname):
+            reader = PDFFile.PDFReader(fname);
+            try:
+                with tracer.span('read_pages', 'merge'):
+                    pages = list(reader.pages());
+                total = len(pages);
+                if self.skip_duplicates:
+                    with tracer.span('remove_duplicates', 'merge', pages=total):
+                        pages = self.removeDuplicates(reader, fname, pages);
+
+                with tracer.span('copy_pages', 'merge', pages=len(pages)):
+                    count = self.copyPages(reader, pages);
+            finally:
+                reader.close();
+
+        registry.inc('merge_pages_total', count);
+        registry.inc('merge_duplicates_total', total - count);
+        registry.inc('merge_input_bytes_total', os.path.getsize(fname));
+        return count;
+
+    def removeDuplicates(self, reader, fname, pages):
+        '''
+        Filter out the pages identical to ones added from earlier files, recording each one left
+        out in self.dropped. The rest are added to the index once the whole file has been looked
+        up, so pages repeated within the file are all kept.
+
+        @param reader: The PDFReader.
+        @param fname: String, the location of the PDF, for the report.
+        @param pages: List of (Ref, page dictionary) tuples from reader.pages().
+        @return: Returns the list of pages to keep.
+        '''
+
+        keep = [];
+        added = [];         # (fingerprint, page number) of the pages kept.
+        fingerprinter = Fingerprinter(reader);
+        for i, (ref, page) in enumerate(pages):
+            try:
+                key = fingerprinter.page(page);
+            except PDFError:
+                # Content that can't be decoded is never treated as a duplicate.
+                keep.append((ref, page));
+                continue;
+
+            if key in self.index:
+                orig_file, orig_page = self.index[key];
+                self.dropped.append(DroppedPage(fname, i + 1, orig_file, orig_page, key));
+            else:
+                added.append((key, i + 1));
+                keep.append((ref, page));
+
+        for key, num in added:
+            self.index.setdefault(key, (fname, num));
+
+        return keep;
+
+    def report(self):
+        '''
+        @return: Returns a list of strings, one for each page left out and why.
+        '''
+        return [str(d) for d in self.dropped];
+
+    def copyPages(self, reader, pages):
+        '''
+        Copy a set of pages from an open reader, along with everything they refer to.
+
+        @param reader: The PDFReader.
+        @param pages: List of (Ref, page dictionary) tuples from reader.pages().
+        @return: Returns the number of pages added.
+        '''
+
+        writer = self.writer;
+        mapping = {};       # Object number in the input -> object number in the output.
+        queue = deque();    # Input objects numbered but not yet written.
+        overrides = {};     # Page dictionaries, with inherited attributes filled in.
+
+        def renumber(ref):
+            if ref.num not in mapping:
+                mapping[ref.num] = writer.allocate();
+                queue.append(ref.num);
+            return Ref(mapping[ref.num]);
+
+        parent = writer.ref(self.pages_root);
+        for ref, page in pages:
+            page = dict(page);
+            page.pop('Parent', None);
+            overrides[ref.num] = page;
+            self.pages.append(renumber(ref));
+            self.kids.append(self.pages[-1]);
+            self.count += 1;
+
+        while len(queue):
+            num = queue.popleft();
+            if num in overrides:
+                obj = PDFFile.remap(overrides.pop(num), renumber);
+                obj['Parent'] = parent;
+            else:
+                obj = reader.getObject(num);
+                if isinstance(obj, dict) and obj.get('Type') == 'Pages':
+                    # A node of the input's page tree, reached through something other than
+                    # the pages being copied (e.g. a link's destination). Copying it would pull
+                    # in the whole input, so it is dropped.
+                    obj = None;
+                else:
+                    obj = PDFFile.remap(obj, renumber);
+
+            writer.writeObject(mapping[num], obj);
+
+        return len(pages);
+
+    def close(self):
+        '''
+        Write the page tree, the catalog and the cross-reference table, and close the output.
+        When updating, only the root of the page tree is rewritten.
+        '''
+
+        if self.closed:
+            return;
+
+        with Tracing.tracer.span('merge_finish', 'merge', pages=self.count):
+            writer = self.writer;
+            root = dict(self.root_dict);
+            root[Name('Kids')] = self.kids;
+            root[Name('Count')] = self.count;
+            writer.writeObject(self.pages_root, root);
+            if self.start == None:
+                writer.writeObject(self.catalog, {
+                                                  Name('Type') : Name('Catalog'),
+                                                  Name('Pages') : writer.ref(self.pages_root)
+                                                  });
+
+            trailer = dict(self.trailer);
+            trailer[Name('Root')] = writer.ref(self.catalog);
+            writer.finish(trailer);
+
+        Metrics.registry.inc('merge_output_bytes_total', writer.pos - (self.start or 0));
+
+        self.f.close();
+        self.closed = True;
+
+    def abort(self):
+        '''
+        Give up on the merge. When updating, the file is cut back to how it was, otherwise the
+        output is finished with the pages added so far.
+        '''
+
+        if self.closed:
+            return;
+        if self.start == None:
+            self.close();
+            return;
+
+        self.f.truncate(self.start);
+        self.f.close();
+        self.closed = True;
+
+    def __enter__(self):
+        return self;
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type != None:
+            self.abort();
+        else:
+            self.close();
+
+
+class Fingerprinter:
+    '''
+    Works out fingerprints for the pages of one PDF. Two pages have the same fingerprint if their
+    content streams are the same once decoded and their whitespace normalised, they are the same
+    size, and the resources they use (fonts, images, etc.) have the same content - the object
+    numbers of the resources don't matter, so identical pages from different files match.
+
+    Resources are usually shared by many pages, so each one is only hashed once.
+    '''
+
+    def __init__(self, reader):
+        '''
+        @param reader: The PDFReader the pages come from.
+        '''
+
+        self.reader = reader;
+        self.resources = {};    # (Object number, depth) -> hash, for resources already hashed.
+
+    def page(self, page):
+        '''
+        @param page: The page dictionary, with inherited attributes filled in.
+        @return: Returns the fingerprint, a hex string.
+        @raise PDFError: Raised if the content uses a filter that can't be decoded.
+        '''
+
+        reader = self.reader;
+        h = hashlib.sha1();
+
+        contents = reader.resolve(page.get('Contents'));
+        if not isinstance(contents, list):
+            contents = [contents];
+        for stream in contents:
+            stream = reader.resolve(stream);
+            if isinstance(stream, Stream):
+                h.update(re_content_ws.sub(' ', stream.decoded()).strip());
+                h.update('\n');
+
+        h.update(PDFFile.serialize(reader.resolve(page.get('MediaBox'))));
+        h.update(str(reader.resolve(page.get('Rotate', 0))));
+        h.update(self.resource(page.get('Resources'), resource_depth));
+
+        return h.hexdigest();
+
+    def resource(self, obj, depth):
+        '''
+        A hash of an object's content, following references to the given depth.
+        '''
+
+        if isinstance(obj, Ref):
+            if depth == 0:
+                return 'R';
+            # A hash cut short at a lower depth leaves out what's further down, so it is only
+            # reused at the same depth.
+            key = (obj.num, depth);
+            if key not in self.resources:
+                # Guards against reference loops while this one is hashed.
+                self.resources[key] = 'R';
+                self.resources[key] = self.resource(self.reader.getObject(obj.num), depth - 1);
+            return self.resources[key];
+
+        if isinstance(obj, Stream):
+            h = hashlib.sha1();
+            h.update(self.resource(dict([(k, v) for k, v in obj.dict.items() if k != 'Length']),
+                                   depth));
+            for chunk in obj.chunks():
+                h.update(chunk);
+            return 'S' + h.hexdigest();
+        elif isinstance(obj, dict):
+            return '<<' + ' '.join(['/' + k + ' ' + self.resource(obj[k], depth)
+                                    for k in sorted(obj.keys())]) + '>>';
+        elif isinstance(obj, list):
+            return '[' + ' '.join([self.resource(o, depth) for o in obj]) + ']';
+        elif isinstance(obj, PDFFile.String):
+            # The same string can be written several ways.
+            return '<' + obj.value().encode('hex') + '>';
+
+        return PDFFile.serialize(obj);
+
+
+class DroppedPage:
+    '''
+    A page left out of a merge as a duplicate of a page from an earlier file - generally the
+    last page of one article, which the next article's PDF starts on as well.
+    '''
+
+    def __init__(self, fname, page, orig_file, orig_page, fingerprint):
+        '''
+        @param fname: String, the file the page was in.
+        @param page: int, the page number in that file, from 1.
+        @param orig_file: String, the file with the page it duplicates.
+        @param orig_page: int, the page number of the page it duplicates.
+        @param fingerprint: String, the fingerprint they share.
+        '''
+
+        self.fname = fname;
+        self.page = page;
+        self.orig_file = orig_file;
+        self.orig_page = orig_page;
+        self.fingerprint = fingerprint;
+
+    def __str__(self):
+        return (self.fname + ' page ' + str(self.page) + ': already added from ' +
+                self.orig_file + ' page ' + str(self.orig_page) + ', e.g. a page shared by ' +
+                'neighbouring articles (same content and resources, ' + self.fingerprint[:12] + ')');
+
+
+def mergePDFs(files, output, skip_duplicates=True, update=False):
+    '''
+    Merge PDFs, in the order given, into a single file.
+
+    @param files: List of strings, the locations of the PDFs.
+    @param output: String, the location of the merged PDF.
+    @param skip_duplicates: Boolean, whether to leave out pages identical to one already added.
+    @param update: Boolean, True to add the pages to an existing output as an incremental update.
+    @return: Returns a tuple of the number of pages in the merged PDF and a list of DroppedPage
+            items for the pages left out.
+    @raise PDFError: Raised if any of the files can't be read. When updating, the output is left
+                as it was.
+    '''
+
+    with PDFMerger(output, skip_duplicates=skip_duplicates, update=update) as merger:
+        for fname in files:
+            merger.append(fname);
+
+    return merger.count, merger.dropped;
+
+
+class Article:
+    '''
+    An article placed by orderArticles, with its citation parsed.
+    '''
+
+    def __init__(self, item, index, citation):
+        '''
+        @param item: The article (e.g. a download_pdfs.Branch).
+        @param index: int, its position in the list given to orderArticles.
+        @param citation: Dictionary of citation fields, as in fetchMode.citeLoc.
+        '''
+
+        self.item = item;
+        self.index = index;
+        self.volume = citation.get('volume');
+        self.issue = citation.get('issue');
+        self.doi = citation.get('doi');
+        self.prefix, self.first, self.last = parsePages(citation.get('pages'));
+
+        # The run of pages the article belongs to - its volume, issue and page prefix (e.g. the S
+        # of supplement pages S1-S9).
+        self.group = (numKey(self.volume), numKey(self.issue), self.prefix);
+
+    def __str__(self):
+        if self.first == None:
+            return 'article ' + str(self.index + 1);
+        return 'article ' + str(self.index + 1) + ' (' + pageLabel(self.prefix, self.first,
+                                                                   self.last) + ')';
+
+
+class IntervalIndex:
+    '''
+    Index over the page ranges of a set of articles, for finding the articles that cover a given
+    range of pages. Ranges are kept sorted by first page, alongside the highest last page of any
+    range up to each point, so a query only looks at ranges that could overlap it.
+    '''
+
+    def __init__(self, articles):
+        '''
+        @param articles: List of Article items with page ranges, all in the same group.
+        '''
+
+        self.articles = sorted(articles, key=lambda a: (a.first, a.last));
+        self.starts = [a.first for a in self.articles];
+        self.reach = [];
+        reach = None;
+        for a in self.articles:
+            reach = a.last if reach == None else max(reach, a.last);
+            self.reach.append(reach);
+
+    def find(self, first, last=None):
+        '''
+        @param first: int, the first page of the range.
+        @param last: int, the last page of the range, defaults to first.
+        @return: Returns the list of Article items whose ranges share a page with the range, in
+                page order.
+        '''
+
+        if last == None:
+            last = first;
+
+        # Only ranges starting at or before 'last' can overlap, and the running highest last page
+        # says when no earlier range can reach 'first'.
+        i = bisect.bisect_right(self.starts, last) - 1;
+        out = [];
+        while i >= 0 and self.reach[i] >= first:
+            if self.articles[i].last >= first:
+                out.append(self.articles[i]);
+            i -= 1;
+
+        out.reverse();
+        return out;
+
+
+class OrderReport:
+    '''
+    The result of orderArticles.
+
+    order:      The articles (as given) in assembly order.
+    overlaps:   List of (Article, Article, first, last) tuples, for pairs of articles sharing the
+                pages first to last.
+    gaps:       List of (group, first, last) tuples, for pages first to last which no article
+                covers, between the first and last page of a group (see Article).
+    unplaced:   List of Article items whose page ranges couldn't be parsed. They are put at the
+                end of the order, in the order given.
+    indexes:    Dictionary mapping each group to an IntervalIndex over its articles.
+    '''
+
+    def __init__(self):
+        self.order = [];
+        self.overlaps = [];
+        self.gaps = [];
+        self.unplaced = [];
+        self.indexes = {};
+
+    def report(self):
+        '''
+        @return: Returns a list of strings, one for each problem found.
+        '''
+
+        out = [];
+        for a, b, first, last in self.overlaps:
+            out.append(str(a) + ' and ' + str(b) + ' share ' +
+                       pageLabel(a.prefix, first, last));
+        for (volume, issue, prefix), first, last in self.gaps:
+            out.append('No article covers ' + pageLabel(prefix, first, last));
+        for a in self.unplaced:
+            out.append(str(a) + ' has no usable page range, placed last');
+
+        return out;
+
+
+def parsePages(pages):
+    '''
+    Parse a page range as given in a citation, e.g. '123-130', '123\u2013130', 'S12-S15', 'e1003' or
+    '1201-9' (the last page abbreviated).
+
+    @param pages: String, the range, or None.
+    @return: Returns a tuple of (prefix, first, last), with prefix '' for plain page numbers, or
+            ('', None, None) if the range can't be parsed.
+    '''
+
+    if pages == None:
+        return ('', None, None);
+
+    m = re_page_range.search(pages);
+    if m == None:
+        return ('', None, None);
+
+    prefix = m.group(1).upper();
+    first = int(m.group(2));
+    if m.group(4) == None or (m.group(3) and m.group(3).upper() != prefix):
+        return (prefix, first, first);
+
+    last = int(m.group(4));
+    if last < first and len(m.group(4)) < len(m.group(2)):
+        # Abbreviated, e.g. 1201-9 for 1201-1209.
+        scale = 10**len(m.group(4));
+        last += first - first % scale;
+        if last < first:
+            last += scale;
+
+    if last < first:
+        return (prefix, first, first);
+
+    return (prefix, first, last);
+
+
+def pageLabel(prefix, first, last):
+    if first == last:
+        return 'page ' + prefix + str(first);
+    return 'pages ' + prefix + str(first) + '-' + prefix + str(last);
+
+
+def numKey(value):
+    '''
+    Sort key for a volume or issue: numbers in numeric order, before anything else.
+    '''
+
+    if value == None:
+        return (2, '');
+
+    m = re_digits.match(value);
+    if m != None:
+        return (0, int(m.group(1)));
+
+    return (1, value.strip());
+
+
+def branchCitation(branch):
+    '''
+    The citation fields of a download_pdfs.Branch.
+    '''
+    return dict([(key, branch.getField(key)) for key in ('volume', 'issue', 'pages', 'doi')]);
+
+
+def orderArticles(items, citation=branchCitation):
+    '''
+    Work out the order to assemble articles in from their citations - by volume, issue and first
+    page - checking for pages shared by two articles and for pages no article covers along the
+    way. Takes O(n log n) for n articles, plus the time to sort the overlapping pairs found: one
+    sort, then a pass keeping a heap, by last page, of the articles not yet ended. Every article
+    left on the heap once those ending before the next one's first page are popped overlaps it.
+
+    @param items: List of articles, e.g. the leaves of a download_pdfs.Branch tree.
+    @param citation: Function taking an article and returning a dictionary of its citation fields
+                (volume, issue, pages, doi).
+    @return: Returns an OrderReport.
+    '''
+
+    report = OrderReport();
+    placed = [];
+    for i, item in enumerate(items):
+        a = Article(item, i, citation(item));
+        if a.first == None:
+            report.unplaced.append(a);
+        else:
+            placed.append(a);
+
+    placed.sort(key=lambda a: (a.group, a.first, a.last, a.doi or '', a.index));
+
+    group = None;
+    reach = None;       # The article reaching furthest into the group so far.
+    active = [];        # Heap of (last page, position, Article) for the articles not yet ended.
+    members = [];
+    for pos, a in enumerate(placed):
+        if a.group != group:
+            if group != None:
+                report.indexes[group] = IntervalIndex(members);
+            group = a.group;
+            reach = None;
+            active = [];
+            members = [];
+
+        while len(active) and active[0][0] < a.first:
+            heapq.heappop(active);
+        for i, b in sorted([(i, b) for last, i, b in active]):
+            report.overlaps.append((b, a, a.first, min(a.last, b.last)));
+
+        if reach != None and a.first > reach.last + 1:
+            report.gaps.append((group, reach.last + 1, a.first - 1));
+
+        if reach == None or a.last > reach.last:
+            reach = a;
+        heapq.heappush(active, (a.last, pos, a));
+        members.append(a);
+
+    if group != None:
+        report.indexes[group] = IntervalIndex(members);
+
+    report.order = [a.item for a in placed + report.unplaced];
+    return report;
+
+
+def mergeIssue(root, output, skip_duplicates=True):
+    '''
+    Merge the PDFs downloaded for an issue into a single file, with the articles in citation order.
+
+    @param root: The download_pdfs.Branch tree, after PDFDownloader.downloadPDFs.
+    @param output: String, the location of the merged PDF.
+    @param skip_duplicates: Boolean, whether to leave out pages identical to one already added.
+    @return: Returns a tuple of the number of pages in the merged PDF, a list of DroppedPage items
+            for the pages left out, and the OrderReport.
+    @raise PDFError: Raised if any of the files can't be read.
+    '''
+
+    order = orderArticles(list(root.leaves()));
+
+    files = [];
+    for branch in order.order:
+        files += [f.path for f in branch.files if f != None];
+
+    count, dropped = mergePDFs(files, output, skip_duplicates);
+    return count, dropped, order;
@@ -0,0 +1,301 @@
+"""
+Library for recording what a run is doing - request latencies, bytes transferred, cache hits,
+parse times, queue depths - so that it can be read while the run goes on, and written out as a
+JSON summary or a Prometheus text-format file at the end.
+
+Everything in the process records to the one registry in this module, so a single snapshot
+shows the network, parsing and merging side by side.
+
+@author: SquidneyPoitier <squidney.poitier@gmail.com>
+@version: 0.1
+"""
+
+import json;
+import threading;
+import time;
+
+prefix = 'journalswipe_';
+
+# Upper bounds of the histogram buckets, in seconds. An implicit +Inf bucket follows.
+dflt_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+                30.0);
+
+descriptions = {
+    'mode_load_seconds' : 'Time to get a mode from SettingsReader.getMode.',
+    'settings_cache_total' : 'Lookups in the settings, mode and snapshot caches.',
+    'http_request_seconds' : 'Time from sending a request to receiving the response headers.',
+    'http_responses_total' : 'Responses received, by status.',
+    'http_errors_total' : 'Requests which failed without a response.',
+    'http_received_bytes_total' : 'Response body bytes received, as sent (before decoding).',
+    'http_connections_active' : 'Connections currently checked out of the pool.',
+    'http_connections_idle' : 'Connections currently kept open for reuse.',
+    'response_cache_total' : 'Response cache lookups and changes, by result.',
+    'page_fetch_seconds' : 'Time to fetch a page, by step.',
+    'page_parse_seconds' : 'Time to parse a page and extract its fields, by step.',
+    'page_stream_seconds' : 'Time to fetch and parse a page when streaming, by step.',
+    'pages_total' : 'Pages crawled, by step and result.',
+    'download_seconds' : 'Time to download a file.',
+    'downloads_total' : 'Files downloaded, by result.',
+    'journal_restored_total' : 'Branches restored from a crawl journal rather than crawled.',
+    'download_bytes_total' : 'File bytes downloaded, by host.',
+    'crawl_queue_depth' : 'Tasks waiting in a CrawlPool.',
+    'scheduler_queue_depth' : 'Tasks waiting in a HostScheduler, by host.',
+    'scheduler_running' : 'Tasks running in a HostScheduler, by host.',
+    'merge_file_seconds' : 'Time to add one PDF to a merge.',
+    'merge_pages_total' : 'Pages added to merged PDFs.',
+    'merge_duplicates_total' : 'Duplicate pages left out of merged PDFs.',
+    'merge_input_bytes_total' : 'Bytes of PDFs read by merges.',
+    'merge_output_bytes_total' : 'Bytes of merged PDFs written.'
+    };
+
+class Histogram:
+    '''
+    Counts of observations falling in each bucket, with their total.
+    '''
+
+    def __init__(self, buckets=dflt_buckets):
+        self.buckets = tuple(buckets);
+        self.counts = [0]*(len(self.buckets) + 1);
+        self.count = 0;
+        self.sum = 0.0;
+
+    def observe(self, value):
+        i = 0;
+        for bound in self.buckets:
+            if value <= bound:
+                break;
+            i += 1;
+
+        self.counts[i] += 1;
+        self.count += 1;
+        self.sum += value;
+
+    def toDict(self):
+        '''
+        @return: Returns the count, sum and cumulative bucket counts, as (bound, count) pairs with
+                the last bound '+Inf'.
+        '''
+
+        cumulative = [];
+        total = 0;
+        for bound, n in zip(self.buckets + ('+Inf',), self.counts):
+            total += n;
+            cumulative.append((bound, total));
+
+        return {'count' : self.count, 'sum' : self.sum, 'buckets' : cumulative};
+
+
+class MetricsRegistry:
+    '''
+    Thread-safe store of counters, gauges and histograms, each identified by a name and a set of
+    labels (e.g. host='www.nature.com').
+
+    Gauges can be set directly, or given a function which is called whenever the registry is
+    read - used for things like queue lengths which are cheaper to look at than to keep track of.
+    '''
+
+    def __init__(self, buckets=dflt_buckets):
+        '''
+        @param buckets: The default histogram bucket bounds.
+        '''
+
+        self.buckets = buckets;
+        self.lock = threading.Lock();
+        self.counters = {};     # (name, labels) -> value
+        self.gauges = {};       # (name, labels) -> value, or function returning it
+        self.histograms = {};   # (name, labels) -> Histogram
+        self.started = time.time();
+
+    def key(self, name, labels):
+        return (name, tuple(sorted(labels.items())));
+
+    def inc(self, name, value=1, **labels):
+        '''
+        Add to a counter.
+        '''
+
+        key = self.key(name, labels);
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value;
+
+    def set(self, name, value, **labels):
+        '''
+        Set a gauge, to a number or to a function returning one.
+        '''
+
+        key = self.key(name, labels);
+        with self.lock:
+            self.gauges[key] = value;
+
+    def remove(self, name, **labels):
+        '''
+        Forget a gauge, e.g. when the thing it measures is gone.
+        '''
+
+        key = self.key(name, labels);
+        with self.lock:
+            self.gauges.pop(key, None);
+
+    def observe(self, name, value, **labels):
+        '''
+        Add an observation to a histogram.
+        '''
+
+        key = self.key(name, labels);
+        with self.lock:
+            hist = self.histograms.get(key);
+            if hist == None:
+                hist = self.histograms[key] = Histogram(self.buckets);
+            hist.observe(value);
+
+    def timer(self, name, **labels):
+        '''
+        @return: Returns a context manager which observes the time spent in it to a histogram.
+        '''
+        return Timer(self, name, labels);
+
+    def reset(self):
+        '''
+        Clear everything except the gauges.
+        '''
+
+        with self.lock:
+            self.counters = {};
+            self.histograms = {};
+            self.started = time.time();
+
+    def snapshot(self):
+        '''
+        Read everything recorded so far. Can be called at any time during a run.
+
+        @return: Returns a dictionary with the 'time' and the 'uptime' of the registry in seconds,
+                and 'counters', 'gauges' and 'histograms', each a dictionary mapping the metric
+                name to a list of {'labels' : ..., 'value' : ...} items (histograms have 'count',
+                'sum' and 'buckets' in place of 'value').
+        '''
+
+        with self.lock:
+            counters = self.counters.items();
+            gauges = self.gauges.items();
+            histograms = [(key, hist.toDict()) for key, hist in self.histograms.items()];
+
+        out = {
+               'time' : time.time(),
+               'uptime' : time.time() - self.started,
+               'counters' : {},
+               'gauges' : {},
+               'histograms' : {}
+               };
+
+        for (name, labels), value in sorted(counters):
+            out['counters'].setdefault(name, []).append({'labels' : dict(labels), 'value' : value});
+
+        for (name, labels), value in sorted(gauges):
+            if callable(value):
+                try:
+                    value = value();
+                except Exception:
+                    # Whatever it measured has gone away.
+                    continue;
+            out['gauges'].setdefault(name, []).append({'labels' : dict(labels), 'value' : value});
+
+        for (name, labels), hist in sorted(histograms):
+            hist['labels'] = dict(labels);
+            out['histograms'].setdefault(name, []).append(hist);
+
+        return out;
+
+    def toJSON(self):
+        return json.dumps(self.snapshot(), indent=1, sort_keys=True);
+
+    def toPrometheus(self):
+        '''
+        @return: Returns everything recorded, in the Prometheus text exposition format.
+        '''
+
+        snap = self.snapshot();
+        lines = [];
+
+        def header(name, kind):
+            full = prefix + name;
+            if name in descriptions:
+                lines.append('# HELP ' + full + ' ' + descriptions[name]);
+            lines.append('# TYPE ' + full + ' ' + kind);
+            return full;
+
+        for name, items in sorted(snap['counters'].items()):
+            full = header(name, 'counter');
+            for item in items:
+                lines.append(full + labelText(item['labels']) + ' ' + number(item['value']));
+
+        for name, items in sorted(snap['gauges'].items()):
+            full = header(name, 'gauge');
+            for item in items:
+                lines.append(full + labelText(item['labels']) + ' ' + number(item['value']));
+
+        for name, items in sorted(snap['histograms'].items()):
+            full = header(name, 'histogram');
+            for item in items:
+                labels = item['labels'];
+                for bound, count in item['buckets']:
+                    le = dict(labels);
+                    le['le'] = bound if isinstance(bound, str) else number(bound);
+                    lines.append(full + '_bucket' + labelText(le) + ' ' + str(count));
+                lines.append(full + '_sum' + labelText(labels) + ' ' + number(item['sum']));
+                lines.append(full + '_count' + labelText(labels) + ' ' + str(item['count']));
+
+        return '\n'.join(lines) + '\n';
+
+    def write(self, fname):
+        '''
+        Write everything recorded to a file - in the Prometheus text format if its name ends in
+        '.prom', as JSON otherwise.
+        '''
+
+        if fname.endswith('.prom'):
+            data = self.toPrometheus();
+        else:
+            data = self.toJSON();
+
+        with open(fname, 'wb') as f:
+            f.write(data);
+
+
+class Timer:
+    '''
+    Context manager returned by MetricsRegistry.timer.
+    '''
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry;
+        self.name = name;
+        self.labels = labels;
+        self.start = None;
+
+    def __enter__(self):
+        self.start = time.time();
+        return self;
+
+    def __exit__(self, *args):
+        self.registry.observe(self.name, time.time() - self.start, **self.labels);
+
+
+def labelText(labels):
+    if len(labels) == 0:
+        return '';
+
+    parts = [];
+    for k, v in sorted(labels.items()):
+        v = unicode(v).encode('utf-8').replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n');
+        parts.append(k + '="' + v + '"');
+
+    return '{' + ','.join(parts) + '}';
+
+def number(value):
+    if isinstance(value, float):
+        return repr(value);
+    return str(value);
+
+
+# The registry everything in the process records to.
+registry = MetricsRegistry();
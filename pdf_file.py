@@ -0,0 +1,943 @@
+"""
+Library for reading and writing the low-level structure of PDF files - objects, cross-reference
+tables and the page tree - as needed to take pages out of one PDF and write them into another.
+Page contents are never interpreted, only copied.
+
+Files are read through mmap and objects are parsed only when asked for, so opening a PDF costs
+the size of its cross-reference table rather than the size of the file.
+
+@author: SquidneyPoitier <squidney.poitier@gmail.com>
+@version: 0.1
+"""
+
+from error_handling import PDFError;
+from collections import OrderedDict;
+import binascii;
+import mmap;
+import re;
+import zlib;
+
+ws_chars = '\x00\t\n\x0c\r ';
+delim_chars = '()<>[]{}/%';
+
+re_ws = re.compile(r'(?:[\x00\t\n\x0c\r ]+|%[^\r\n]*)*');
+re_number = re.compile(r'[+-]?(?:\d+\.?\d*|\.\d+)');
+re_ref = re.compile(r'(\d+)[\x00\t\n\x0c\r ]+(\d+)[\x00\t\n\x0c\r ]+R(?![^\x00\t\n\x0c\r ()<>\[\]{}/%])');
+re_regular = re.compile(r'[^\x00\t\n\x0c\r ()<>\[\]{}/%]*');
+re_string_special = re.compile(r'[()\\]');
+re_obj_header = re.compile(r'(\d+)[\x00\t\n\x0c\r ]+(\d+)[\x00\t\n\x0c\r ]+obj(?![^\x00\t\n\x0c\r ()<>\[\]{}/%])');
+re_xref_entry = re.compile(r'(\d{1,10})[ ]+(\d{1,5})[ ]+([nf])');
+re_xref_subsection = re.compile(r'(\d+)[ ]+(\d+)[ ]*(?=[\r\n])');
+re_hex_junk = re.compile(r'[^0-9A-Fa-f]');
+re_string_escape = re.compile(r'\\([0-7]{1,3}|\r\n|[\s\S])');
+
+string_escapes = {'n' : '\n', 'r' : '\r', 't' : '\t', 'b' : '\b', 'f' : '\f'};
+
+copy_chunk_size = 64*1024;      # Bytes copied at a time when writing stream data.
+objstm_cache_size = 4;          # Decoded object streams kept per reader.
+
+# Page attributes which a page inherits from its ancestors in the page tree.
+inheritable = ('Resources', 'MediaBox', 'CropBox', 'Rotate');
+
+class Name(str):
+    '''
+    A PDF name, stored without its leading slash and with any #xx escapes left as they are.
+    '''
+    pass
+
+class String(str):
+    '''
+    A PDF string, literal or hexadecimal, stored as it appears in the file including its
+    delimiters, so it can be written back out unchanged.
+    '''
+
+    def value(self):
+        '''
+        @return: Returns the bytes the string stands for, with escapes undone.
+        '''
+
+        if self.startswith('<'):
+            digits = re_hex_junk.sub('', self[1:-1]);
+            if len(digits) % 2:
+                digits += '0';
+            return binascii.unhexlify(digits);
+
+        return re_string_escape.sub(_unescape, self[1:-1]);
+
+def _unescape(m):
+    esc = m.group(1);
+    if esc[0] in '01234567':
+        return chr(int(esc, 8) & 0xff);
+    elif esc[0] in '\r\n':
+        # A line continuation.
+        return '';
+
+    return string_escapes.get(esc, esc);
+
+class Keyword(str):
+    '''
+    A bare keyword, e.g. obj or stream. Only seen while parsing.
+    '''
+    pass
+
+class Ref:
+    '''
+    An indirect reference to an object.
+    '''
+
+    __slots__ = ('num', 'gen');
+
+    def __init__(self, num, gen=0):
+        self.num = num;
+        self.gen = gen;
+
+    def __eq__(self, other):
+        return isinstance(other, Ref) and self.num == other.num and self.gen == other.gen;
+
+    def __ne__(self, other):
+        return not self.__eq__(other);
+
+    def __hash__(self):
+        return hash((self.num, self.gen));
+
+    def __repr__(self):
+        return 'Ref(%d, %d)' % (self.num, self.gen);
+
+class Stream:
+    '''
+    A stream object - its dictionary, and the location of its (still encoded) data in the file it
+    came from. The data is only read when asked for.
+    '''
+
+    def __init__(self, dictionary, buf=None, start=0, length=0, data=None):
+        '''
+        @param dictionary: The stream's dictionary.
+        @param buf: The buffer (generally an mmap) the data is in.
+        @param start: int, offset of the data in buf.
+        @param length: int, length of the data.
+        @param data: String, the data itself, in place of buf/start/length.
+        '''
+
+        self.dict = dictionary;
+        self.buf = buf;
+        self.start = start;
+        self.length = length;
+        if data != None:
+            self.buf = data;
+            self.start = 0;
+            self.length = len(data);
+
+    def raw(self):
+        '''
+        @return: Returns the encoded data.
+        '''
+        return self.buf[self.start:self.start + self.length];
+
+    def chunks(self, size=copy_chunk_size):
+        '''
+        Generator over the encoded data, a chunk at a time.
+        '''
+
+        end = self.start + self.length;
+        for pos in xrange(self.start, end, size):
+            yield self.buf[pos:min(end, pos + size)];
+
+    def decoded(self):
+        '''
+        @return: Returns the decoded data.
+        @raise PDFError: Raised if the stream uses a filter other than FlateDecode.
+        '''
+
+        filters = self.dict.get('Filter');
+        parms = self.dict.get('DecodeParms');
+        if filters == None:
+            return self.raw();
+
+        if not isinstance(filters, list):
+            filters = [filters];
+            parms = [parms];
+        elif not isinstance(parms, list):
+            parms = [parms]*len(filters);
+
+        data = self.raw();
+        for filt, parm in zip(filters, parms):
+            if filt not in ('FlateDecode', 'Fl'):
+                raise PDFError(PDFError.ERR_FILTER, 'Unsupported stream filter: ' + filt);
+
+            try:
+                data = zlib.decompress(data);
+            except zlib.error:
+                # Some writers leave junk after the compressed data.
+                data = zlib.decompressobj().decompress(data);
+
+            if isinstance(parm, dict) and parm.get('Predictor', 1) >= 10:
+                data = unpredict(data, parm.get('Columns', 1), parm.get('Colors', 1),
+                                 parm.get('BitsPerComponent', 8));
+
+        return data;
+
+
+def unpredict(data, columns, colors=1, bits=8):
+    '''
+    Undo PNG predictors (as used by cross-reference streams).
+
+    @param data: String, the predicted data.
+    @param columns: int, samples per row.
+    @param colors: int, components per sample.
+    @param bits: int, bits per component.
+    @return: Returns the original data.
+    '''
+
+    bpp = max(1, colors*bits//8);
+    rowlen = (columns*colors*bits + 7)//8;
+    out = [];
+    prev = bytearray(rowlen);
+    for pos in xrange(0, len(data), rowlen + 1):
+        ftype = ord(data[pos]);
+        row = bytearray(data[pos + 1:pos + 1 + rowlen]);
+        if len(row) < rowlen:
+            row.extend(bytearray(rowlen - len(row)));
+
+        if ftype == 1:
+            for i in xrange(bpp, rowlen):
+                row[i] = (row[i] + row[i - bpp]) & 0xff;
+        elif ftype == 2:
+            for i in xrange(rowlen):
+                row[i] = (row[i] + prev[i]) & 0xff;
+        elif ftype == 3:
+            for i in xrange(rowlen):
+                left = row[i - bpp] if i >= bpp else 0;
+                row[i] = (row[i] + ((left + prev[i]) >> 1)) & 0xff;
+        elif ftype == 4:
+            for i in xrange(rowlen):
+                a = row[i - bpp] if i >= bpp else 0;
+                b = prev[i];
+                c = prev[i - bpp] if i >= bpp else 0;
+                p = a + b - c;
+                pa, pb, pc = abs(p - a), abs(p - b), abs(p - c);
+                if pa <= pb and pa <= pc:
+                    pred = a;
+                elif pb <= pc:
+                    pred = b;
+                else:
+                    pred = c;
+                row[i] = (row[i] + pred) & 0xff;
+
+        out.append(str(row));
+        prev = row;
+
+    return ''.join(out);
+
+
+class Parser:
+    '''
+    Parses PDF objects out of a buffer. Indirect references to stream lengths are resolved
+    through the reader, if one is given.
+    '''
+
+    def __init__(self, buf, reader=None):
+        self.buf = buf;
+        self.reader = reader;
+
+    def skip(self, pos):
+        '''
+        @return: Returns the position of the next token at or after pos.
+        '''
+        return re_ws.match(self.buf, pos).end();
+
+    def parse(self, pos):
+        '''
+        Parse the object starting at (or after whitespace from) pos.
+
+        @param pos: int, the offset.
+        @return: Returns a tuple of the object and the offset just after it.
+        @raise PDFError: Raised on a syntax error.
+        '''
+
+        buf = self.buf;
+        pos = self.skip(pos);
+        if pos >= len(buf):
+            raise PDFError(PDFError.ERR_BAD_PDF, 'Unexpected end of file');
+
+        c = buf[pos];
+        if c == '/':
+            m = re_regular.match(buf, pos + 1);
+            return Name(m.group()), m.end();
+        elif c == '(':
+            return self.parseString(pos);
+        elif c == '<':
+            if buf[pos + 1:pos + 2] == '<':
+                return self.parseDict(pos + 2);
+            end = buf.find('>', pos);
+            if end < 0:
+                raise PDFError(PDFError.ERR_BAD_PDF, 'Unterminated hex string');
+            return String(buf[pos:end + 1]), end + 1;
+        elif c == '[':
+            out = [];
+            pos += 1;
+            while True:
+                pos = self.skip(pos);
+                if buf[pos:pos + 1] == ']':
+                    return out, pos + 1;
+                obj, pos = self.parse(pos);
+                out.append(obj);
+        elif c in '+-.0123456789':
+            m = re_ref.match(buf, pos);
+            if m:
+                return Ref(int(m.group(1)), int(m.group(2))), m.end();
+            m = re_number.match(buf, pos);
+            if not m:
+                raise PDFError(PDFError.ERR_BAD_PDF, 'Bad number at ' + str(pos));
+            tok = m.group();
+            if '.' in tok:
+                return float(tok), m.end();
+            return int(tok), m.end();
+        elif c in ')>]}':
+            raise PDFError(PDFError.ERR_BAD_PDF, 'Unexpected ' + c + ' at ' + str(pos));
+
+        m = re_regular.match(buf, pos);
+        tok = m.group();
+        if tok == 'true':
+            return True, m.end();
+        elif tok == 'false':
+            return False, m.end();
+        elif tok == 'null':
+            return None, m.end();
+        elif tok == '':
+            raise PDFError(PDFError.ERR_BAD_PDF, 'Unexpected ' + c + ' at ' + str(pos));
+
+        return Keyword(tok), m.end();
+
+    def parseString(self, pos):
+        buf = self.buf;
+        depth = 0;
+        i = pos;
+        while True:
+            m = re_string_special.search(buf, i);
+            if m == None:
+                raise PDFError(PDFError.ERR_BAD_PDF, 'Unterminated string');
+            i = m.start();
+            c = buf[i];
+            if c == '\\':
+                i += 2;
+                continue;
+            elif c == '(':
+                depth += 1;
+            else:
+                depth -= 1;
+                if depth == 0:
+                    return String(buf[pos:i + 1]), i + 1;
+            i += 1;
+
+    def parseDict(self, pos):
+        buf = self.buf;
+        out = {};
+        while True:
+            pos = self.skip(pos);
+            if buf[pos:pos + 2] == '>>':
+                return out, pos + 2;
+
+            key, pos = self.parse(pos);
+            if not isinstance(key, Name):
+                raise PDFError(PDFError.ERR_BAD_PDF, 'Dictionary key is not a name at ' + str(pos));
+            val, pos = self.parse(pos);
+            out[key] = val;
+
+    def parseIndirect(self, pos):
+        '''
+        Parse an indirect object, 'num gen obj ... endobj', including its stream data if it is a
+        stream.
+
+        @param pos: int, the offset of the object header.
+        @return: Returns a tuple of (object number, object).
+        @raise PDFError: Raised if there is no object at pos.
+        '''
+
+        buf = self.buf;
+        m = re_obj_header.match(buf, self.skip(pos));
+        if m == None:
+            raise PDFError(PDFError.ERR_BAD_PDF, 'No object at ' + str(pos));
+
+        num = int(m.group(1));
+        obj, pos = self.parse(m.end());
+        if not isinstance(obj, dict):
+            return num, obj;
+
+        after = self.skip(pos);
+        if buf[after:after + 6] != 'stream':
+            return num, obj;
+
+        start = after + 6;
+        if buf[start:start + 2] == '\r\n':
+            start += 2;
+        elif buf[start:start + 1] in ('\n', '\r'):
+            start += 1;
+
+        length = obj.get('Length');
+        if isinstance(length, Ref) and self.reader != None:
+            length = self.reader.getObject(length.num);
+
+        # Trust the length only if endstream follows it.
+        if not isinstance(length, (int, long)) or \
+            buf[self.skip(start + length):self.skip(start + length) + 9] != 'endstream':
+            end = buf.find('endstream', start);
+            if end < 0:
+                raise PDFError(PDFError.ERR_BAD_PDF, 'Unterminated stream');
+            while end > start and buf[end - 1] in '\r\n':
+                end -= 1;
+            length = end - start;
+
+        return num, Stream(obj, buf, start, length);
+
+
+class PDFReader:
+    '''
+    Read-only access to the objects and pages of a PDF file.
+    '''
+
+    def __init__(self, fname):
+        '''
+        Opens the file and reads its cross-reference table. If the table is missing or broken,
+        the file is scanned for objects instead.
+
+        @param fname: String, the location of the PDF.
+        @raise PDFError: Raised if the file is not a usable PDF, or is encrypted.
+        '''
+
+        self.fname = fname;
+        self.f = open(fname, 'rb');
+        try:
+            self.buf = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ);
+        except (ValueError, EnvironmentError):
+            self.f.close();
+            raise PDFError(PDFError.ERR_BAD_PDF, 'Could not map ' + fname);
+
+        self.parser = Parser(self.buf, self);
+        self.xref = {};         # num -> offset, or (object stream num, index)
+        self.gens = {};         # num -> generation, for objects whose generation isn't 0.
+        self.trailer = {};
+        self.startxref = None;  # Offset of the newest cross-reference section, None if scanned.
+        self.xref_stream = False;   # Whether the newest section is a cross-reference stream.
+        self.objstms = OrderedDict();
+
+        try:
+            self.readXref();
+        except (PDFError, ValueError, IndexError, KeyError, TypeError):
+            self.xref = {};
+            self.gens = {};
+            self.trailer = {};
+            self.startxref = None;
+            self.scan();
+
+        if 'Root' not in self.trailer:
+            self.close();
+            raise PDFError(PDFError.ERR_BAD_PDF, 'No document catalog in ' + fname);
+
+        if 'Encrypt' in self.trailer:
+            self.close();
+            raise PDFError(PDFError.ERR_ENCRYPTED);
+
+    def close(self):
+        if self.buf != None:
+            self.buf.close();
+            self.buf = None;
+        self.f.close();
+        self.objstms = OrderedDict();
+
+    def __enter__(self):
+        return self;
+
+    def __exit__(self, *args):
+        self.close();
+
+    def readXref(self):
+        '''
+        Reads the cross-reference sections, newest first, following /Prev. Entries from newer
+        sections take precedence.
+        '''
+
+        buf = self.buf;
+        pos = buf.rfind('startxref', max(0, len(buf) - 2048));
+        if pos < 0:
+            raise PDFError(PDFError.ERR_BAD_PDF, 'No startxref');
+
+        offset, pos = self.parser.parse(pos + len('startxref'));
+        self.startxref = offset;
+        seen = set();
+        while offset != None and offset not in seen:
+            seen.add(offset);
+            pos = self.parser.skip(offset);
+            if buf[pos:pos + 4] == 'xref':
+                trailer = self.readXrefTable(pos + 4);
+                if 'XRefStm' in trailer:
+                    self.readXrefStream(trailer['XRefStm']);
+            else:
+                trailer = self.readXrefStream(pos);
+                if offset == self.startxref:
+                    self.xref_stream = True;
+
+            for key, val in trailer.items():
+                if key not in self.trailer:
+                    self.trailer[key] = val;
+
+            offset = trailer.get('Prev');
+
+    def readXrefTable(self, pos):
+        '''
+        @return: Returns the trailer dictionary following the table.
+        '''
+
+        buf = self.buf;
+        while True:
+            pos = self.parser.skip(pos);
+            if buf[pos:pos + 7] == 'trailer':
+                trailer, pos = self.parser.parse(pos + 7);
+                return trailer;
+
+            m = re_xref_subsection.match(buf, pos);
+            if m == None:
+                raise PDFError(PDFError.ERR_BAD_PDF, 'Bad xref subsection at ' + str(pos));
+            start, count = int(m.group(1)), int(m.group(2));
+            pos = m.end();
+
+            for num in xrange(start, start + count):
+                m = re_xref_entry.search(buf, pos, pos + 40);
+                if m == None:
+                    raise PDFError(PDFError.ERR_BAD_PDF, 'Bad xref entry at ' + str(pos));
+                pos = m.end();
+                if m.group(3) == 'n' and num not in self.xref:
+                    self.xref[num] = int(m.group(1));
+                    if int(m.group(2)) != 0:
+                        self.gens[num] = int(m.group(2));
+                elif num not in self.xref:
+                    self.xref[num] = None;
+
+    def readXrefStream(self, pos):
+        '''
+        @return: Returns the cross-reference stream's dictionary, which doubles as the trailer.
+        '''
+
+        num, stream = self.parser.parseIndirect(pos);
+        if not isinstance(stream, Stream) or stream.dict.get('Type') != 'XRef':
+            raise PDFError(PDFError.ERR_BAD_PDF, 'Bad xref stream at ' + str(pos));
+
+        d = stream.dict;
+        w = d['W'];
+        index = d.get('Index', [0, d['Size']]);
+        data = stream.decoded();
+        rowlen = sum(w);
+
+        def field(row, start, width, default):
+            if width == 0:
+                return default;
+            val = 0;
+            for c in row[start:start + width]:
+                val = (val << 8) | ord(c);
+            return val;
+
+        pos = 0;
+        for i in range(0, len(index), 2):
+            for num in xrange(index[i], index[i] + index[i + 1]):
+                row = data[pos:pos + rowlen];
+                pos += rowlen;
+                if len(row) < rowlen:
+                    break;
+                if num in self.xref:
+                    continue;
+
+                ftype = field(row, 0, w[0], 1);
+                a = field(row, w[0], w[1], 0);
+                b = field(row, w[0] + w[1], w[2], 0);
+                if ftype == 1:
+                    self.xref[num] = a;
+                    if b != 0:
+                        self.gens[num] = b;
+                elif ftype == 2:
+                    self.xref[num] = (a, b);
+                else:
+                    self.xref[num] = None;
+
+        return d;
+
+    def scan(self):
+        '''
+        Rebuild the cross-reference table by searching the whole file for objects, for files
+        whose table is damaged. Later copies of an object win, as they would in an update.
+        '''
+
+        buf = self.buf;
+        objstms = [];
+        for m in re_obj_header.finditer(buf):
+            if m.start() > 0 and buf[m.start() - 1] not in ws_chars:
+                continue;
+            num, gen = int(m.group(1)), int(m.group(2));
+            self.xref[num] = m.start();
+            self.gens.pop(num, None);
+            if gen != 0:
+                self.gens[num] = gen;
+            if buf.find('/ObjStm', m.end(), m.end() + 512) >= 0:
+                objstms.append(num);
+
+        # Objects inside object streams can't be found by searching, so list their contents.
+        for stmnum in objstms:
+            try:
+                stream = self.getObject(stmnum);
+                if not isinstance(stream, Stream) or stream.dict.get('Type') != 'ObjStm':
+                    continue;
+                parser = Parser(stream.decoded(), self);
+                pos = 0;
+                for i in range(stream.dict['N']):
+                    num, pos = parser.parse(pos);
+                    off, pos = parser.parse(pos);
+                    if num not in self.xref:
+                        self.xref[num] = (stmnum, i);
+            except (PDFError, KeyError, TypeError, zlib.error):
+                continue;
+
+        pos = buf.rfind('trailer');
+        if pos >= 0:
+            try:
+                self.trailer, end = self.parser.parse(pos + 7);
+            except PDFError:
+                self.trailer = {};
+
+        if 'Root' not in self.trailer:
+            # No usable trailer - look for the catalog, or a cross-reference stream's dictionary.
+            for num in sorted(self.xref, reverse=True):
+                try:
+                    obj = self.getObject(num);
+                except PDFError:
+                    continue;
+                if isinstance(obj, Stream) and obj.dict.get('Type') == 'XRef' and 'Root' in obj.dict:
+                    self.trailer = obj.dict;
+                    break;
+                if isinstance(obj, dict) and obj.get('Type') == 'Catalog':
+                    self.trailer = {'Root' : Ref(num)};
+                    break;
+
+    def getObject(self, num):
+        '''
+        Parse an object.
+
+        @param num: int, the object number.
+        @return: Returns the object, None if it doesn't exist.
+        @raise PDFError: Raised if the object can't be parsed.
+        '''
+
+        loc = self.xref.get(num);
+        if loc == None:
+            return None;
+
+        if isinstance(loc, tuple):
+            return self.getCompressed(loc[0], loc[1]);
+
+        found, obj = self.parser.parseIndirect(loc);
+        return obj;
+
+    def getCompressed(self, stmnum, index):
+        '''
+        Get an object out of an object stream.
+        '''
+
+        if stmnum in self.objstms:
+            offsets, parser = self.objstms.pop(stmnum);
+        else:
+            stream = self.getObject(stmnum);
+            if not isinstance(stream, Stream):
+                raise PDFError(PDFError.ERR_BAD_PDF, 'Bad object stream ' + str(stmnum));
+
+            data = stream.decoded();
+            parser = Parser(data, self);
+            first = stream.dict['First'];
+            offsets = [];
+            pos = 0;
+            for i in range(stream.dict['N']):
+                num, pos = parser.parse(pos);
+                off, pos = parser.parse(pos);
+                offsets.append(first + off);
+
+            if len(self.objstms) >= objstm_cache_size:
+                self.objstms.popitem(False);
+
+        self.objstms[stmnum] = (offsets, parser);
+        obj, pos = parser.parse(offsets[index]);
+        return obj;
+
+    def resolve(self, obj):
+        '''
+        @return: Returns the object a reference points to, or obj itself if it isn't a reference.
+        '''
+
+        while isinstance(obj, Ref):
+            obj = self.getObject(obj.num);
+
+        return obj;
+
+    def pages(self):
+        '''
+        Generator over the pages, in order. Inherited attributes are copied into each page's
+        dictionary.
+
+        @return: Yields (Ref, page dictionary) tuples.
+        '''
+
+        root = self.resolve(self.trailer['Root']);
+        if not isinstance(root, dict) or 'Pages' not in root:
+            raise PDFError(PDFError.ERR_BAD_PDF, 'No page tree in ' + self.fname);
+
+        # Depth first, with the inherited attributes carried down the stack.
+        stack = [(root['Pages'], {})];
+        seen = set();
+        while len(stack):
+            ref, inherited = stack.pop();
+            if not isinstance(ref, Ref) or ref.num in seen:
+                continue;
+            seen.add(ref.num);
+
+            node = self.resolve(ref);
+            if not isinstance(node, dict):
+                continue;
+
+            if node.get('Type') == 'Pages' or ('Kids' in node and node.get('Type') != 'Page'):
+                inherited = dict(inherited);
+                for key in inheritable:
+                    if key in node:
+                        inherited[key] = node[key];
+                kids = self.resolve(node.get('Kids', []));
+                for kid in reversed(kids):
+                    stack.append((kid, inherited));
+            else:
+                page = dict(node);
+                for key, val in inherited.items():
+                    if key not in page:
+                        page[key] = val;
+                yield ref, page;
+
+
+class PDFWriter:
+    '''
+    Writes objects to a file as they are given to it, keeping only their offsets, then the
+    cross-reference table and trailer when finished.
+
+    It can also add an incremental update to the end of an existing file: new and replaced
+    objects, followed by a cross-reference section listing only those objects and pointing back
+    to the file's previous one. Nothing already in the file is changed. The section is of the
+    same kind as the previous one - a table, or a cross-reference stream - and replaced objects
+    keep their generation numbers.
+    '''
+
+    def __init__(self, f, version='1.7', update=None, xref_stream=False, gens=None):
+        '''
+        Writes the header, unless updating.
+
+        @param f: A file object opened for binary writing. For an update, it must be open on the
+                    existing file and positioned at its end.
+        @param version: String, the PDF version for the header.
+        @param update: For an incremental update, a tuple of the existing file's trailer /Size
+                    and the offset of its newest cross-reference section (PDFReader.startxref).
+        @param xref_stream: Boolean, True to finish with a cross-reference stream rather than a
+                    table - for updating a file whose newest section is a stream 
+                    (PDFReader.xref_stream).
+        @param gens: Dictionary mapping the numbers of objects in the existing file to their
+                    generations, where they aren't 0 (PDFReader.gens).
+        '''
+
+        self.f = f;
+        self.xref_stream = xref_stream;
+        self.gens = dict(gens or {});
+        if update == None:
+            self.base = 0;
+            self.prev = None;
+            self.offsets = [None];  # Indexed by object number; object 0 is always free.
+            f.write('%PDF-' + version + '\n%\xe2\xe3\xcf\xd3\n');
+        else:
+            size, self.prev = update;
+            self.base = size;       # Numbers below this belong to the existing file.
+            self.offsets = [None]*size;
+        self.pos = f.tell();
+
+    def allocate(self):
+        '''
+        Reserve an object number.
+
+        @return: Returns the number.
+        '''
+
+        self.offsets.append(None);
+        return len(self.offsets) - 1;
+
+    def ref(self, num):
+        '''
+        @return: Returns a reference to an object, with its generation.
+        '''
+        return Ref(num, self.gens.get(num, 0));
+
+    def write(self, data):
+        self.f.write(data);
+        self.pos += len(data);
+
+    def writeObject(self, num, obj):
+        '''
+        Write an object. Streams are copied a chunk at a time, with their /Length made direct.
+
+        @param num: int, an object number from allocate(), or when updating the number of an
+                    object in the existing file to replace, which keeps its generation.
+        @param obj: The object, with references already renumbered.
+        '''
+
+        self.offsets[num] = self.pos;
+        self.write(str(num) + ' ' + str(self.gens.get(num, 0)) + ' obj\n');
+        if isinstance(obj, Stream):
+            d = dict(obj.dict);
+            d['Length'] = obj.length;
+            self.write(serialize(d));
+            self.write('\nstream\n');
+            for chunk in obj.chunks():
+                self.write(chunk);
+            self.write('\nendstream');
+        else:
+            self.write(serialize(obj));
+        self.write('\nendobj\n');
+
+    def finish(self, trailer):
+        '''
+        Write the cross-reference table and the trailer, or the cross-reference stream. Numbers
+        allocated but never written are marked free.
+
+        @param trailer: Dictionary for the trailer, which must include /Root. /Size is added, and
+                    /Prev when updating.
+        '''
+
+        if self.xref_stream:
+            # The stream lists itself.
+            num = self.allocate();
+            self.offsets[num] = self.pos;
+
+        start = self.pos;
+        if self.base == 0:
+            nums = range(len(self.offsets));
+        else:
+            # Only the replaced objects and the new ones, in as few subsections as possible. The
+            # head of the free list (object 0) is repeated, as readers expect a section to have it.
+            nums = [0] + [n for n in xrange(1, self.base) if self.offsets[n] != None];
+            nums += range(self.base, len(self.offsets));
+
+        # Runs of consecutive numbers, as (first, count).
+        sections = [];
+        i = 0;
+        while i < len(nums):
+            j = i + 1;
+            while j < len(nums) and nums[j] == nums[j - 1] + 1:
+                j += 1;
+            sections.append((nums[i], j - i));
+            i = j;
+
+        trailer = dict(trailer);
+        trailer['Size'] = len(self.offsets);
+        if self.prev != None:
+            trailer['Prev'] = self.prev;
+
+        if self.xref_stream:
+            self.writeXrefStream(num, sections, trailer);
+        else:
+            out = ['xref\n'];
+            for first, count in sections:
+                out.append(str(first) + ' ' + str(count) + '\n');
+                for n in xrange(first, first + count):
+                    off = self.offsets[n];
+                    if off == None:
+                        out.append('0000000000 65535 f \n');
+                    else:
+                        out.append('%010d %05d n \n' % (off, self.gens.get(n, 0)));
+            self.write(''.join(out));
+            self.write('trailer\n' + serialize(trailer));
+
+        self.write('\nstartxref\n' + str(start) + '\n%%EOF\n');
+
+    def writeXrefStream(self, num, sections, trailer):
+        '''
+        Write the cross-reference section as a stream, object num, with the trailer entries in
+        its dictionary.
+        '''
+
+        width = 1;
+        while max(self.offsets) >> (8*width):
+            width += 1;
+
+        rows = [];
+        for first, count in sections:
+            for n in xrange(first, first + count):
+                off = self.offsets[n];
+                if off == None:
+                    fields = (0, 0, 65535);
+                else:
+                    fields = (1, off, self.gens.get(n, 0));
+                rows.append(chr(fields[0]) + ('%0*x' % (2*width, fields[1])).decode('hex') +
+                            ('%04x' % fields[2]).decode('hex'));
+
+        d = dict(trailer);
+        d[Name('Type')] = Name('XRef');
+        d[Name('W')] = [1, width, 2];
+        d[Name('Index')] = [n for section in sections for n in section];
+        d[Name('Filter')] = Name('FlateDecode');
+        self.writeObject(num, Stream(d, data=zlib.compress(''.join(rows))));
+
+
+def serialize(obj):
+    '''
+    Convert an object to PDF syntax.
+
+    @param obj: The object (not a Stream - see PDFWriter.writeObject).
+    @return: Returns the string.
+    '''
+
+    if obj == None:
+        return 'null';
+    elif isinstance(obj, bool):
+        return 'true' if obj else 'false';
+    elif isinstance(obj, Name):
+        return '/' + obj;
+    elif isinstance(obj, str):
+        # Strings are kept with their delimiters, keywords as they were.
+        return obj;
+    elif isinstance(obj, (int, long)):
+        return str(obj);
+    elif isinstance(obj, float):
+        out = ('%.6f' % obj).rstrip('0').rstrip('.');
+        if out in ('', '-', '-0'):
+            return '0';
+        return out;
+    elif isinstance(obj, Ref):
+        return str(obj.num) + ' ' + str(obj.gen) + ' R';
+    elif isinstance(obj, list):
+        return '[' + ' '.join([serialize(o) for o in obj]) + ']';
+    elif isinstance(obj, dict):
+        return '<<' + ' '.join(['/' + k + ' ' + serialize(v) for k, v in obj.items()]) + '>>';
+
+    raise PDFError(PDFError.ERR_BAD_PDF, 'Cannot write object of type ' + type(obj).__name__);
+
+
+def remap(obj, func):
+    '''
+    Copy an object, replacing every reference in it.
+
+    @param obj: The object.
+    @param func: Function taking a Ref and returning its replacement.
+    @return: Returns the copy. Streams share their data with the original.
+    '''
+
+    if isinstance(obj, Ref):
+        return func(obj);
+    elif isinstance(obj, list):
+        return [remap(o, func) for o in obj];
+    elif isinstance(obj, dict):
+        return dict([(k, remap(v, func)) for k, v in obj.items()]);
+    elif isinstance(obj, Stream):
+        d = dict(obj.dict);
+        length = d.pop('Length', None);
+        d = remap(d, func);
+        # The length is written directly, so an indirect length object is not copied.
+        d['Length'] = length if not isinstance(length, Ref) else 0;
+        return Stream(d, obj.buf, obj.start, obj.length);
+
+    return obj;
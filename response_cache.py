@@ -0,0 +1,319 @@
+"""
+Library for keeping the pages fetched by PDFDownloader on disk between runs. Cached pages are
+revalidated with conditional requests, so an unchanged page costs a 304 response rather than a
+full transfer, and the cache is kept under a size limit by evicting the least recently used pages.
+
+@author: SquidneyPoitier <squidney.poitier@gmail.com>
+@version: 0.1
+"""
+
+from collections import OrderedDict;
+from os import path;
+import metrics as Metrics;
+import hashlib;
+import json;
+import os;
+import tempfile;
+import threading;
+import time;
+
+dflt_cache_location = path.join(path.dirname(path.abspath(__file__)), 'cache');
+dflt_max_size = 512*1024*1024;      # Bytes
+
+class ResponseCache:
+    '''
+    Thread-safe on-disk cache of response bodies, keyed by URL and the type of parser the page is
+    read with ('HTML' or 'XML', see fetchMode.parsers). Each entry is stored as two files named
+    after the hash of its key - the body, and a small JSON file with the validators.
+
+    Only responses with an ETag or Last-Modified header are stored, since without them there is
+    no way to tell whether the page has changed.
+    '''
+
+    def __init__(self, location=dflt_cache_location, max_size=dflt_max_size):
+        '''
+        Opens the cache, creating the directory if needed. Existing entries are ordered by when
+        they were last used.
+
+        @param location: String, the cache directory.
+        @param max_size: int, the most bytes of response bodies to keep.
+        '''
+
+        self.location = location;
+        self.max_size = max_size;
+
+        self.lock = threading.Lock();
+        self.entries = OrderedDict();   # key -> body size, least recently used first.
+        self.size = 0;
+
+        self.hits = 0;
+        self.misses = 0;
+        self.stores = 0;
+        self.evictions = 0;
+        self.errors = 0;
+
+        if not path.isdir(location):
+            os.makedirs(location);
+
+        found = [];
+        for fname in os.listdir(location):
+            if not fname.endswith('.meta'):
+                continue;
+
+            key = fname[:-len('.meta')];
+            body = self.bodyFile(key);
+            if not path.isfile(body):
+                continue;
+
+            found.append((path.getmtime(self.metaFile(key)), key, path.getsize(body)));
+
+        for mtime, key, size in sorted(found):
+            self.entries[key] = size;
+            self.size += size;
+
+        self.evict();
+
+    def key(self, url, parser):
+        '''
+        @param url: String, the URL.
+        @param parser: String, the parser type.
+        @return: Returns the name the entry is stored under.
+        '''
+        return hashlib.sha1(parser + '\n' + url).hexdigest();
+
+    def bodyFile(self, key):
+        return path.join(self.location, key + '.body');
+
+    def metaFile(self, key):
+        return path.join(self.location, key + '.meta');
+
+    def get(self, url, parser):
+        '''
+        Look up an entry, without checking whether it is still current.
+
+        @param url: String, the URL.
+        @param parser: String, the parser type.
+        @return: Returns a tuple of (metadata dictionary, body), or None if it's not cached.
+        '''
+
+        key = self.key(url, parser);
+        with self.lock:
+            if key not in self.entries:
+                return None;
+
+        try:
+            with open(self.metaFile(key), 'rb') as f:
+                meta = json.load(f);
+            with open(self.bodyFile(key), 'rb') as f:
+                body = f.read();
+        except (IOError, OSError, ValueError):
+            self.remove(key);
+            return None;
+
+        return meta, body;
+
+    def put(self, url, parser, resp):
+        '''
+        Store a response, if it has validators, evicting old entries to make room.
+
+        @param url: String, the URL.
+        @param parser: String, the parser type.
+        @param resp: connection_pool.Response item with status 200.
+        @return: Returns True if the response was stored, False if it wasn't - including if it
+                couldn't be written, e.g. because the disk is full, in which case any old entry
+                for it is removed.
+        '''
+
+        etag = resp.getheader('etag');
+        modified = resp.getheader('last-modified');
+        cc = resp.getheader('cache-control', '').lower();
+        if (etag == None and modified == None) or 'no-store' in cc:
+            return False;
+
+        size = len(resp.body);
+        if size > self.max_size:
+            return False;
+
+        key = self.key(url, parser);
+        meta = {
+                'url' : url,
+                'parser' : parser,
+                'etag' : etag,
+                'last_modified' : modified,
+                'date' : resp.getheader('date'),
+                'size' : size,
+                'stored' : time.time()
+                };
+
+        # Write to temporary files and move them into place, so a reader never sees half an entry.
+        try:
+            self.writeFile(self.bodyFile(key), resp.body);
+            self.writeFile(self.metaFile(key), json.dumps(meta));
+        except (IOError, OSError):
+            # The old entry's files may no longer match each other.
+            self.remove(key);
+            with self.lock:
+                self.errors += 1;
+            Metrics.registry.inc('response_cache_total', result='error');
+            return False;
+
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key);
+            self.entries[key] = size;
+            self.size += size;
+            self.stores += 1;
+        Metrics.registry.inc('response_cache_total', result='store');
+
+        self.evict();
+        return True;
+
+    def touch(self, key):
+        '''
+        Mark an entry as most recently used, in memory and on disk.
+        '''
+
+        with self.lock:
+            if key in self.entries:
+                self.entries[key] = self.entries.pop(key);
+
+        try:
+            os.utime(self.metaFile(key), None);
+        except OSError:
+            pass;
+
+    def revalidated(self, key, meta, resp):
+        '''
+        Update an entry after a 304. The response's validators replace the stored ones, so a
+        server which changes its ETags (or dates) without changing the page keeps answering 304s.
+
+        @param key: The entry's key.
+        @param meta: The entry's metadata dictionary.
+        @param resp: The connection_pool.Response item for the 304.
+        '''
+
+        new = dict(meta);
+        for name, header in (('etag', 'etag'), ('last_modified', 'last-modified'), 
+                             ('date', 'date')):
+            value = resp.getheader(header);
+            if value != None:
+                new[name] = value;
+
+        if new == meta:
+            self.touch(key);
+            return;
+
+        with self.lock:
+            if key in self.entries:
+                self.entries[key] = self.entries.pop(key);
+
+        # Rewriting the metadata marks the entry as used on disk as well.
+        try:
+            self.writeFile(self.metaFile(key), json.dumps(new));
+        except (IOError, OSError):
+            # The old validators still work, if less often.
+            self.touch(key);
+
+    def remove(self, key):
+        '''
+        Delete an entry.
+        '''
+
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key);
+
+        for fname in (self.metaFile(key), self.bodyFile(key)):
+            try:
+                os.remove(fname);
+            except OSError:
+                pass;
+
+    def evict(self):
+        '''
+        Remove least recently used entries until the cache is within max_size.
+        '''
+
+        while True:
+            with self.lock:
+                if self.size <= self.max_size or len(self.entries) == 0:
+                    return;
+
+                key = next(iter(self.entries));
+                self.evictions += 1;
+                Metrics.registry.inc('response_cache_total', result='eviction');
+
+            self.remove(key);
+
+    def fetch(self, pool, url, parser):
+        '''
+        Retrieve a page through the cache. If it is cached, the request is made conditional on the
+        stored validators and the stored body is returned on a 304.
+
+        @param pool: The connection_pool.ConnectionPool to make the request through.
+        @param url: String, the URL.
+        @param parser: String, the parser type.
+        @return: Returns a connection_pool.Response item. Its status is 200 for cached pages. A 
+                response which couldn't be stored is still returned.
+        @raise DownloadError: Raised if the request could not be made.
+        '''
+
+        cached = self.get(url, parser);
+        headers = {};
+        if cached != None:
+            meta = cached[0];
+            if meta['etag'] != None:
+                headers['If-None-Match'] = meta['etag'];
+            if meta['last_modified'] != None:
+                headers['If-Modified-Since'] = meta['last_modified'];
+
+        resp = pool.request(url, headers);
+
+        if resp.status == 304 and cached != None:
+            Metrics.registry.inc('response_cache_total', result='hit');
+            with self.lock:
+                self.hits += 1;
+            self.revalidated(self.key(url, parser), cached[0], resp);
+            resp.status = 200;
+            resp.body = cached[1];
+            return resp;
+
+        Metrics.registry.inc('response_cache_total', result='miss');
+        with self.lock:
+            self.misses += 1;
+
+        if resp.status == 200:
+            self.put(url, parser, resp);
+
+        return resp;
+
+    def stats(self):
+        '''
+        @return: Dictionary with the number of 'entries', their total 'size' in bytes, and counts
+                of 'hits' (pages revalidated with a 304), 'misses', 'stores', 'evictions' and
+                'errors' (responses which couldn't be written).
+        '''
+
+        with self.lock:
+            return {
+                    'entries' : len(self.entries),
+                    'size' : self.size,
+                    'hits' : self.hits,
+                    'misses' : self.misses,
+                    'stores' : self.stores,
+                    'evictions' : self.evictions,
+                    'errors' : self.errors
+                    };
+
+    def writeFile(self, fname, data):
+        fd, tmp = tempfile.mkstemp(dir=self.location, suffix='.tmp');
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data);
+            if path.exists(fname) and os.name == 'nt':
+                os.remove(fname);
+            os.rename(tmp, fname);
+        except (IOError, OSError):
+            if path.exists(tmp):
+                os.remove(tmp);
+            raise;
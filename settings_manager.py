@@ -11,12 +11,245 @@ Settings are saved in a simple XML file.
 from lxml import etree;
 from os import path;
 from general_utils import *;
+import metrics as Metrics;
+import tracing as Tracing;
+import marshal;
+import os;
+import re;
+import sys;
+import tempfile;
+import threading;
 
 from error_handling import CompatibilityException, SettingsManagerError, ModeException;
 
 current_version = 0.1; # Settings version, not program version.
 dflt_settings_file = path.join(path.dirname(__file__), 'settings'+path.sep+'config.xml');
 dflt_modes_location = path.join(path.dirname(__file__), 'modes');
+dflt_snapshot_file = path.join(path.dirname(__file__), 'settings'+path.sep+'modes.snapshot');
+snapshot_format = 1;   # Bumped whenever the layout of fetchMode.toSnapshot changes.
+
+re_tag_name = re.compile(r'^(?:\*|[A-Za-z_][\w.-]*)$');    # Tag names a LocTrie can match itself.
+re_xml_space = re.compile(r'[ \t\r\n]+');
+
+def fileStamp(fname):
+    '''
+    @param fname: String, the location of a file.
+    @return: Returns a tuple of the file's modification time and size, used to tell whether it
+            has changed.
+    '''
+    st = os.stat(fname);
+    return (st.st_mtime, st.st_size);
+
+class FileCache:
+    """
+    Thread-safe cache of objects loaded from files, e.g. parsed XML. An entry is
+    reused until the file's modification time or size changes.
+    """
+    
+    def __init__(self, name='files'):
+        '''
+        @param name: String, the name the cache's hits and misses are recorded
+                    under in the metrics.
+        '''
+        self.name = name;
+        self.lock = threading.Lock();
+        self.entries = {};
+    
+    def get(self, fname, loader):
+        '''
+        Get the object for a file, loading it if it isn't cached or the file has
+        changed.
+        
+        @param fname: String, the location of the file.
+        @param loader: Function taking the file location and returning the 
+                    object to cache.
+        @return: Returns the loaded object.
+        '''
+        
+        fname = path.abspath(fname);
+        stamp = fileStamp(fname);
+        
+        with self.lock:
+            entry = self.entries.get(fname);
+        if entry != None and entry[0] == stamp:
+            Metrics.registry.inc('settings_cache_total', cache=self.name, result='hit');
+            return entry[1];
+        
+        Metrics.registry.inc('settings_cache_total', cache=self.name, result='miss');
+        # Loaded outside the lock - two threads may both load a changed file, but
+        # neither waits on the other's parsing.
+        obj = loader(fname);
+        with self.lock:
+            self.entries[fname] = (stamp, obj);
+        
+        return obj;
+    
+    def clear(self):
+        with self.lock:
+            self.entries = {};
+
+# Process-wide caches of parsed settings files, of fetchMode objects and of snapshots.
+settings_cache = FileCache('settings');
+mode_cache = FileCache('mode');
+snapshot_cache = FileCache('snapshot');
+
+def clearCaches():
+    '''
+    Forget all cached settings, modes and snapshots, so they are read from file again.
+    '''
+    settings_cache.clear();
+    mode_cache.clear();
+    snapshot_cache.clear();
+    
+def loadSnapshot(snapshot_file):
+    '''
+    Reads a snapshot file written by writeSnapshot.
+    
+    @param snapshot_file: The location of the snapshot.
+    @return: Returns the snapshot dictionary, or None if it was written by a different version of
+            the snapshot format, of Python or of the settings.
+    '''
+    
+    try:
+        with open(snapshot_file, 'rb') as f:
+            snap = marshal.load(f);
+    except (IOError, EOFError, ValueError, TypeError):
+        return None;
+    
+    if not isinstance(snap, dict) or \
+        snap.get('format') != snapshot_format or \
+        snap.get('python') != tuple(sys.version_info[:2]) or \
+        snap.get('max_version') != CompatibilityHelper.max_version:
+        return None;
+    
+    return snap;
+
+def readSnapshot(snapshot_file=dflt_snapshot_file):
+    '''
+    The current snapshot, cached like the settings.
+    
+    @param snapshot_file: The location of the snapshot.
+    @return: Returns the snapshot dictionary, or None if there is no usable snapshot.
+    '''
+    
+    if not path.isfile(snapshot_file):
+        return None;
+    
+    return snapshot_cache.get(snapshot_file, loadSnapshot);
+
+def writeSnapshot(settings_file=dflt_settings_file, snapshot_file=dflt_snapshot_file):
+    '''
+    Compiles the settings file and every mode registered in it into a snapshot file, which 
+    SettingsReader reads instead of the XML for as long as the files are unchanged.
+    
+    @param settings_file: The location of the settings file.
+    @param snapshot_file: Where to write the snapshot.
+    @return: Returns the list of mode names written.
+    '''
+    
+    stree, fvers = loadSettings(settings_file);
+    
+    locations = {};
+    modes = {};
+    names = [];
+    
+    modes_el = stree.find(fvers.modesTag);
+    if modes_el != None:
+        for child in modes_el:
+            if not isinstance(child.tag, basestring):
+                continue;
+            
+            fileLoc = modeFile(fvers, child);
+            if fileLoc == None:
+                continue;
+            
+            locations[child.tag] = fileLoc;
+            modes[fileLoc] = {
+                              'stamp' : fileStamp(fileLoc),
+                              'mode' : fetchMode(fileLoc).toSnapshot()
+                              };
+            names.append(child.tag);
+    
+    snap = {
+            'format' : snapshot_format,
+            'python' : tuple(sys.version_info[:2]),
+            'max_version' : CompatibilityHelper.max_version,
+            'settings' : {
+                          path.abspath(settings_file) : {
+                                'stamp' : fileStamp(settings_file),
+                                'version' : fvers.version,
+                                'modes' : locations
+                                }
+                          },
+            'modes' : modes
+            };
+    
+    # Write to a temporary file and move it into place, so a reader never sees half a snapshot.
+    fd, tmp = tempfile.mkstemp(dir=path.dirname(path.abspath(snapshot_file)), suffix='.tmp');
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            marshal.dump(snap, f);
+        if path.exists(snapshot_file) and os.name == 'nt':
+            os.remove(snapshot_file);
+        os.rename(tmp, snapshot_file);
+    except:
+        if path.exists(tmp):
+            os.remove(tmp);
+        raise;
+    
+    return names;
+
+def modeFile(fvers, element):
+    '''
+    Finds the mode file for an entry in the Modes section of a settings file.
+    
+    @param fvers: CompatibilityHelper for the settings file.
+    @param element: The mode's element.
+    @return: Returns the absolute location of the mode file, or None if there isn't one.
+    '''
+    
+    if not fvers.modeLocAttrib in element.attrib:
+        return None;
+    
+    fileLoc = element.attrib[fvers.modeLocAttrib];
+    if(fileLoc == None):
+        return None;
+    
+    # By default, file locations that are not absolute locations are taken to be relative 
+    # to the default 'modes' location.
+    if(not path.isabs(fileLoc)):
+        fileLoc = path.join(dflt_modes_location, fileLoc);
+    
+    return path.abspath(fileLoc);
+
+def loadMode(fileLoc, snapshot_file=dflt_snapshot_file):
+    '''
+    Loads a mode, from the snapshot if it has an up to date copy, otherwise from the XML.
+    
+    @param fileLoc: String, the location of the mode file.
+    @param snapshot_file: The location of the snapshot.
+    @return: Returns a fetchMode object.
+    '''
+    
+    snap = readSnapshot(snapshot_file);
+    if snap != None:
+        entry = snap['modes'].get(path.abspath(fileLoc));
+        if entry != None and entry['stamp'] == fileStamp(fileLoc):
+            return fetchMode(fileLoc, entry['mode']);
+    
+    return fetchMode(fileLoc);
+    
+def loadSettings(settings_file):
+    '''
+    Parses a settings file.
+    
+    @param settings_file: The location of the settings file.
+    @return: Returns a tuple of the parsed tree and its CompatibilityHelper.
+    '''
+    
+    parser = etree.XMLParser();
+    stree = etree.parse(settings_file, parser);
+    return stree, CompatibilityHelper(stree.getroot());
 
 class SettingsReader:
     """
@@ -25,19 +258,36 @@ class SettingsReader:
     """
     fvers = None;  # File version
     stree = None;  # Settings tree, from file.
+    locations = None;  # Mode name -> mode file, when read from a snapshot.
     settings_file = dflt_settings_file;
+    snapshot_file = dflt_snapshot_file;
     
     
-    def __init__(self, settings_file=settings_file):
+    def __init__(self, settings_file=settings_file, snapshot_file=snapshot_file):
         '''
         When instantiating this class, the XML tree is parsed and set as a 
-        property, and compatibility is established.
+        property, and compatibility is established. Parsed files are shared 
+        through settings_cache, so the tree must not be modified.
+        
+        If the snapshot (see writeSnapshot) has an up to date copy of the 
+        settings file, the XML isn't parsed at all, stree is left as None and
+        the mode locations are taken from the snapshot.
         
         @param settings_file: The location of the settings file.
+        @param snapshot_file: The location of the snapshot, e.g. one written 
+                    somewhere else by build_snapshot.py.
         '''
-        parser = etree.XMLParser();
-        self.stree = etree.parse(settings_file, parser);
-        self.fvers = CompatibilityHelper(self.stree.getroot());
+        
+        self.snapshot_file = snapshot_file;
+        snap = readSnapshot(snapshot_file);
+        if snap != None:
+            entry = snap['settings'].get(path.abspath(settings_file));
+            if entry != None and entry['stamp'] == fileStamp(settings_file):
+                self.fvers = CompatibilityHelper(entry['version']);
+                self.locations = entry['modes'];
+                return;
+        
+        self.stree, self.fvers = settings_cache.get(settings_file, loadSettings);
                
     def getMode(self, mode, settings_file=settings_file):
         """
@@ -46,14 +296,31 @@ class SettingsReader:
         @param mode: String, the name of the mode.
         @param settings_file: String, location of the settings file. Optional
         @return: Returns an object of class fetchMode, containing the fetch 
-                settings.
+                settings. The object is shared by everything in the process 
+                which reads the same mode file (see mode_cache), and must not
+                be modified.
         """
         
+        with Metrics.registry.timer('mode_load_seconds', mode=mode), \
+                Tracing.tracer.span('mode_load', 'settings', mode=mode):
+            return self._getMode(mode, settings_file);
+    
+    def _getMode(self, mode, settings_file):
         fvers = self.fvers;
         tree = self.stree;
         
-        if(tree == None or settings_file != self.settings_file):
-            return SettingsReader(settings_file).getMode(mode, settings_file);
+        if(settings_file != self.settings_file):
+            return SettingsReader(settings_file, self.snapshot_file)._getMode(mode, settings_file);
+        
+        if(self.locations != None):
+            fileLoc = self.locations.get(mode);
+            if(fileLoc == None):
+                return None;
+            
+            return mode_cache.get(fileLoc, self._loadMode);
+        
+        if(tree == None):
+            return SettingsReader(settings_file, self.snapshot_file)._getMode(mode, settings_file);
         
         # Parse the XML file and find the "Modes" element.
         try:   
@@ -62,24 +329,23 @@ class SettingsReader:
                 return None;
             
             fmode = modes.find(mode); # Find the appropriate mode in the file.
-            if(fmode == None or not fvers.modeLocAttrib in fmode.attrib):
+            if(fmode == None):
                 return None;
             
-            fileLoc = fmode.attrib[fvers.modeLocAttrib];
+            fileLoc = modeFile(fvers, fmode);
             if(fileLoc == None):
                 return None;
             
-            # By default, file locations that are not absolute locations are taken to be relative 
-            # to the default 'modes' location.
-            if(not path.isabs(fileLoc)):
-                fileLoc = path.join(dflt_modes_location, fileLoc);
-            
-            return fetchMode(fileLoc);            
+            return mode_cache.get(fileLoc, self._loadMode);            
                         
         except:
             raise;  
         
 
+    def _loadMode(self, fileLoc):
+        return loadMode(fileLoc, self.snapshot_file);
+        
+
 class SettingsWriter:
     """
     Class for writing settings to a file and updating a settings file.
@@ -299,6 +565,7 @@ class fetchMode:
     
     titleLoc = None;
     authorLoc = None;
+    pdfLoc = None;
     citeLoc = {
                'journal' : None,
                'volume' : None,
@@ -314,13 +581,28 @@ class fetchMode:
                 'desc' : None
                 };
     
-    def __init__(self, modeFile):
+    # Fields which can legitimately have more than one value on a page.
+    listFields = ('authors', 'supp_title', 'supp_pdf', 'supp_desc');
+    
+    def __init__(self, modeFile, snapshot=None):
         """
         Provide a name and various parameters to create the class object.
         
         @param modeFile: String which is the absolute path pointing to the xml file containing the
                         mode specifications.
+        @param snapshot: Dictionary returned by toSnapshot() for this mode file. If given, the mode
+                        is rebuilt from it and the XML is not read.
         """
+        
+        # Per-instance location tables, so that modes loaded side by side don't share them, and the
+        # cache of compiled XPath evaluators shared by every Loc in this mode.
+        self.citeLoc = dict.fromkeys(fetchMode.citeLoc);
+        self.suppInfo = dict.fromkeys(fetchMode.suppInfo);
+        self.xpaths = {};
+        
+        if snapshot != None:
+            self.loadSnapshot(snapshot);
+            return;
                 
         tree = etree.parse(modeFile, self.modeparser);
         root = tree.getroot();
@@ -332,19 +614,20 @@ class fetchMode:
         
         # Parse out the steps
         sparsers = [None]*self.nsteps;
+        stypes = [None]*self.nsteps;
         links = [None]*(self.nsteps-1);
         
         for step in root.findall(fvers.ModeXML.step):
             i = int(step.attrib[fvers.ModeXML.num]);
-            print(step.attrib[fvers.ModeXML.parser]);
-            sparsers[i] = self.parsers[step.attrib[fvers.ModeXML.parser]];
+            stypes[i] = step.attrib[fvers.ModeXML.parser];
+            sparsers[i] = self.parsers[stypes[i]];
         
             # Parse out the steps we need - start with the links.
             ll = step.find(fvers.ModeXML.linkLoc);
             if i != self.nsteps-1 and ll == None:
                 raise ModeException(ModeException.ERR_NO_LINK);
             elif ll != None:
-                links[i] = self.parseLoc(ll);
+                links[i] = self.Loc(self.parseLoc(ll), i, self.xpaths);
                 if fvers.ModeXML.articleLink in ll.attrib and \
                     boolString(ll.attrib[fvers.ModeXML.articleLink]):
                     self.aLinkStep = i;
@@ -355,65 +638,204 @@ class fetchMode:
                 if tl != None:
                     if fvers.ModeXML.useLinkText in tl.attrib and \
                     boolString(tl.attrib[fvers.ModeXML.useLinkText]):
-                        titleLoc = links[i];
-                        titleLoc[-1].set_at(None);
-                        self.titleLoc = self.Loc(titleLoc, i);
+                        # Same path as the link, but ending on the element rather than its 
+                        # attribute. Copy the last tag so the link keeps its 'at'.
+                        titleLoc = list(links[i].tags);
+                        last = titleLoc[-1];
+                        titleLoc[-1] = self.Tag(last.name, last.get_class(), last.get_id());
+                        self.titleLoc = self.Loc(titleLoc, i, self.xpaths);
                     else:
-                        self.titleLoc = self.Loc(self.parseLoc(tl), i);
+                        self.titleLoc = self.Loc(self.parseLoc(tl), i, self.xpaths);
             
             # Check for the author list
             if self.authorLoc == None:
                 al = step.find(fvers.ModeXML.authorLoc);
                 if al != None:
-                    self.authorLoc = self.Loc(self.parseLoc(al), i);
+                    self.authorLoc = self.Loc(self.parseLoc(al), i, self.xpaths);
+            
+            # Check for the PDF link
+            if self.pdfLoc == None:
+                pl = step.find(fvers.ModeXML.pdfLoc);
+                if pl != None:
+                    self.pdfLoc = self.Loc(self.parseLoc(pl), i, self.xpaths);
             
             # Check for a citation location.
             cl = step.find(fvers.ModeXML.citeLoc);
             if(cl != None):
                 jl = cl.find(fvers.ModeXML.journalName);
                 if(jl != None):
-                    self.citeLoc['journal'] = self.Loc(self.parseLoc(jl), i);
+                    self.citeLoc['journal'] = self.Loc(self.parseLoc(jl), i, self.xpaths);
                 
                 vl = cl.find(fvers.ModeXML.volume);
                 if(vl != None):
-                    self.citeLoc['volume'] = self.Loc(self.parseLoc(vl), i);
+                    self.citeLoc['volume'] = self.Loc(self.parseLoc(vl), i, self.xpaths);
                 
                 il = cl.find(fvers.ModeXML.issue);
                 if(il != None):
-                    self.citeLoc['issue'] = self.Loc(self.parseLoc(il), i);
+                    self.citeLoc['issue'] = self.Loc(self.parseLoc(il), i, self.xpaths);
                 
                 pl = cl.find(fvers.ModeXML.pages);
                 if(pl != None):
-                    self.citeLoc['pages'] = self.Loc(self.parseLoc(pl), i);
+                    self.citeLoc['pages'] = self.Loc(self.parseLoc(pl), i, self.xpaths);
                 
                 dl = cl.find(fvers.ModeXML.doi);
                 if(dl != None):
-                    self.citeLoc['doi'] = self.Loc(self.parseLoc(dl), i);
+                    self.citeLoc['doi'] = self.Loc(self.parseLoc(dl), i, self.xpaths);
                 
                 yl = cl.find(fvers.ModeXML.year);
                 if(yl != None):
-                    self.citeLoc['year'] = self.Loc(self.parseLoc(yl), i);
+                    self.citeLoc['year'] = self.Loc(self.parseLoc(yl), i, self.xpaths);
             
             # Find supplementary information
-            if self.suppInfo == None:
-                sl = step.find(fvers.ModeXML.suppInfo);
-                if(sl != None):
-                    slp = self.parseTag(sl);
-                    
-                    tl = step.find(fvers.ModeXML.title);
-                    if(tl != None):
-                        self.suppInfo['title'] = self.Loc(self.parseLoc(tl, slp), i);
-                    
-                    pl = step.find(fvers.ModeXML.pdf);
-                    if(pl != None):
-                        self.suppInfo['pdf'] = self.Loc(self.parseLoc(pl, slp), i);
-                    
-                    dl = step.find(fvers.ModeXML.desc);
-                    if(dl != None):
-                        self.suppInfo['desc'] = self.Loc(self.parseLoc(dl, slp), i);
+            sl = step.find(fvers.ModeXML.suppInfo);
+            if(sl != None):
+                slp = self.parseTag(sl);
+                
+                tl = sl.find(fvers.ModeXML.title);
+                if(tl != None):
+                    self.suppInfo['title'] = self.Loc(self.parseLoc(tl, slp), i, self.xpaths);
+                
+                pl = sl.find(fvers.ModeXML.pdf);
+                if(pl != None):
+                    self.suppInfo['pdf'] = self.Loc(self.parseLoc(pl, slp), i, self.xpaths);
+                
+                dl = sl.find(fvers.ModeXML.desc);
+                if(dl != None):
+                    self.suppInfo['desc'] = self.Loc(self.parseLoc(dl, slp), i, self.xpaths);
             
         self.sparsers = sparsers;        
+        self.stypes = stypes;
         self.links = links;
+        self.fields = [self.stepFields(i) for i in range(self.nsteps)];
+        self.roots = [self.stepRoots(i) for i in range(self.nsteps)];
+        self.tries = [self.stepTrie(i) for i in range(self.nsteps)];
+    
+    def toSnapshot(self):
+        '''
+        Reduces the mode to plain Python types (see writeSnapshot).
+        
+        @return: Returns a dictionary from which loadSnapshot can rebuild the mode.
+        '''
+        
+        def loc(l):
+            if l == None:
+                return None;
+            return (l.step, [(t.name, t.get_class(), t.get_id(), t.get_at()) for t in l.tags]);
+        
+        return {
+                'version' : self.fvers.version,
+                'name' : self.name,
+                'nsteps' : self.nsteps,
+                'stypes' : list(self.stypes),
+                'aLinkStep' : getattr(self, 'aLinkStep', None),
+                'links' : [loc(l) for l in self.links],
+                'titleLoc' : loc(self.titleLoc),
+                'authorLoc' : loc(self.authorLoc),
+                'pdfLoc' : loc(self.pdfLoc),
+                'citeLoc' : dict([(k, loc(v)) for k, v in self.citeLoc.items()]),
+                'suppInfo' : dict([(k, loc(v)) for k, v in self.suppInfo.items()])
+                };
+    
+    def loadSnapshot(self, snap):
+        '''
+        Rebuilds the mode from a dictionary returned by toSnapshot.
+        
+        @param snap: The dictionary.
+        '''
+        
+        def loc(l):
+            if l == None:
+                return None;
+            return self.Loc([self.Tag(*t) for t in l[1]], l[0], self.xpaths);
+        
+        self.fvers = CompatibilityHelper(snap['version']);
+        self.name = snap['name'];
+        self.nsteps = snap['nsteps'];
+        self.stypes = snap['stypes'];
+        self.sparsers = [self.parsers[t] for t in self.stypes];
+        if snap['aLinkStep'] != None:
+            self.aLinkStep = snap['aLinkStep'];
+        
+        self.links = [loc(l) for l in snap['links']];
+        self.titleLoc = loc(snap['titleLoc']);
+        self.authorLoc = loc(snap['authorLoc']);
+        self.pdfLoc = loc(snap['pdfLoc']);
+        for k, v in snap['citeLoc'].items():
+            self.citeLoc[k] = loc(v);
+        for k, v in snap['suppInfo'].items():
+            self.suppInfo[k] = loc(v);
+        
+        self.fields = [self.stepFields(i) for i in range(self.nsteps)];
+        self.roots = [self.stepRoots(i) for i in range(self.nsteps)];
+        self.tries = [self.stepTrie(i) for i in range(self.nsteps)];
+        
+    def stepRoots(self, step):
+        '''
+        Finds the distinct top-level tags of all the locations on a given step - the only parts of
+        the page which need to be kept to find everything on it.
+        
+        @param step: int, the step (0-based index).
+        @return: Returns a list of Loc items, one for each distinct first tag.
+        '''
+        
+        roots = {};
+        for loc in self.stepLocs(step):
+            roots.setdefault(loc.tags[0].predicate(), loc);
+        
+        return [roots[key] for key in sorted(roots)];
+        
+    def stepFields(self, step):
+        '''
+        Collects the locations of all the information found on a given step, other than the link
+        to the next step.
+        
+        @param step: int, the step (0-based index).
+        @return: Returns a list of (field name, Loc) tuples. Citation fields are named as in 
+                citeLoc, supplementary information fields are prefixed with 'supp_'.
+        '''
+        
+        named = [('title', self.titleLoc), ('authors', self.authorLoc), ('pdf', self.pdfLoc)];
+        named += sorted(self.citeLoc.items());
+        named += [('supp_' + key, loc) for key, loc in sorted(self.suppInfo.items())];
+        
+        fields = [];
+        for name, loc in named:
+            if loc != None and loc.step == step:
+                fields.append((name, loc));
+        
+        return fields;
+    
+    def stepLocs(self, step):
+        '''
+        @param step: int, the step (0-based index).
+        @return: Returns the list of all the locations on a step - the link to the next step, if
+                there is one, followed by the Locs of stepFields in the same order.
+        '''
+        
+        locs = [loc for name, loc in self.fields[step]];
+        if step < len(self.links) and self.links[step] != None:
+            locs.insert(0, self.links[step]);
+        
+        return locs;
+    
+    def stepTrie(self, step):
+        '''
+        Merges all the locations on a step into a single LocTrie, so that they can all be found
+        in one pass over a page.
+        
+        @param step: int, the step (0-based index).
+        @return: Returns the LocTrie, over the Locs of stepLocs in that order, or None if any of
+                them has a tag name which isn't a plain element name (or *), in which case the
+                Locs have to be evaluated one by one.
+        '''
+        
+        locs = self.stepLocs(step);
+        for loc in locs:
+            for tag in loc.tags:
+                if not re_tag_name.match(tag.name):
+                    return None;
+        
+        return self.LocTrie(locs, self.xpaths);
         
     def parseLoc(self, element, parent=None):
         '''
@@ -434,7 +856,7 @@ class fetchMode:
             tags.append(self.parseTag(child));
                     
         # Check if the final tag has an 'at' attribute.
-        child = element[-1];
+        child = element[-1] if len(element) else element;
         if(fvers.ModeXML.attrib in child.attrib):
             tags[-1].set_at(child.attrib[fvers.ModeXML.attrib]);
         
@@ -482,31 +904,403 @@ class fetchMode:
         
         return './/'+tag;
     
-    class Loc:
+    class Loc(object):
         '''
         Class for specifying locations and such.
+        
+        The list of tags is compiled once into an etree.XPath evaluator, so that finding the
+        location on a page is done in a single call into lxml rather than by walking the tree.
+        The evaluators are compiled the first time they are used, so a mode which is loaded 
+        (e.g. from a snapshot) but only partly used doesn't pay for the rest.
+        
+        Locs, Tags and Steps use __slots__, so a mode costs no per-object dictionaries however
+        many are kept around.
         '''
         
-        def __init__(self, tags, step):
+        __slots__ = ('tags', 'step', 'cache', '_xpath', '_item_xpath', '_root_xpath', 
+                     '_within_xpath');
+        
+        def __init__(self, tags, step, cache=None):
             '''
             Instantiate the class with a list of tags locating the relevant information and the 
             step number that it's in (0-based index.);
             
             @param tags: List of Tag items.
             @param step: int, the step it's on.
+            @param cache: Dictionary of compiled XPath objects keyed by expression, shared between
+                        the Locs of a mode. Pass None to compile without caching.
             '''
             self.tags = tags;
             self.step = step;
+            self.cache = cache;
+            
+            self._xpath = None;
+            self._item_xpath = None;
+            self._root_xpath = None;
+            self._within_xpath = None;
+        
+        @property
+        def xpath(self):
+            if self._xpath is None:
+                self._xpath = self.compile(self.expression(), self.cache);
+            return self._xpath;
+        
+        @property
+        def item_xpath(self):
+            if self._item_xpath is None:
+                self._item_xpath = self.compile('.//' + self.tags[0].predicate(), self.cache);
+            return self._item_xpath;
+        
+        @property
+        def root_xpath(self):
+            if self._root_xpath is None:
+                self._root_xpath = self.compile('self::' + self.tags[0].predicate(), self.cache);
+            return self._root_xpath;
+        
+        @property
+        def within_xpath(self):
+            if self._within_xpath is None:
+                self._within_xpath = self.compile(self.expression(True), self.cache);
+            return self._within_xpath;
+        
+        @staticmethod
+        def compile(expr, cache):
+            '''
+            Compiles an XPath expression, reusing an already compiled one from the cache if there
+            is one.
+            
+            @param expr: String, the XPath expression.
+            @param cache: Dictionary of compiled expressions, or None.
+            @return: The etree.XPath object.
+            '''
+            
+            if(cache == None):
+                return etree.XPath(expr, smart_strings=False);
+            
+            xpath = cache.get(expr);
+            if xpath is None:
+                # Two threads may both compile an expression; the dictionary keeps one of them.
+                xpath = cache.setdefault(expr, etree.XPath(expr, smart_strings=False));
+            
+            return xpath;
+        
+        def expression(self, within=False):
+            '''
+            Builds the XPath expression for this location. Each tag is searched for among the 
+            descendants of the previous one, and if the final tag has an 'at' attribute the 
+            expression selects that attribute rather than the element.
+            
+            @param within: Boolean, if True the expression is relative to an element matching the
+                        first tag (see items()), rather than searching for that tag.
+            @return: String, the XPath expression.
+            '''
+            
+            preds = [tag.predicate() for tag in self.tags];
+            if within:
+                expr = 'self::' + '//'.join(preds);
+            else:
+                expr = './/' + '//'.join(preds);
+            
+            last = self.tags[-1];
+            if last.use_at():
+                expr += '/@' + last.get_at();
+                
+            return expr;
+        
+        def items(self, node):
+            '''
+            Finds the elements matching the first tag of the location, e.g. each 'article' in a
+            table of contents, so that several locations can be evaluated per item.
+            
+            @param node: An element or element tree, generally a parsed page.
+            @return: List of elements.
+            '''
+            return self.item_xpath(node);
+        
+        def isItem(self, element):
+            '''
+            Checks whether an element matches the first tag of the location. Only the element's
+            own name and attributes are looked at, so this can be called as soon as its start tag
+            has been parsed.
+            
+            @param element: An element.
+            @return: Boolean.
+            '''
+            return len(self.root_xpath(element)) > 0;
+        
+        def evaluate(self, node, within=False):
+            '''
+            Find all the matches for this location below a given node.
+            
+            @param node: An element or element tree, generally a parsed page.
+            @param within: Boolean, set to True if node is an element returned by items().
+            @return: List of elements, or of strings if the location ends on an attribute.
+            '''
+            
+            if within:
+                return self.within_xpath(node);
+            
+            return self.xpath(node);
+        
+        def text(self, node, within=False):
+            '''
+            Like evaluate, but always returns strings - the attribute value, or the whitespace
+            normalised text content of each matching element.
+            
+            @param node: An element or element tree, generally a parsed page.
+            @param within: Boolean, set to True if node is an element returned by items().
+            @return: List of strings.
+            '''
+            
+            out = [];
+            for match in self.evaluate(node, within):
+                if etree.iselement(match):
+                    match = ' '.join(''.join(match.itertext()).split());
+                out.append(match);
+                
+            return out;
+    
+    class LocTrie(object):
+        '''
+        The locations on a step merged into a trie of tags, for finding all of them in a single
+        walk of a page. Locations sharing a prefix (e.g. the citation fields, which all start 
+        from the same 'dl') share the nodes for it, so the cost of matching them depends on the
+        size of the page rather than on the number of locations.
+        
+        The elements matching any location's first tag are found with one XPath call, and only
+        the subtrees below them are walked - by lxml, which only stops at elements whose names
+        appear somewhere in the trie. Each of those is tested against the children of every 
+        trie node reached by one of its ancestors, so every match is sent to every location 
+        that ends at the node it reaches.
+        
+        Matches are recorded with the element that matched the first tag (their origin), so 
+        that locations can be read either over the whole page, as Loc.evaluate gives them, or
+        per item, as Loc.evaluate(item, True) does for the items found by Loc.items.
+        '''
+        
+        __slots__ = ('locs', 'ats', 'root', 'names', 'cache', 'roots_expr', '_roots_xpath');
+        
+        def __init__(self, locs, cache=None):
+            '''
+            @param locs: List of Loc items. The locations are numbered by their place in it.
+            @param cache: Dictionary of compiled XPath objects, as for Loc.
+            '''
+            
+            self.locs = list(locs);
+            self.ats = [loc.tags[-1].get_at() for loc in self.locs];
+            self.root = fetchMode.TrieNode(None);
+            
+            names = set();
+            for i, loc in enumerate(self.locs):
+                node = self.root;
+                for tag in loc.tags:
+                    node = node.child(tag);
+                    names.add(tag.name);
+                node.ends.append(i);
+            
+            # The element names worth stopping at, or None for all of them.
+            self.names = None;
+            if '*' not in names:
+                self.names = sorted(names);
+            
+            preds = sorted(set([loc.tags[0].predicate() for loc in self.locs]));
+            self.roots_expr = ' | '.join(['.//' + pred for pred in preds]);
+            self.cache = cache;
+            self._roots_xpath = None;
+        
+        @property
+        def roots_xpath(self):
+            # Compiled on first use, as for Loc.
+            if self._roots_xpath is None:
+                self._roots_xpath = fetchMode.Loc.compile(self.roots_expr, self.cache);
+            return self._roots_xpath;
+        
+        def match(self, node):
+            '''
+            Finds every location below a node.
+            
+            @param node: An element or element tree, generally a parsed page.
+            @return: Returns a tuple of the list of elements matching a first tag (the origins), 
+                    in document order, and a list with, for each location, the list of its 
+                    matches as (origin, element) tuples in document order. An element matched
+                    from more than one origin appears once for each.
+            '''
+            
+            origins = [];
+            found = [[] for loc in self.locs];
+            if len(self.locs) == 0:
+                return (origins, found);
+            
+            last = None;
+            for top in self.roots_xpath(node):
+                if last is not None and any(a == last for a in top.iterancestors()):
+                    # Already walked, as part of an enclosing match.
+                    continue;
+                
+                self.walk(top, origins, found);
+                last = top;
+            
+            return (origins, found);
+        
+        def walk(self, top, origins, found):
+            '''
+            Walks the subtree of an element in document order, matching it against the trie.
+            '''
+            
+            roots = self.root;
+            stack = [()];       # The (trie node, origin) states reached by each open element.
+            for event, element in etree.iterwalk(top, ('start', 'end'), tag=self.names):
+                if event == 'end':
+                    stack.pop();
+                    continue;
+                
+                states = stack[-1];
+                name = element.tag;
+                
+                # A first tag can match anywhere, starting a new origin.
+                matched = [];
+                for child in roots.children.get(name, roots.any):
+                    if child.plain or child.matches(element):
+                        if len(matched) == 0:
+                            origins.append(element);
+                        matched.append((child, element));
+                
+                for node, origin in states:
+                    for child in node.children.get(name, node.any):
+                        if child.plain or child.matches(element):
+                            matched.append((child, origin));
+                
+                if len(matched):
+                    if len(matched) > 1:
+                        matched = unique(matched);
+                    for child, origin in matched:
+                        for i in child.ends:
+                            found[i].append((origin, element));
+                    
+                    # States which can go further, and aren't there already.
+                    new = [m for m in matched if len(m[0].keys) and m not in states];
+                    if len(new):
+                        states = states + tuple(new);
+                
+                stack.append(states);
+        
+        def value(self, i, element):
+            '''
+            @return: Returns the string a match gives for location i - its attribute, or its 
+                    whitespace normalised text - or None if it doesn't have the attribute.
+            '''
+            
+            at = self.ats[i];
+            if at != None:
+                return element.get(at);
+            
+            return ' '.join(''.join(element.itertext()).split());
+        
+        def text(self, found, i):
+            '''
+            @param found: The list of matches returned by match().
+            @param i: int, the location.
+            @return: Returns the strings for location i over the whole page, as Loc.text(node) 
+                    does.
+            '''
+            
+            out = [];
+            for element in unique([element for origin, element in found[i]]):
+                v = self.value(i, element);
+                if v != None:
+                    out.append(v);
+            
+            return out;
+        
+        def byOrigin(self, found, i):
+            '''
+            @param found: The list of matches returned by match().
+            @param i: int, the location.
+            @return: Returns a dictionary mapping each origin to the strings for location i 
+                    within it, as Loc.text(origin, True) does.
+            '''
+            
+            out = {};
+            for origin, element in found[i]:
+                v = self.value(i, element);
+                if v != None:
+                    out.setdefault(origin, []).append(v);
+            
+            return out;
+    
+    class TrieNode(object):
+        '''
+        A node of a LocTrie - a tag, the nodes for the tags which can follow it, and the 
+        locations which end on it.
+        '''
+        
+        __slots__ = ('name', '_id', 'classes', 'plain', 'children', 'any', 'ends', 'keys');
+        
+        def __init__(self, tag):
+            '''
+            @param tag: The Tag item, or None for the root.
+            '''
+            
+            self.name = None;
+            self._id = None;
+            self.classes = ();
+            if tag != None:
+                self.name = tag.name;
+                self._id = tag.get_id();
+                if tag.has_class():
+                    self.classes = tuple(tag.get_class().split());
+            
+            # Whether any element with the right name matches.
+            self.plain = self._id == None and len(self.classes) == 0;
+            
+            self.children = {};     # Tag name -> list of TrieNode, including those in any.
+            self.any = [];          # Children matching any name (*).
+            self.ends = [];         # Indices of the locations ending here.
+            self.keys = {};         # Predicate -> TrieNode, for building.
+        
+        def child(self, tag):
+            '''
+            @return: Returns the child node for a tag, adding it if there isn't one.
+            '''
+            
+            key = tag.predicate();
+            node = self.keys.get(key);
+            if node == None:
+                node = self.keys[key] = fetchMode.TrieNode(tag);
+                if tag.name == '*':
+                    self.any.append(node);
+                    for nodes in self.children.values():
+                        nodes.append(node);
+                else:
+                    self.children.setdefault(tag.name, list(self.any)).append(node);
+            
+            return node;
+        
+        def matches(self, element):
+            '''
+            Checks an element's id and classes, its name being known to match.
+            '''
+            
+            if self._id != None and element.get('id') != self._id:
+                return False;
+            
+            if len(self.classes):
+                have = element.get('class');
+                if have == None:
+                    return False;
+                have = re_xml_space.split(have);
+                for cls in self.classes:
+                    if cls not in have:
+                        return False;
+            
+            return True;
     
-    class Tag:
+    class Tag(object):
         '''
         Class for specifying a kind of tag.
         '''
         
-        name = None;
-        _class = None;
-        _id = None;
-        _at = None;
+        __slots__ = ('name', '_class', '_id', '_at');
         
         def __init__(self, name, _class=None, _id=None, _at=None):
             '''
@@ -521,6 +1315,30 @@ class fetchMode:
             self.name = name;
             self._class = _class;
             self._id = _id;
+            self._at = _at;
+        
+        def predicate(self):
+            '''
+            The XPath node test for this tag, including its id and class conditions. Classes 
+            containing spaces (e.g. 'authors expandable') are split and each class is required to 
+            be present, in any order, as a browser would match them.
+            
+            @return: String, the XPath step (without axis) matching this tag.
+            '''
+            
+            conds = [];
+            if self.has_id():
+                conds.append('@id=' + xpathLiteral(self._id));
+                
+            if self.has_class():
+                for cls in self._class.split():
+                    conds.append("contains(concat(' ', normalize-space(@class), ' '), " + 
+                                 xpathLiteral(' ' + cls + ' ') + ')');
+            
+            if len(conds) == 0:
+                return self.name;
+            
+            return self.name + '[' + ' and '.join(conds) + ']';
         
         def has_id(self):
             return (not self._id == None);
@@ -549,27 +1367,18 @@ class fetchMode:
         def set_at(self, val):
             self._at = val;
             
-    class Step:
+    class Step(object):
         '''
         Class containing information about where to find the information in a 
         given step. This is arranged as a linked-list, and so must contain
         references to the previous and next steps
         '''
         
-        # List linking
-        next = None
-        prev = None
-        
-        # The Loc items
-        linkLoc = None
-        titleLoc = None
-        authorLoc = None
-        citeLoc = None
-        suppInfo = None
-        
-        # Booleans
-        useLinkText = False
-        isArticleLink = True
+        __slots__ = (
+                     'next', 'prev',                                                # List linking
+                     'linkLoc', 'titleLoc', 'authorLoc', 'citeLoc', 'suppInfo',     # The Loc items
+                     'useLinkText', 'isArticleLink'                                 # Booleans
+                     )
         
         def __init__(self, prev_step=None, linkLoc=None,
                      titleLoc=None,authorLoc=None,citeLoc=None,suppInfo=None):
@@ -594,6 +1403,11 @@ class fetchMode:
                             information.
             '''
             
+            self.next = None
+            self.titleLoc = None
+            self.useLinkText = False
+            self.isArticleLink = True
+            
             # Update the linked list
             prev = self.prev = prev_step
             
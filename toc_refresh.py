@@ -0,0 +1,146 @@
+"""
+Library for refreshing issues whose tables of contents keep changing after they are published
+(e.g. online-first journals), without crawling them again from scratch.
+
+After each crawl, a snapshot of the issue is kept: a fingerprint of each article as the table of
+contents listed it, with what was found on the article's page and the files downloaded for it.
+The next crawl of the issue compares the articles it finds against it, and only fetches the pages
+of - and downloads the files for - the articles which are new or whose listing has changed.
+
+@author: SquidneyPoitier <squidney.poitier@gmail.com>
+@version: 0.1
+"""
+
+from os import path;
+import hashlib;
+import json;
+import os;
+import tempfile;
+
+dflt_snapshot_location = path.join(path.dirname(path.abspath(__file__)), 'snapshots');
+snapshot_format = 1;
+
+class TOCSnapshots:
+    '''
+    Snapshots of issues, kept as one small JSON file each in a directory, named by the hash of
+    the mode and the table of contents URL.
+
+    A snapshot is a dictionary with the 'digest' of the whole list of articles, their URLs in
+    'order', and for each URL in 'articles', a dictionary with its 'fingerprint', the 'fields'
+    found on its page, and its 'files' as [URL, path, size, SHA-256] lists.
+    '''
+
+    def __init__(self, location=dflt_snapshot_location):
+        '''
+        @param location: String, the directory to keep the snapshots in.
+        '''
+
+        self.location = location;
+        if not path.isdir(location):
+            os.makedirs(location);
+
+    def snapshotFile(self, mode, url):
+        return path.join(self.location, hashlib.sha1(mode + '\n' + url).hexdigest() + '.json');
+
+    def load(self, mode, url):
+        '''
+        @param mode: String, the mode the issue is crawled with.
+        @param url: String, the table of contents URL.
+        @return: Returns the last snapshot of the issue, or None if there isn't one (or it can't
+                be read).
+        '''
+
+        try:
+            with open(self.snapshotFile(mode, url), 'rb') as f:
+                snap = json.load(f);
+        except (IOError, ValueError):
+            return None;
+
+        if snap.get('format') != snapshot_format:
+            return None;
+
+        return snap;
+
+    def save(self, mode, url, snap):
+        '''
+        Replace the snapshot of an issue. The file is written in full before it replaces the
+        old one, so a crash never leaves half a snapshot.
+        '''
+
+        snap = dict(snap);
+        snap['format'] = snapshot_format;
+        fname = self.snapshotFile(mode, url);
+        fd, temp = tempfile.mkstemp(dir=self.location);
+        with os.fdopen(fd, 'wb') as f:
+            json.dump(snap, f);
+
+        if os.name == 'nt' and path.exists(fname):
+            os.remove(fname);
+        os.rename(temp, fname);
+
+    def forget(self, mode, url):
+        fname = self.snapshotFile(mode, url);
+        if path.exists(fname):
+            os.remove(fname);
+
+
+class RefreshReport:
+    '''
+    What changed in an issue since its last snapshot.
+    '''
+
+    def __init__(self, previous):
+        '''
+        @param previous: The snapshot compared against, or None if there wasn't one.
+        '''
+
+        self.previous = previous;
+        self.added = [];        # URLs of articles which weren't in the snapshot.
+        self.changed = [];      # URLs of articles listed differently.
+        self.unchanged = [];    # URLs of articles taken from the snapshot.
+        self.removed = [];      # URLs of articles in the snapshot which are no longer listed.
+        self.removed_files = [];    # Their files, deleted when the issue's are downloaded.
+        self.complete = True;   # False if pages above the articles failed, hiding any removals.
+        self.digest = None;
+
+    def add(self, result, url):
+        '''
+        @param result: String, 'added', 'changed' or 'unchanged'.
+        @param url: String, the article's URL.
+        '''
+        getattr(self, result).append(url);
+
+    def modified(self):
+        '''
+        @return: Returns True if the list of articles is different from the snapshot's.
+        '''
+        return self.previous == None or self.digest != self.previous.get('digest');
+
+    def report(self):
+        '''
+        @return: Returns a list of strings describing the changes.
+        '''
+
+        lines = [];
+        for label, urls in (('Added', self.added), ('Changed', self.changed),
+                            ('Removed', self.removed)):
+            for url in urls:
+                lines.append(label + ': ' + url);
+        lines.append(str(len(self.unchanged)) + ' unchanged');
+        return lines;
+
+
+def fingerprint(url, fields):
+    '''
+    @param url: String, the article's URL.
+    @param fields: Dictionary of the fields the table of contents lists for it.
+    @return: Returns a short hex digest which changes whenever the URL or any of the fields do.
+    '''
+    return hashlib.sha1(json.dumps([url, sorted(fields.items())])).hexdigest()[:16];
+
+def listDigest(articles):
+    '''
+    @param articles: List of (URL, fingerprint) tuples, in order.
+    @return: Returns a hex digest of the whole list.
+    '''
+    return hashlib.sha1(json.dumps(articles)).hexdigest();
@@ -0,0 +1,180 @@
+"""
+Library for recording a timeline of what each thread and process was doing - loading modes,
+fetching and parsing pages, evaluating locations, downloading and merging PDFs - and writing it
+out in the Chrome trace event format, to be opened in chrome://tracing or ui.perfetto.dev.
+
+Where the metrics module says how long things take on average, a trace shows when they happened
+and alongside what, so it shows where workers sit idle waiting on each other.
+
+Tracing is off unless enabled, and costs a function call per span when it is.
+
+@author: SquidneyPoitier <squidney.poitier@gmail.com>
+@version: 0.1
+"""
+
+import json;
+import multiprocessing;
+import os;
+import threading;
+import time;
+
+class Tracer:
+    '''
+    Thread-safe recorder of spans, each a named stretch of time on one thread, with a category
+    and any arguments (e.g. the step and URL of a page).
+    '''
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled;
+        self.lock = threading.Lock();
+        self.events = [];
+        self.names = {};        # (pid, tid) -> thread name, for the threads seen so far.
+
+    def enable(self):
+        '''
+        Start recording, discarding anything recorded before.
+        '''
+
+        with self.lock:
+            self.events = [];
+            self.names = {};
+        self.enabled = True;
+
+    def disable(self):
+        self.enabled = False;
+
+    def span(self, name, cat, **args):
+        '''
+        @param name: String, what is being done, e.g. 'fetch'.
+        @param cat: String, the stage it belongs to, e.g. 'crawl'.
+        @param args: Anything else to show with the span.
+        @return: Returns a context manager which records the time spent in it, or one which does
+                nothing if tracing is off.
+        '''
+
+        if not self.enabled:
+            return null_span;
+        return Span(self, name, cat, args);
+
+    def add(self, name, cat, start, end, args):
+        '''
+        Record a span of the current thread.
+
+        @param start: float, when it started, as from time.time().
+        @param end: float, when it ended.
+        '''
+
+        pid = os.getpid();
+        thread = threading.current_thread();
+        event = {
+                 'name' : name,
+                 'cat' : cat,
+                 'ph' : 'X',
+                 'ts' : int(start*1e6),
+                 'dur' : int((end - start)*1e6),
+                 'pid' : pid,
+                 'tid' : thread.ident,
+                 'args' : args
+                 };
+
+        with self.lock:
+            self.events.append(event);
+            if (pid, thread.ident) not in self.names:
+                self.names[(pid, thread.ident)] = thread.name;
+                if (pid, None) not in self.names:
+                    self.names[(pid, None)] = multiprocessing.current_process().name;
+
+    def drain(self):
+        '''
+        Take everything recorded so far, e.g. to send it from a worker process back to the one
+        writing the trace (see extend).
+
+        @return: Returns a tuple of the list of events and the dictionary of thread names.
+        '''
+
+        with self.lock:
+            out = (self.events, self.names);
+            self.events = [];
+            self.names = {};
+
+        return out;
+
+    def extend(self, recorded):
+        '''
+        Add events taken from another tracer by drain().
+        '''
+
+        events, names = recorded;
+        if not self.enabled:
+            return;
+
+        with self.lock:
+            self.events.extend(events);
+            for key, name in names.items():
+                self.names.setdefault(key, name);
+
+    def toDict(self):
+        '''
+        @return: Returns the trace, as a dictionary in the Chrome trace event format, with the
+                names of the processes and threads as metadata events.
+        '''
+
+        with self.lock:
+            events = list(self.events);
+            names = self.names.items();
+
+        meta = [];
+        for (pid, tid), name in sorted(names):
+            if tid == None:
+                meta.append({'name' : 'process_name', 'ph' : 'M', 'pid' : pid,
+                             'args' : {'name' : name}});
+            else:
+                meta.append({'name' : 'thread_name', 'ph' : 'M', 'pid' : pid, 'tid' : tid,
+                             'args' : {'name' : name}});
+
+        events.sort(key=lambda e: e['ts']);
+        return {'traceEvents' : meta + events, 'displayTimeUnit' : 'ms'};
+
+    def write(self, fname):
+        with open(fname, 'wb') as f:
+            json.dump(self.toDict(), f);
+
+
+class Span:
+    '''
+    Context manager returned by Tracer.span.
+    '''
+
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer;
+        self.name = name;
+        self.cat = cat;
+        self.args = args;
+        self.start = None;
+
+    def __enter__(self):
+        self.start = time.time();
+        return self;
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type != None:
+            self.args['error'] = exc_type.__name__;
+        self.tracer.add(self.name, self.cat, self.start, time.time(), self.args);
+
+
+class NullSpan:
+    '''
+    Context manager returned by Tracer.span when tracing is off.
+    '''
+
+    def __enter__(self):
+        return self;
+
+    def __exit__(self, *args):
+        pass;
+
+null_span = NullSpan();
+
+
+# The tracer everything in the process records to.
+tracer = Tracer();